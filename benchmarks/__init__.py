@@ -0,0 +1,2 @@
+"""Benchmarks of the storage, id, envelope and streaming hot paths, and an
+end to end load driver. Run them all with ``python -m benchmarks``."""
@@ -0,0 +1,48 @@
+"""Run the benchmark suite and save the results as JSON.
+
+    python -m benchmarks --output results.json
+    python -m benchmarks --only storage ids --sizes 1000 --compare results.json
+"""
+import argparse
+
+from benchmarks import envelope, ids, load, storage, streaming  # noqa: F401 -- registers the benchmarks
+from benchmarks.harness import compare, flatten, load_results, registered, run, save_results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--only', nargs='*', default=(), metavar='PREFIX',
+                        help='run only the benchmarks whose names start with one of these')
+    parser.add_argument('--sizes', nargs='*', type=int, default=None,
+                        help='data sizes to run every benchmark at instead of its defaults '
+                             '(items, or MiB for streaming)')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None, metavar='RESULTS',
+                        help='print the change of every metric against a previous results file')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+    args = parser.parse_args()
+
+    benchmarks = registered(args.only)
+    if args.list:
+        for b in benchmarks:
+            print(f'{b.name:<28} sizes {", ".join(map(str, b.sizes))}')
+        return
+
+    results = run(benchmarks, args.sizes)
+    if args.output:
+        save_results(args.output, results)
+
+    if args.compare:
+        print(f'{"benchmark":<26} {"size":>7} {"metric":<40} {"before":>12} {"after":>12} {"ratio":>7}')
+        for name, size, metric, before, after, ratio in compare(load_results(args.compare), results):
+            before = '-' if before is None else f'{before:.6g}'
+            ratio = '-' if ratio is None else f'{ratio:.2f}'
+            print(f'{name:<26} {size:>7} {metric:<40} {before:>12} {after:>12.6g} {ratio:>7}')
+    else:
+        for result in results:
+            for metric, value in flatten(result['metrics']):
+                print(f'{result["name"]:<26} {result["size"]:>7} {metric:<40} {value:>12.6g}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Compare the JSON and binary MessageEnvelope encodings.
+
+Measures encode and decode throughput of the exact conversions the two
+column types perform, and the encoded size of each. The JSON size is the
+length of the serialized document, which is what psycopg2 sends and a
+close lower bound for what JSONB stores.
+
+    python -m benchmarks.envelope --count 20000
+
+Part of the suite run by ``python -m benchmarks`` as ``envelope``.
+"""
+import argparse
+import json
+import time
+
+from google.protobuf import any_pb2
+from google.protobuf.json_format import MessageToDict, ParseDict
+
+from benchmarks.harness import benchmark, best_of
+from bifrostv1.bifrost_pb2 import Endpoint
+
+
+def make_endpoints(count):
+    return [
+        Endpoint(
+            id=i,
+            name=f'endpoint-{i}',
+            service_name='benchmark-service',
+            url=f'http://endpoint-{i}.bifrost.valhalla:4480/my-webhook',
+            forward_to=f'127.0.0.1:{5000 + i % 1000}',
+            owner=f'owner-{i % 50}',
+            tags=['benchmark', f'shard-{i % 8}'])
+        for i in range(count)]
+
+
+def make_envelopes(count):
+    envelopes = []
+    for endpoint in make_endpoints(count):
+        envelope = any_pb2.Any()
+        envelope.Pack(endpoint)
+        envelopes.append(envelope)
+    return envelopes
+
+
+def timed(fn, items):
+    start = time.perf_counter()
+    results = [fn(item) for item in items]
+    return time.perf_counter() - start, results
+
+
+def json_encode(envelope):
+    return json.dumps(MessageToDict(envelope))
+
+
+def json_decode(document):
+    envelope = ParseDict(json.loads(document), any_pb2.Any())
+    endpoint = Endpoint()
+    envelope.Unpack(endpoint)
+    return endpoint
+
+
+def binary_encode(envelope):
+    return envelope.SerializeToString()
+
+
+def binary_decode(data):
+    envelope = any_pb2.Any.FromString(data)
+    endpoint = Endpoint()
+    envelope.Unpack(endpoint)
+    return endpoint
+
+
+FORMATS = (('json', json_encode, json_decode),
+           ('binary', binary_encode, binary_decode))
+
+
+def run(count):
+    envelopes = make_envelopes(count)
+    results = {}
+    for name, encode, decode in FORMATS:
+        encode_seconds, encoded = timed(encode, envelopes)
+        decode_seconds, _ = timed(decode, encoded)
+        size = sum(len(e) for e in encoded)
+        results[name] = dict(
+            encode_per_second=count / encode_seconds,
+            decode_per_second=count / decode_seconds,
+            mean_size_bytes=size / count)
+    return results
+
+
+@benchmark('envelope', sizes=(100, 1000, 10000))
+def envelope_suite(size):
+    envelopes = make_envelopes(size)
+    results = {}
+    for name, encode, decode in FORMATS:
+        encoded = [encode(e) for e in envelopes]
+        results[name] = dict(
+            encode=best_of(lambda: [encode(e) for e in envelopes], size),
+            decode=best_of(lambda: [decode(e) for e in encoded], size),
+            mean_size_bytes=sum(len(e) for e in encoded) / size)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=10000, help='number of envelopes')
+    args = parser.parse_args()
+
+    results = run(args.count)
+    print(f'{"format":<8} {"encode/s":>12} {"decode/s":>12} {"bytes":>8}')
+    for name, result in results.items():
+        print(f'{name:<8} {result["encode_per_second"]:>12.0f} '
+              f'{result["decode_per_second"]:>12.0f} {result["mean_size_bytes"]:>8.1f}')
+
+    json_result, binary_result = results['json'], results['binary']
+    print()
+    print(f'binary is {binary_result["encode_per_second"] / json_result["encode_per_second"]:.1f}x faster to encode, '
+          f'{binary_result["decode_per_second"] / json_result["decode_per_second"]:.1f}x faster to decode and '
+          f'{json_result["mean_size_bytes"] / binary_result["mean_size_bytes"]:.1f}x smaller')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Registration, timing and result files shared by the benchmarks.
+
+A benchmark is a function of one data size returning a dict of metrics.
+Modules register theirs with :func:`benchmark` at import time and
+``python -m benchmarks`` runs them at every requested size.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, NamedTuple, Sequence
+
+
+__all__ = (
+    'Benchmark',
+    'benchmark',
+    'registered',
+    'best_of',
+    'latency_summary',
+    'run',
+    'save_results',
+    'load_results',
+    'compare',
+    'flatten',
+)
+
+
+class Benchmark(NamedTuple):
+    name: str
+    fn: Callable[[int], Dict[str, float]]
+    sizes: Sequence[int]
+
+
+_REGISTRY = {}  # type: Dict[str, Benchmark]
+
+
+def benchmark(name: str, sizes: Sequence[int]=(1000,)):
+    """Register the decorated function as the benchmark `name`, run by
+    default at each of `sizes`."""
+    def register(fn):
+        _REGISTRY[name] = Benchmark(name, fn, tuple(sizes))
+        return fn
+    return register
+
+
+def registered(prefixes: Sequence[str]=()) -> List[Benchmark]:
+    return [b for name, b in sorted(_REGISTRY.items())
+            if not prefixes or any(name.startswith(p) for p in prefixes)]
+
+
+def best_of(fn: Callable[[], object], operations: int, repeat: int=5) -> Dict[str, float]:
+    """Time `repeat` calls of `fn`, each performing `operations` operations,
+    and report the fastest. The minimum is the run least disturbed by the
+    rest of the machine, as with :mod:`timeit`."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return dict(seconds_per_op=best / operations, ops_per_second=operations / best)
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    if not latencies:
+        return dict(count=0)
+    ordered = sorted(latencies)
+    return dict(
+        count=len(ordered),
+        mean_seconds=sum(ordered) / len(ordered),
+        p50_seconds=_percentile(ordered, .50),
+        p90_seconds=_percentile(ordered, .90),
+        p99_seconds=_percentile(ordered, .99),
+        max_seconds=ordered[-1])
+
+
+def run(benchmarks: List[Benchmark], sizes: Sequence[int]=None, log=sys.stderr) -> List[dict]:
+    results = []
+    for b in benchmarks:
+        for size in sizes or b.sizes:
+            print(f'{b.name} size={size}', file=log, flush=True)
+            started = time.perf_counter()
+            metrics = b.fn(size)
+            results.append(dict(name=b.name, size=size, metrics=metrics,
+                                wall_seconds=time.perf_counter() - started))
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path: str, results: List[dict]):
+    document = dict(
+        created=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        revision=_git_revision(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        results=results)
+    with open(path, 'w') as outfile:
+        json.dump(document, outfile, indent=2, sort_keys=True)
+
+
+def load_results(path: str) -> dict:
+    with open(path, 'r') as infile:
+        return json.load(infile)
+
+
+def flatten(metrics, prefix=''):
+    for key, value in metrics.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)):
+            yield f'{prefix}{key}', value
+
+
+def compare(baseline: dict, results: List[dict]) -> List[tuple]:
+    """Pair every metric of `results` with the same metric in a saved
+    `baseline` document: (benchmark, size, metric, before, after, ratio)."""
+    before = {(r['name'], r['size']): dict(flatten(r['metrics'])) for r in baseline['results']}
+    rows = []
+    for result in results:
+        previous = before.get((result['name'], result['size']), {})
+        for metric, value in flatten(result['metrics']):
+            old = previous.get(metric)
+            ratio = value / old if old else None
+            rows.append((result['name'], result['size'], metric, old, value, ratio))
+    return rows
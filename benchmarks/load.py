@@ -0,0 +1,144 @@
+"""End to end load on an in-process gRPC server running BifrostAPI.
+
+The server is set up like ``server.serve``, with the metrics interceptor,
+over the in-memory storage preloaded with `size` endpoints, or over the
+database named by BIFROST_BENCH_DATABASE_URI, which is emptied first as
+in :mod:`benchmarks.storage`. A pool of client threads then drives each
+RPC in turn and the throughput and latency percentiles are reported per
+RPC. A streaming call is timed until its last message is received.
+
+    python -m benchmarks.load --endpoints 10000 --concurrency 16 --requests 2000
+"""
+import argparse
+import contextlib
+import itertools
+import os
+import tempfile
+import time
+from concurrent import futures
+from typing import Callable, Dict
+
+import grpc
+from google.protobuf import empty_pb2
+
+from benchmarks.envelope import make_endpoints
+from benchmarks.harness import benchmark, latency_summary
+from benchmarks.storage import database_storage, memory_storage
+from bifrost.api import BifrostAPI
+from bifrost.const import Size
+from bifrost.metrics import MetricsInterceptor
+from bifrost.service import BifrostService, BifrostServiceFactory
+from bifrostv1 import bifrost_pb2_grpc
+from bifrostv1.bifrost_pb2 import ClientConfigRequest, CreateEndpointRequest, ListEndpointsRequest, ProxyClientBinaryInfoRequest, \
+    StreamProxyClientBinaryRequest
+
+
+CONCURRENCY = 8
+REQUESTS = 1000
+CLIENT_BINARY_SIZE = 4 * Size.MiB
+
+
+def _drain(responses):
+    for _ in responses:
+        pass
+
+
+def scenarios(stub) -> Dict[str, Callable[[], object]]:
+    batch = make_endpoints(100)
+    names = itertools.count()
+    return {
+        'GetProxyClientBinaryInfo': lambda: stub.GetProxyClientBinaryInfo(ProxyClientBinaryInfoRequest()),
+        'ClientConfig': lambda: stub.ClientConfig(ClientConfigRequest(subdomain='load')),
+        'ListEndpoints': lambda: stub.ListEndpoints(ListEndpointsRequest(page_size=100)),
+        'StreamEndpoints': lambda: _drain(stub.StreamEndpoints(empty_pb2.Empty())),
+        'StreamProxyClientBinary': lambda: _drain(stub.StreamProxyClientBinary(StreamProxyClientBinaryRequest())),
+        'CreateEndpoints': lambda: stub.CreateEndpoints(iter(batch)),
+        # Re-registers the same few endpoints, like retrying clients do
+        'CreateEndpoint': lambda: stub.CreateEndpoint(CreateEndpointRequest(
+            name=f'load-{next(names) % 100}', owner='load', url='http://127.0.0.1:5001')),
+    }
+
+
+@contextlib.contextmanager
+def running_server(endpoints: int):
+    """Start the API on a free local port and yield a stub connected to it"""
+    import server
+
+    uri = os.environ.get('BIFROST_BENCH_DATABASE_URI')
+    fresh_storage = database_storage(uri) if uri else memory_storage()
+    with tempfile.NamedTemporaryFile() as binary_file, fresh_storage as storage:
+        binary_file.write(os.urandom(CLIENT_BINARY_SIZE))
+        binary_file.flush()
+
+        config = server.load_config()
+        config = config._replace(client_binary=config.client_binary._replace(PATH=binary_file.name))
+        storage.put_many(make_endpoints(endpoints))
+        # Docker is only used by the proxy RPCs, which are not driven here
+        service = BifrostService(config, storage, docker=None,
+                                 client_binary=BifrostServiceFactory.load_client_binary(config))
+
+        grpc_server = grpc.server(futures.ThreadPoolExecutor(max_workers=10),
+                                  interceptors=[MetricsInterceptor()])
+        bifrost_pb2_grpc.add_BifrostServicer_to_server(BifrostAPI(service=service), grpc_server)
+        port = grpc_server.add_insecure_port('127.0.0.1:0')
+        grpc_server.start()
+        try:
+            with grpc.insecure_channel(f'127.0.0.1:{port}') as channel:
+                yield bifrost_pb2_grpc.BifrostStub(channel)
+        finally:
+            grpc_server.stop(0)
+
+
+def drive(call: Callable[[], object], concurrency: int, requests: int) -> dict:
+    """Issue `requests` calls from `concurrency` threads and summarize them"""
+    def worker(count):
+        latencies = []
+        for _ in range(count):
+            started = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    share, extra = divmod(requests, concurrency)
+    counts = [share + (1 if i < extra else 0) for i in range(concurrency)]
+    started = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = [l for result in pool.map(worker, counts) for l in result]
+    elapsed = time.perf_counter() - started
+    return dict(requests_per_second=len(latencies) / elapsed, **latency_summary(latencies))
+
+
+def run(endpoints: int, concurrency=CONCURRENCY, requests=REQUESTS) -> dict:
+    with running_server(endpoints) as stub:
+        results = {}
+        for name, call in scenarios(stub).items():
+            # Warm up connections, caches and the lazily loaded client binary
+            drive(call, concurrency, concurrency)
+            # Streams of the whole table or binary are far heavier than a
+            # unary call, so issue fewer of them
+            count = requests if not name.startswith('Stream') else max(concurrency, requests // 10)
+            results[name] = drive(call, concurrency, count)
+        return results
+
+
+@benchmark('load', sizes=(1000, 10000))
+def load_suite(size):
+    return run(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--endpoints', type=int, default=1000, help='endpoints stored before the run')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='client threads')
+    parser.add_argument('--requests', type=int, default=REQUESTS, help='unary requests per RPC')
+    args = parser.parse_args()
+
+    results = run(args.endpoints, args.concurrency, args.requests)
+    print(f'{"rpc":<26} {"req/s":>10} {"p50 ms":>9} {"p99 ms":>9}')
+    for name, result in results.items():
+        print(f'{name:<26} {result["requests_per_second"]:>10.1f} '
+              f'{result["p50_seconds"] * 1000:>9.2f} {result["p99_seconds"] * 1000:>9.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Client binary streaming: chunking the mapped file and serializing the
+parts the server sends, for several binary and chunk sizes. The size is
+the binary size in MiB."""
+import os
+import tempfile
+
+from benchmarks.harness import benchmark, best_of
+from bifrost.artifact import ClientBinary
+from bifrost.const import Size
+from bifrostv1.bifrost_pb2 import ProxyClientBinaryPart
+
+
+CHUNK_SIZES = (64 * Size.KiB, 256 * Size.KiB, 1 * Size.MiB)
+
+
+def _serialize_parts(binary, chunk_size):
+    offset = 0
+    for chunk in binary.iter_chunks(0, chunk_size):
+        ProxyClientBinaryPart(chunk=chunk, offset=offset).SerializeToString()
+        offset += len(chunk)
+
+
+@benchmark('streaming.client_binary', sizes=(4, 16))
+def client_binary_suite(size):
+    total = size * Size.MiB
+    with tempfile.NamedTemporaryFile() as binary_file:
+        binary_file.write(os.urandom(total))
+        binary_file.flush()
+
+        binary = ClientBinary(binary_file.name)
+        try:
+            results = dict(open_and_hash=best_of(lambda: ClientBinary(binary_file.name).close(), 1))
+            for chunk_size in CHUNK_SIZES:
+                chunks = -(-total // chunk_size)
+                results[f'chunk_{chunk_size // Size.KiB}k'] = dict(
+                    iter_chunks=best_of(lambda: sum(1 for _ in binary.iter_chunks(0, chunk_size)), chunks),
+                    serialize=best_of(lambda: _serialize_parts(binary, chunk_size), chunks))
+        finally:
+            binary.close()
+    return results
@@ -0,0 +1,150 @@
+from typing import AsyncIterator
+
+import grpc
+from google.protobuf import empty_pb2
+
+from bifrost.aioservice import AsyncBifrostService
+from bifrost.artifact import ArtifactNotFoundError, InvalidRangeError
+from bifrost.changefeed import ChangeFeedLaggedError, TooManySubscriptionsError
+from bifrost.clientconfig import InvalidSubdomainError
+from bifrost.dockerops import DockerUnavailableError
+from bifrost.proxypool import ProxyNotFoundError, ProxyPoolDisabledError, ProxyPoolExhaustedError
+from bifrost.service import InvalidEndpointError, InvalidPageTokenError, endpoint_from_request
+from bifrostv1 import bifrost_pb2_grpc
+from bifrostv1.bifrost_pb2 import CreateEndpointRequest, CreateEndpointResponse, CreateEndpointsResponse, \
+    ListEndpointsRequest, ListEndpointsResponse, StreamProxyClientBinaryRequest, ProxyClientBinaryPart, \
+    ProxyClientBinaryInfoRequest, ProxyClientBinaryInfo, ClientConfigRequest, ClientConfigResponse, Endpoint, \
+    WatchEndpointsRequest, EndpointEvent, StartProxyRequest, StartProxyResponse, StopProxyRequest, \
+    StopProxyResponse, Proxy
+
+
+class AsyncBifrostAPI(bifrost_pb2_grpc.BifrostServicer):
+    """:class:`bifrost.api.BifrostAPI` for a ``grpc.aio`` server, where every
+    RPC is a coroutine or async generator on a single event loop."""
+
+    def __init__(self, *args, service: AsyncBifrostService, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._service = service
+
+    async def CreateEndpoint(self, request: CreateEndpointRequest,
+                             context: grpc.aio.ServicerContext) -> CreateEndpointResponse:
+        try:
+            endpoint = await self._service.create_endpoint(endpoint_from_request(request))
+        except InvalidEndpointError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        return CreateEndpointResponse(endpoint=endpoint)
+
+    async def CreateEndpoints(self, request_iterator: AsyncIterator[Endpoint],
+                              context: grpc.aio.ServicerContext) -> CreateEndpointsResponse:
+        try:
+            created = await self._service.create_endpoints(request_iterator)
+        except InvalidEndpointError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        return CreateEndpointsResponse(created=created)
+
+    async def ListEndpoints(self, request: ListEndpointsRequest,
+                            context: grpc.aio.ServicerContext) -> ListEndpointsResponse:
+        try:
+            endpoints, next_page_token = await self._service.list_endpoints(
+                request.page_size, request.page_token)
+        except InvalidPageTokenError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+        response = ListEndpointsResponse(next_page_token=next_page_token)
+        response.endpoints.extend(endpoints)
+        return response
+
+    async def StreamEndpoints(self, request: empty_pb2.Empty,
+                              context: grpc.aio.ServicerContext) -> AsyncIterator[Endpoint]:
+
+        async for endpoint in self._service.iter_endpoints():
+            yield endpoint
+
+    async def WatchEndpoints(self, request: WatchEndpointsRequest,
+                             context: grpc.aio.ServicerContext) -> AsyncIterator[EndpointEvent]:
+        try:
+            watch = self._service.watch_endpoints(request.since_revision)
+        except TooManySubscriptionsError as e:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+
+        # A client going away cancels this generator, which closes the watch
+        try:
+            async for event in watch:
+                yield EndpointEvent(type=EndpointEvent.Type.Value(event.type.value),
+                                    endpoint=event.message,
+                                    revision=event.revision,
+                                    key=event.key)
+        except ChangeFeedLaggedError as e:
+            await context.abort(grpc.StatusCode.ABORTED, f'{e}, resume from revision {watch.revision}')
+
+    async def StartProxy(self, request: StartProxyRequest,
+                         context: grpc.aio.ServicerContext) -> StartProxyResponse:
+        try:
+            proxy = await self._service.start_proxy(request.user)
+        except ProxyPoolExhaustedError as e:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+        except ProxyPoolDisabledError as e:
+            await context.abort(grpc.StatusCode.FAILED_PRECONDITION, str(e))
+        except DockerUnavailableError as e:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, str(e))
+        return StartProxyResponse(uuid=proxy.uuid, proxy=proxy)
+
+    async def StopProxy(self, request: StopProxyRequest,
+                        context: grpc.aio.ServicerContext) -> StopProxyResponse:
+        try:
+            await self._service.stop_proxy(request.uuid)
+        except ProxyNotFoundError as e:
+            await context.abort(grpc.StatusCode.NOT_FOUND, str(e))
+        except ProxyPoolDisabledError as e:
+            await context.abort(grpc.StatusCode.FAILED_PRECONDITION, str(e))
+        except DockerUnavailableError as e:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, str(e))
+        return StopProxyResponse()
+
+    async def StreamProxies(self, request: empty_pb2.Empty,
+                            context: grpc.aio.ServicerContext) -> AsyncIterator[Proxy]:
+
+        async for proxy in self._service.iter_proxies():
+            yield proxy
+
+    async def StreamProxyClientBinary(self, request: StreamProxyClientBinaryRequest,
+                                      context: grpc.aio.ServicerContext) -> AsyncIterator[ProxyClientBinaryPart]:
+
+        try:
+            binary = await self._service.client_binary()
+            encoding = binary.choose_encoding(request.accept_encoding)
+            chunks = await self._service.iter_client_binary(request.offset, encoding)
+        except ArtifactNotFoundError as e:
+            await context.abort(grpc.StatusCode.NOT_FOUND, str(e))
+        except InvalidRangeError as e:
+            await context.abort(grpc.StatusCode.OUT_OF_RANGE, str(e))
+
+        offset = request.offset
+        header = dict(sha256=binary.sha256, total_size=binary.size,
+                      encoding=encoding, encoded_size=binary.encoded_size(encoding))
+        for chunk in chunks:
+            # Each yield waits for the client to accept the part, so a slow
+            # download applies back pressure without holding a thread.
+            yield ProxyClientBinaryPart(chunk=chunk, offset=offset, **header)
+            offset += len(chunk)
+            header = {}
+
+        if header:
+            yield ProxyClientBinaryPart(offset=offset, **header)
+
+    async def GetProxyClientBinaryInfo(self, request: ProxyClientBinaryInfoRequest,
+                                       context: grpc.aio.ServicerContext) -> ProxyClientBinaryInfo:
+        try:
+            binary = await self._service.client_binary()
+        except ArtifactNotFoundError as e:
+            await context.abort(grpc.StatusCode.NOT_FOUND, str(e))
+        return ProxyClientBinaryInfo(sha256=binary.sha256, total_size=binary.size)
+
+    async def ClientConfig(self, request: ClientConfigRequest,
+                           context: grpc.aio.ServicerContext) -> ClientConfigResponse:
+        try:
+            rendered = await self._service.client_config(request.subdomain)
+        except InvalidSubdomainError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        return ClientConfigResponse(config=rendered.config, server_addr=rendered.server_addr,
+                                    proxy_uri=rendered.proxy_uri)
@@ -0,0 +1,142 @@
+import asyncio
+from typing import AsyncIterable, AsyncIterator, Iterator, List, Tuple
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from thundersnow.precondition import check_state
+
+from bifrost.aiostorage import AsyncSessionFactory, AsyncStorage, abatched, async_database_uri
+from bifrost.artifact import IDENTITY, ArtifactNotFoundError, ClientBinary
+from bifrost.changefeed import AsyncWatch, ChangeHub
+from bifrost.clientconfig import ClientConfigSource, RenderedClientConfig
+from bifrost.dockerops import ContainerIndex, DockerExecutor
+from bifrost.metrics import REGISTRY
+from bifrost.proxypool import ProxyPool, ProxyPoolDisabledError
+from bifrost.service import MAX_PAGE_SIZE, BifrostServiceFactory, count_bytes_saved, decode_page_token, \
+    encode_page_token, endpoint_key, with_container_status
+from bifrost.singleflight import AsyncSingleFlight
+from bifrost.storage import EnvelopeFormat
+from bifrostv1.bifrost_pb2 import Endpoint, Proxy
+
+
+__all__ = (
+    'AsyncBifrostService',
+    'AsyncBifrostServiceFactory',
+)
+
+
+class AsyncBifrostService(object):
+    """asyncio counterpart of :class:`bifrost.service.BifrostService`. Nothing
+    here blocks the event loop: database access goes through the async
+    engine and file reads run on the loop's default executor."""
+
+    def __init__(self, config, storage: AsyncStorage, client_binary: ClientBinary=None,
+                 changes: ChangeHub=None, docker: DockerExecutor=None, proxies: ProxyPool=None,
+                 containers: ContainerIndex=None):
+        self.config = config
+        self.storage = storage
+        self.changes = changes
+        self.docker = docker
+        self.proxies = proxies
+        self.containers = containers
+        self.flight = AsyncSingleFlight()
+        self.client_configs = ClientConfigSource(config.client_config.PATH,
+                                                 template_path=config.client_config.TEMPLATE_PATH,
+                                                 http_port=config.client_config.HTTP_PORT,
+                                                 check_interval=config.client_config.CHECK_INTERVAL_SECONDS)
+        self._client_binary = client_binary
+
+    async def create_endpoint(self, endpoint: Endpoint) -> Endpoint:
+        revision = await self.storage.upsert(endpoint, endpoint_key(endpoint.owner, endpoint.name))
+        return revision.message
+
+    async def create_endpoints(self, endpoints: AsyncIterable[Endpoint]) -> int:
+        created = 0
+        async for batch in abatched(endpoints, self.storage.batch_size):
+            created += len(await self.storage.upsert_many([(e, endpoint_key(e.owner, e.name)) for e in batch]))
+        return created
+
+    async def list_endpoints(self, page_size=0, page_token='') -> Tuple[List[Endpoint], str]:
+        page_size = min(page_size or self.storage.page_size, MAX_PAGE_SIZE)
+        after_key = decode_page_token(page_token)
+        page = await self.flight.do(('list_endpoints', after_key, page_size),
+                                    lambda: self.storage.page(Endpoint, after_key, page_size))
+        return page.messages, encode_page_token(page.next_key)
+
+    def iter_endpoints(self) -> AsyncIterator[Endpoint]:
+        return self.storage.iter(Endpoint)
+
+    def watch_endpoints(self, since_revision=0) -> AsyncWatch:
+        check_state(self.changes is not None, 'the change feed is not enabled')
+        return AsyncWatch(self.storage, self.changes, Endpoint, since_revision)
+
+    def _proxy_pool(self) -> ProxyPool:
+        if self.proxies is None:
+            raise ProxyPoolDisabledError('the proxy pool is not enabled')
+        return self.proxies
+
+    async def start_proxy(self, user) -> Proxy:
+        # The pool is synchronous and waits on Docker
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._proxy_pool().acquire, user)
+
+    async def stop_proxy(self, uuid) -> Proxy:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._proxy_pool().release, uuid)
+
+    async def iter_proxies(self) -> AsyncIterator[Proxy]:
+        async for proxy in self.storage.iter(Proxy):
+            yield with_container_status(proxy, self.containers)
+
+    def close(self):
+        if self.proxies is not None:
+            self.proxies.stop()
+        if self.containers is not None:
+            self.containers.stop()
+        if self.docker is not None:
+            self.docker.shutdown()
+
+    async def client_binary(self) -> ClientBinary:
+        if self._client_binary is None:
+            raise ArtifactNotFoundError(f'there is no client binary at {self.config.client_binary.PATH}')
+        return self._client_binary
+
+    async def iter_client_binary(self, offset=0, encoding=IDENTITY) -> Iterator[bytes]:
+        """Chunks are slices of the memory mapped binary, so iterating them
+        never waits on a file read."""
+        binary = await self.client_binary()
+        chunks = binary.iter_chunks(offset, self.config.client_binary.CHUNK_SIZE, encoding)
+        return count_bytes_saved(binary, encoding, chunks)
+
+    async def client_config(self, subdomain='') -> RenderedClientConfig:
+        if self.client_configs.refresh_due():
+            # Checking the file for changes is the only part that waits on disk
+            loop = asyncio.get_running_loop()
+            await self.flight.do('client_config', lambda: loop.run_in_executor(None, self.client_configs.refresh))
+        return self.client_configs.render(subdomain)
+
+
+class AsyncBifrostServiceFactory(object):
+
+    def __init__(self):
+        pass
+
+    def create(config):
+        changes = ChangeHub(max_pending=config.changefeed.MAX_PENDING,
+                            max_subscriptions=config.changefeed.MAX_WATCHES)
+        engine = create_async_engine(async_database_uri(config.DATABASE_URI))
+        storage = AsyncStorage(AsyncSessionFactory(engine),
+                               page_size=config.storage.PAGE_SIZE,
+                               batch_size=config.storage.BATCH_SIZE,
+                               envelope_format=EnvelopeFormat(config.storage.ENVELOPE_FORMAT),
+                               changes=changes)
+        # The synchronous storage relays the NOTIFYs of postgres to the hub
+        # and is the one the proxy pool, which runs on threads, writes with
+        sync_storage = BifrostServiceFactory.create_storage(config, changes)
+        executor = containers = proxies = None
+        if config.proxy_pool.ENABLED:
+            executor, containers, proxies = BifrostServiceFactory.create_proxy_pool(config, sync_storage)
+        if config.metrics.ENABLED:
+            REGISTRY.gauge('bifrost_changefeed_subscribers', 'Open change feed subscriptions',
+                           callback=lambda: len(changes))
+        return AsyncBifrostService(config, storage, BifrostServiceFactory.load_client_binary(config),
+                                   changes, executor, proxies, containers)
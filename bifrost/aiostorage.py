@@ -0,0 +1,288 @@
+import asyncio
+import contextlib
+from typing import AsyncIterable, AsyncIterator, Iterable, List, Optional, Tuple
+
+import google.protobuf.message
+from google.protobuf.message import Message
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+from thundersnow.precondition import check_argument
+
+from bifrost.changefeed import ChangeHub, ChangeType, Tombstone
+from bifrost.id import prefix_for
+from bifrost.model import KeyValue
+from bifrost.storage import BEGIN_IMMEDIATE, DEFAULT_BATCH_SIZE, DEFAULT_PAGE_SIZE, LATEST_REVISION_QUERY, \
+    REVISION_LOCK_STATEMENT, EnvelopeFormat, Page, Revision, Write, changed_query, count_query, \
+    delete_statement, entry_lock_query, entry_query, keys_query, new_entry, next_key_for, page_query, \
+    revision_for, rows_for, tombstone_query, unpack_entry, upsert_rows, upserted
+
+
+__all__ = (
+    'ASYNC_DRIVERS',
+    'async_database_uri',
+    'AsyncSessionFactory',
+    'AsyncStorage',
+    'abatched',
+)
+
+
+# The asyncio driver used for each database backend
+ASYNC_DRIVERS = {
+    'postgresql': 'asyncpg',
+    'sqlite': 'aiosqlite',
+    'mysql': 'aiomysql',
+}
+
+
+def async_database_uri(uri: str) -> str:
+    """`uri` with its driver replaced by the asyncio one of its backend,
+    e.g. postgresql+asyncpg for postgresql+psycopg2"""
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    check_argument(backend in ASYNC_DRIVERS, 'no asyncio driver for {} databases', backend)
+    return str(url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}'))
+
+
+class AsyncSessionFactory(object):
+    def __init__(self, engine):
+        self._engine = engine
+
+        self._sessionmaker = sessionmaker(
+            bind=self._engine,
+            class_=AsyncSession,
+            # prevents SQLAlchemy from lazy loading (i.e. blocking) on
+            # attribute access after a commit
+            expire_on_commit=False)
+
+    def create_session(self) -> AsyncSession:
+        return self._sessionmaker()
+
+    @contextlib.asynccontextmanager
+    async def create_context(self, session=None):
+        should_close = False
+        if session is None:
+            should_close = True
+            session = self.create_session()
+
+        try:
+            yield session
+        finally:
+            if should_close:
+                await session.close()
+
+
+async def abatched(iterable: AsyncIterable, size: int) -> AsyncIterator[list]:
+    """Split the async `iterable` into lists of at most `size` items"""
+    batch = []
+    async for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class AsyncWrite(Write):
+    """:class:`bifrost.storage.Write` for an async session: the statements
+    are the same, only executing them is awaited"""
+
+    async def revisions(self, count: int) -> List[int]:
+        if self._counts_on_latest():
+            self._count_on(*(await self.session.execute(LATEST_REVISION_QUERY)).one())
+        return self._hand_out(count)
+
+    async def begin_immediate(self):
+        await self.session.execute(BEGIN_IMMEDIATE)
+
+    async def assign_revisions(self):
+        if not self.changes:
+            return
+        await self.session.flush()
+        await self.session.execute(REVISION_LOCK_STATEMENT)
+        assigned = [await self.session.execute(statement) for statement in self._revision_updates()]
+        draw = self._draw_query()
+        drawn = (await self.session.execute(draw)).scalars().all() if draw is not None else ()
+        self._apply_revisions(assigned, drawn)
+
+    async def record_deletes(self):
+        for statement in self._tombstone_inserts():
+            await self.session.execute(statement)
+
+    async def notify(self):
+        for statement in self._notifications():
+            await self.session.execute(statement)
+
+
+class AsyncStorage(object):
+    """asyncio counterpart of :class:`bifrost.storage.Storage` on SQLAlchemy's
+    async engine. Rows, keys, envelopes, revisions and change notifications
+    are produced exactly as the synchronous storage produces them so both
+    can share one database."""
+
+    def __init__(self, session_factory, page_size=DEFAULT_PAGE_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE, envelope_format=EnvelopeFormat.json,
+                 changes: ChangeHub=None):
+        # type: (AsyncSessionFactory, int, int, EnvelopeFormat, ChangeHub) -> None
+        self.session_factory = session_factory
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.envelope_format = envelope_format
+        self.changes = changes
+        self._write_lock = asyncio.Lock()
+        self._last_revision = 0
+
+    @contextlib.asynccontextmanager
+    async def _write(self, existing_session: AsyncSession=None) -> AsyncIterator[AsyncWrite]:
+        async with self.session_factory.create_context(existing_session) as session:
+            dialect = session.bind.dialect
+            postgres = dialect.name == 'postgresql'
+            async with contextlib.nullcontext() if postgres else self._write_lock:
+                write = AsyncWrite(session, dialect, self._last_revision)
+                async with session.begin():
+                    if not postgres:
+                        await write.begin_immediate()
+                    yield write
+                    if postgres:
+                        await write.assign_revisions()
+                    await write.record_deletes()
+                    if postgres:
+                        await write.notify()
+                if not postgres:
+                    self._last_revision = write.last_revision
+                    if self.changes is not None:
+                        self.changes.publish(write.changes)
+
+    async def put(self, message: google.protobuf.message.Message, key: str=None,
+                  existing_session: AsyncSession=None) -> KeyValue:
+        entry = new_entry(message, key, self.envelope_format)
+        async with self._write(existing_session) as write:
+            write.add(entry, *await write.revisions(1))
+
+        set_committed_value(entry, 'revision', write.revision_of(entry.key, entry.resource_type))
+        return entry
+
+    async def put_many(self, messages: List[google.protobuf.message.Message],
+                       existing_session: AsyncSession=None) -> List[str]:
+        rows = rows_for(list(messages), self.envelope_format)
+        if not rows:
+            return []
+
+        async with self._write(existing_session) as write:
+            for statement in write.inserts(rows, await write.revisions(len(rows)), self.batch_size):
+                await write.session.execute(statement)
+
+        return [row['key'] for row in rows]
+
+    async def upsert(self, message: google.protobuf.message.Message, key: str,
+                     existing_session: AsyncSession=None) -> Revision:
+        revision, = await self.upsert_many([(message, key)], existing_session)
+        return revision
+
+    async def upsert_many(self, items: Iterable[Tuple[google.protobuf.message.Message, str]],
+                          existing_session: AsyncSession=None) -> List[Revision]:
+        items = list(items)
+        if not items:
+            return []
+        rows = upsert_rows(items, self.envelope_format)
+
+        entries = {}
+        async with self._write(existing_session) as write:
+            for statement in write.upserts(rows, await write.revisions(len(rows)), self.batch_size):
+                result = await write.session.execute(statement)
+                if result.returns_rows:
+                    entries.update((entry.key, entry) for entry in result)
+            for query in write.upserted_queries(rows):
+                entries.update((entry.key, entry) for entry in await write.session.execute(query))
+            write.record_upserts(rows, entries)
+
+        return upserted(write, items, entries)
+
+    async def delete(self, key: str, Message, existing_session: AsyncSession=None) -> bool:
+        resource_type = prefix_for(Message)
+        async with self._write(existing_session) as write:
+            if (await write.session.execute(entry_lock_query(key, resource_type))).first() is None:
+                return False
+            revision, = await write.revisions(1)
+            await write.session.execute(delete_statement(key, resource_type))
+            write.changed(ChangeType.deleted, key, resource_type, revision)
+        return True
+
+    async def get(self, key: str, Message, existing_session: AsyncSession=None) -> Optional[Message]:
+
+        async with self.session_factory.create_context(existing_session) as session:
+            entry = (await session.execute(entry_query(key, Message))).first()
+
+        if entry is None:
+            return None
+
+        return unpack_entry(Message, entry)
+
+    async def page(self, Message, after_key: str=None, page_size: int=None, owner: str=None,
+                   existing_session: AsyncSession=None) -> Page:
+        page_size = page_size or self.page_size
+        check_argument(page_size > 0, 'page_size must be positive, got {}', page_size)
+
+        async with self.session_factory.create_context(existing_session) as session:
+            entries = (await session.execute(page_query(Message, after_key, page_size, owner))).all()
+
+        messages = [unpack_entry(Message, e) for e in entries]
+        return Page(messages, next_key_for(entries, page_size))
+
+    async def iter(self, Message, page_size: int=None, owner: str=None,
+                   existing_session: AsyncSession=None) -> AsyncIterator[Message]:
+        async with self.session_factory.create_context(existing_session) as session:
+            after_key = None
+            while True:
+                page = await self.page(Message, after_key, page_size, owner, existing_session=session)
+                for message in page.messages:
+                    yield message
+                if page.next_key is None:
+                    break
+                after_key = page.next_key
+
+    async def all(self, Message, owner: str=None, existing_session: AsyncSession=None) -> List[Message]:
+        return [m async for m in self.iter(Message, owner=owner, existing_session=existing_session)]
+
+    async def keys(self, Message, page_size: int=None, owner: str=None,
+                   existing_session: AsyncSession=None) -> AsyncIterator[str]:
+        page_size = page_size or self.page_size
+        async with self.session_factory.create_context(existing_session) as session:
+            after_key = None
+            while True:
+                keys = (await session.execute(keys_query(Message, after_key, page_size, owner))).scalars().all()
+                for key in keys:
+                    yield key
+                if len(keys) < page_size:
+                    break
+                after_key = keys[-1]
+
+    async def changed_since(self, Message, after_revision: int=0, page_size: int=None, owner: str=None,
+                            existing_session: AsyncSession=None) -> AsyncIterator[Revision]:
+        page_size = page_size or self.page_size
+        async with self.session_factory.create_context(existing_session) as session:
+            while True:
+                entries = (await session.execute(changed_query(Message, after_revision, page_size, owner))).all()
+                for entry in entries:
+                    yield revision_for(Message, entry)
+                if len(entries) < page_size:
+                    break
+                after_revision = entries[-1].revision
+
+    async def deleted_since(self, Message, after_revision: int=0, page_size: int=None,
+                            existing_session: AsyncSession=None) -> AsyncIterator[Tombstone]:
+        page_size = page_size or self.page_size
+        async with self.session_factory.create_context(existing_session) as session:
+            while True:
+                tombstones = (await session.execute(tombstone_query(Message, after_revision, page_size))).all()
+                for key, revision in tombstones:
+                    yield Tombstone(key, revision)
+                if len(tombstones) < page_size:
+                    break
+                after_revision = tombstones[-1].revision
+
+    async def count(self, Message, owner: str=None, existing_session: AsyncSession=None) -> int:
+        async with self.session_factory.create_context(existing_session) as session:
+            return (await session.execute(count_query(Message, owner))).scalar()
@@ -1,11 +1,19 @@
-from typing import Generator
+from typing import Generator, Iterator
 import grpc
 from google.protobuf import empty_pb2
 
-from bifrost.service import BifrostService
+from bifrost.artifact import ArtifactNotFoundError, InvalidRangeError
+from bifrost.changefeed import ChangeFeedLaggedError, TooManySubscriptionsError
+from bifrost.clientconfig import InvalidSubdomainError
+from bifrost.dockerops import DockerUnavailableError
+from bifrost.proxypool import ProxyNotFoundError, ProxyPoolDisabledError, ProxyPoolExhaustedError
+from bifrost.service import BifrostService, InvalidEndpointError, InvalidPageTokenError, endpoint_from_request
 from bifrostv1 import bifrost_pb2_grpc
-from bifrostv1.bifrost_pb2 import CreateEndpointRequest, CreateEndpointResponse, ListEndpointsResponse, \
-    StreamProxyClientBinaryRequest, ProxyClientBinaryPart, ClientConfigResponse
+from bifrostv1.bifrost_pb2 import CreateEndpointRequest, CreateEndpointResponse, CreateEndpointsResponse, \
+    ListEndpointsRequest, ListEndpointsResponse, StreamProxyClientBinaryRequest, ProxyClientBinaryPart, \
+    ProxyClientBinaryInfoRequest, ProxyClientBinaryInfo, ClientConfigRequest, ClientConfigResponse, Endpoint, \
+    WatchEndpointsRequest, EndpointEvent, StartProxyRequest, StartProxyResponse, StopProxyRequest, \
+    StopProxyResponse, Proxy
 
 
 class BifrostAPI(bifrost_pb2_grpc.BifrostServicer):
@@ -16,24 +24,123 @@ class BifrostAPI(bifrost_pb2_grpc.BifrostServicer):
 
     def CreateEndpoint(self, request: CreateEndpointRequest,
                        context: grpc.RpcContext) -> CreateEndpointResponse:
-        details = self._service.create_endpoint(request.endpoint)
-        return CreateEndpointResponse(details=details)
+        try:
+            endpoint = self._service.create_endpoint(endpoint_from_request(request))
+        except InvalidEndpointError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        return CreateEndpointResponse(endpoint=endpoint)
 
-    def ListEndpoints(self, request: empty_pb2.Empty,
-                      context: grpc.RpcContext) ->  Generator[ListEndpointsResponse, None, None]:
+    def CreateEndpoints(self, request_iterator: Iterator[Endpoint],
+                        context: grpc.RpcContext) -> CreateEndpointsResponse:
+        try:
+            created = self._service.create_endpoints(request_iterator)
+        except InvalidEndpointError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        return CreateEndpointsResponse(created=created)
 
-        for endpoint in self._service.list_endpoints():
+    def ListEndpoints(self, request: ListEndpointsRequest,
+                      context: grpc.RpcContext) -> ListEndpointsResponse:
+        try:
+            endpoints, next_page_token = self._service.list_endpoints(
+                request.page_size, request.page_token)
+        except InvalidPageTokenError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+        response = ListEndpointsResponse(next_page_token=next_page_token)
+        response.endpoints.extend(endpoints)
+        return response
+
+    def StreamEndpoints(self, request: empty_pb2.Empty,
+                        context: grpc.RpcContext) -> Generator[Endpoint, None, None]:
+
+        for endpoint in self._service.iter_endpoints():
             yield endpoint
 
+    def WatchEndpoints(self, request: WatchEndpointsRequest,
+                       context: grpc.RpcContext) -> Iterator[EndpointEvent]:
+        try:
+            watch = self._service.watch_endpoints(request.since_revision)
+        except TooManySubscriptionsError as e:
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+
+        # Wakes the watch up to end it when the client goes away
+        context.add_callback(watch.close)
+        try:
+            for event in watch:
+                yield EndpointEvent(type=EndpointEvent.Type.Value(event.type.value),
+                                    endpoint=event.message,
+                                    revision=event.revision,
+                                    key=event.key)
+        except ChangeFeedLaggedError as e:
+            context.abort(grpc.StatusCode.ABORTED, f'{e}, resume from revision {watch.revision}')
+
+    def StartProxy(self, request: StartProxyRequest,
+                   context: grpc.RpcContext) -> StartProxyResponse:
+        try:
+            proxy = self._service.start_proxy(request.user)
+        except ProxyPoolExhaustedError as e:
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+        except ProxyPoolDisabledError as e:
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION, str(e))
+        except DockerUnavailableError as e:
+            context.abort(grpc.StatusCode.UNAVAILABLE, str(e))
+        return StartProxyResponse(uuid=proxy.uuid, proxy=proxy)
+
+    def StopProxy(self, request: StopProxyRequest,
+                  context: grpc.RpcContext) -> StopProxyResponse:
+        try:
+            self._service.stop_proxy(request.uuid)
+        except ProxyNotFoundError as e:
+            context.abort(grpc.StatusCode.NOT_FOUND, str(e))
+        except ProxyPoolDisabledError as e:
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION, str(e))
+        except DockerUnavailableError as e:
+            context.abort(grpc.StatusCode.UNAVAILABLE, str(e))
+        return StopProxyResponse()
+
+    def StreamProxies(self, request: empty_pb2.Empty,
+                      context: grpc.RpcContext) -> Generator[Proxy, None, None]:
+
+        for proxy in self._service.iter_proxies():
+            yield proxy
+
     def StreamProxyClientBinary(self, request: StreamProxyClientBinaryRequest,
                                 context: grpc.RpcContext) -> Generator[ProxyClientBinaryPart, None, None]:
 
-        for chunk in self._service.iter_client_binary():
-            response = ProxyClientBinaryPart()
-            response.chunk = chunk
-            yield response
+        try:
+            binary = self._service.client_binary()
+            encoding = binary.choose_encoding(request.accept_encoding)
+            chunks = self._service.iter_client_binary(request.offset, encoding)
+        except ArtifactNotFoundError as e:
+            context.abort(grpc.StatusCode.NOT_FOUND, str(e))
+        except InvalidRangeError as e:
+            context.abort(grpc.StatusCode.OUT_OF_RANGE, str(e))
 
-    def ClientConfig(self, request, context):
-        response = ClientConfigResponse()
-        response.config = self._service.client_config()
-        return response
+        offset = request.offset
+        header = dict(sha256=binary.sha256, total_size=binary.size,
+                      encoding=encoding, encoded_size=binary.encoded_size(encoding))
+        for chunk in chunks:
+            yield ProxyClientBinaryPart(chunk=chunk, offset=offset, **header)
+            offset += len(chunk)
+            header = {}
+
+        if header:
+            # Resuming at the very end still reports the digest and size
+            yield ProxyClientBinaryPart(offset=offset, **header)
+
+    def GetProxyClientBinaryInfo(self, request: ProxyClientBinaryInfoRequest,
+                                 context: grpc.RpcContext) -> ProxyClientBinaryInfo:
+        try:
+            binary = self._service.client_binary()
+        except ArtifactNotFoundError as e:
+            context.abort(grpc.StatusCode.NOT_FOUND, str(e))
+        return ProxyClientBinaryInfo(sha256=binary.sha256, total_size=binary.size)
+
+    def ClientConfig(self, request: ClientConfigRequest,
+                     context: grpc.RpcContext) -> ClientConfigResponse:
+        try:
+            rendered = self._service.client_config(request.subdomain)
+        except InvalidSubdomainError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        return ClientConfigResponse(config=rendered.config, server_addr=rendered.server_addr,
+                                    proxy_uri=rendered.proxy_uri)
@@ -0,0 +1,221 @@
+import gzip
+import hashlib
+import mmap
+import os
+import zlib
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence
+
+from thundersnow.precondition import check_argument
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from bifrost.const import Size
+from bifrost.error import BifrostError
+
+
+__all__ = (
+    'ArtifactError',
+    'ArtifactNotFoundError',
+    'InvalidRangeError',
+    'DigestMismatchError',
+    'UnsupportedEncodingError',
+    'IDENTITY',
+    'available_encodings',
+    'decoder_for',
+    'encoded_path',
+    'precompress',
+    'ClientBinary',
+)
+
+
+DEFAULT_CHUNK_SIZE = 1 * Size.MiB
+
+# Content codings as named by HTTP. Artifacts are compressed once, so
+# spend the time on the smallest output.
+IDENTITY = 'identity'
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+
+# File suffix of each encoding written by precompress
+SUFFIXES = dict(gzip='.gz', zstd='.zst')
+
+
+class ArtifactError(BifrostError):
+    pass
+
+
+class ArtifactNotFoundError(ArtifactError):
+    pass
+
+
+class InvalidRangeError(ArtifactError):
+    pass
+
+
+class DigestMismatchError(ArtifactError):
+    pass
+
+
+class UnsupportedEncodingError(ArtifactError):
+    pass
+
+
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def _encoders():
+    # zstd when the optional zstandard package is installed
+    encoders = dict(gzip=lambda data: gzip.compress(data, GZIP_LEVEL, mtime=0))
+    if zstandard is not None:
+        encoders.update(zstd=_zstd_compress)
+    return encoders
+
+
+def available_encodings() -> Sequence[str]:
+    """The encodings this process can produce and decode, best first"""
+    return tuple(sorted(_encoders(), key=('zstd', 'gzip').index))
+
+
+def _map(path: Path):
+    """The contents of the file at `path`, mapped into memory"""
+    with path.open('rb') as infile:
+        if path.stat().st_size == 0:
+            # mmap refuses empty files
+            return b''
+        return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _sha256(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def encoded_path(path, sha256: str, encoding: str) -> Path:
+    """Where :func:`precompress` writes the `encoding` form of the file at
+    `path` whose contents hash to `sha256`. Naming it after the digest
+    keeps a form of an older file from ever being served for a newer one."""
+    path = Path(path)
+    return path.with_name(f'{path.name}.{sha256[:16]}{SUFFIXES[encoding]}')
+
+
+def precompress(path, encodings: Sequence[str]=('zstd', 'gzip')) -> List[Path]:
+    """Write the forms of the file at `path` in each of `encodings` this
+    process supports next to it, for :class:`ClientBinary` to map instead
+    of compressing the file itself. Run it when building the image or once
+    before starting the server. Forms that exist are kept, those of other
+    versions of the file removed, and forms no smaller than the file not
+    written. Returns the files written."""
+    path = Path(path)
+    data = path.read_bytes()
+    sha256 = _sha256(data)
+    encoders = _encoders()
+    written = []
+    for encoding in encodings:
+        if encoding not in encoders:
+            continue
+        target = encoded_path(path, sha256, encoding)
+        for stale in path.parent.glob(f'{path.name}.{"[0-9a-f]" * 16}{SUFFIXES[encoding]}'):
+            if stale != target:
+                stale.unlink()
+        if target.exists():
+            continue
+        encoded = encoders[encoding](data)
+        if len(encoded) >= len(data):
+            continue
+        # Renamed into place, so a server starting meanwhile never maps
+        # half of it
+        partial = target.with_name(target.name + '.partial')
+        partial.write_bytes(encoded)
+        os.replace(partial, target)
+        written.append(target)
+    return written
+
+
+class _IdentityDecoder(object):
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b''
+
+
+def decoder_for(encoding: str):
+    """An incremental decoder with ``decompress(data)`` and ``flush()``"""
+    if encoding in ('', IDENTITY):
+        return _IdentityDecoder()
+    if encoding == 'gzip':
+        return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise UnsupportedEncodingError(f'cannot decode {encoding!r}')
+
+
+class ClientBinary(object):
+    """A file served to clients. It is mapped into memory and hashed once
+    when loaded so every download shares the same pages rather than
+    reopening and re-reading the file.
+
+    It is also served in each of `encodings` this process supports, for
+    clients that accept them. The forms written by :func:`precompress` are
+    mapped as well; the others are compressed here, once, and those
+    smaller than the file kept in memory. The digest and size are always
+    those of the uncompressed file.
+    """
+
+    def __init__(self, path, encodings: Sequence[str]=('zstd', 'gzip')):
+        self.path = Path(path)
+        self._data = _map(self.path)
+        self.size = len(self._data)
+        self.sha256 = _sha256(self._data)
+
+        self._encoded = {IDENTITY: self._data}  # type: Dict[str, bytes]
+        encoders = _encoders()
+        for encoding in encodings:
+            if encoding not in encoders:
+                continue
+            precompressed = encoded_path(self.path, self.sha256, encoding)
+            if precompressed.exists():
+                self._encoded[encoding] = _map(precompressed)
+                continue
+            encoded = encoders[encoding](self._data)
+            if len(encoded) < self.size:
+                self._encoded[encoding] = encoded
+
+    @property
+    def encodings(self) -> Sequence[str]:
+        return tuple(self._encoded)
+
+    def choose_encoding(self, accepted: Sequence[str]) -> str:
+        """The first of the client's `accepted` encodings that is
+        available, else the file as is"""
+        return next((e for e in accepted if e in self._encoded), IDENTITY)
+
+    def encoded_size(self, encoding: str=IDENTITY) -> int:
+        return len(self._encoded[encoding])
+
+    def iter_chunks(self, offset=0, chunk_size=DEFAULT_CHUNK_SIZE, encoding=IDENTITY) -> Iterator[bytes]:
+        """Return an iterator over the `encoding` form of the contents from
+        `offset` onward, in pieces of at most `chunk_size` bytes. The offset
+        counts bytes of that form. The range is validated up front so
+        callers can report it before streaming anything."""
+        check_argument(chunk_size > 0, 'chunk_size must be positive, got {}', chunk_size)
+        data = self._encoded[encoding]
+        size = len(data)
+        if not 0 <= offset <= size:
+            raise InvalidRangeError(f'offset {offset} is outside of {self.path.name} ({size} {encoding} bytes)')
+
+        def chunks():
+            for start in range(offset, size, chunk_size):
+                yield data[start:start + chunk_size]
+
+        return chunks()
+
+    def close(self):
+        for data in self._encoded.values():
+            if isinstance(data, mmap.mmap):
+                data.close()
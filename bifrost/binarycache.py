@@ -0,0 +1,129 @@
+import fcntl
+import hashlib
+import os
+import stat
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Callable, IO, Optional
+
+from bifrost.artifact import DigestMismatchError
+
+
+__all__ = (
+    'BinaryCache',
+    'default_cache_dir',
+)
+
+
+# Suffix of the file recording the verified digest of a cached binary
+DIGEST_SUFFIX = '.sha256'
+
+READ_SIZE = 1 << 20
+
+
+def file_sha256(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def default_cache_dir() -> Path:
+    base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'bifrost' / 'proxy-client'
+
+
+class BinaryCache(object):
+    """Content addressed on-disk cache of proxy client binaries, shared by
+    every process of the same user.
+
+    Entries are stored under their SHA-256 digest and only ever appear by an
+    atomic rename of a fully written and verified file, so concurrent
+    readers never see a partial binary. The digest is checked once, before
+    the rename, and recorded next to the binary in ``sha256sum`` format; a
+    hit needs that record as well as the size. A per-directory lock keeps
+    parallel workers from downloading the same binary more than once.
+    """
+
+    def __init__(self, directory=None, filename='ngrok'):
+        self.directory = Path(directory) if directory is not None else default_cache_dir()
+        self.filename = filename
+
+    def path_for(self, sha256: str) -> Path:
+        return self.directory / sha256 / self.filename
+
+    def digest_path_for(self, sha256: str) -> Path:
+        return self.directory / sha256 / f'{self.filename}{DIGEST_SUFFIX}'
+
+    def lookup(self, sha256: str, size: int) -> Optional[Path]:
+        path = self.path_for(sha256)
+        try:
+            if path.stat().st_size != size:
+                return None
+        except FileNotFoundError:
+            return None
+        if self._recorded_digest(sha256) == sha256:
+            return path
+        # Cached before digests were recorded, or its record was lost
+        if file_sha256(path) == sha256:
+            self._record_digest(sha256)
+            return path
+        return None
+
+    def _recorded_digest(self, sha256: str) -> Optional[str]:
+        try:
+            return self.digest_path_for(sha256).read_text().split(maxsplit=1)[0]
+        except (FileNotFoundError, IndexError):
+            return None
+
+    def _record_digest(self, sha256: str):
+        digest_path = self.digest_path_for(sha256)
+        with NamedTemporaryFile('w', dir=str(digest_path.parent), prefix=f'.{digest_path.name}-',
+                                delete=False) as tmp:
+            tmp.write(f'{sha256}  {self.filename}\n')
+        os.replace(tmp.name, str(digest_path))
+
+    @contextmanager
+    def _locked(self, directory: Path):
+        with (directory / '.lock').open('a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def fetch(self, sha256: str, size: int, download: Callable[[IO[bytes]], None]) -> Path:
+        """Return the cached binary for `sha256`, calling `download` with a
+        writable file to populate the cache on a miss. What it wrote is
+        checked against `sha256` and `size` before it enters the cache,
+        raising DigestMismatchError if it does not match."""
+        path = self.lookup(sha256, size)
+        if path is not None:
+            return path
+
+        path = self.path_for(sha256)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._locked(path.parent):
+            # Another worker may have finished the download while we waited
+            if self.lookup(sha256, size) is not None:
+                return path
+
+            with NamedTemporaryFile(dir=str(path.parent), prefix=f'.{self.filename}-', delete=False) as tmp:
+                try:
+                    download(tmp)
+                    tmp.flush()
+                    os.fsync(tmp.fileno())
+                    written, digest = os.stat(tmp.name).st_size, file_sha256(tmp.name)
+                    if written != size or digest != sha256:
+                        raise DigestMismatchError(f'downloaded {written} bytes with sha256 {digest}, '
+                                                  f'expected {size} bytes with sha256 {sha256}')
+                    os.chmod(tmp.name, os.stat(tmp.name).st_mode | stat.S_IEXEC)
+                    os.replace(tmp.name, str(path))
+                except BaseException:
+                    os.unlink(tmp.name)
+                    raise
+            self._record_digest(sha256)
+
+        return path
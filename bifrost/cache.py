@@ -0,0 +1,235 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, NamedTuple, Optional, Tuple
+
+import google.protobuf.message
+from google.protobuf.message import Message
+from sqlalchemy.orm import Session
+from thundersnow.precondition import check_argument
+from thundersnow.type import sentinel
+
+from bifrost.changefeed import Change, ChangeHub
+from bifrost.id import prefix_for
+from bifrost.storage import Page, Revision, Storage
+
+
+__all__ = (
+    'CacheStats',
+    'LRUCache',
+    'CachedStorage',
+)
+
+
+Missing = sentinel('MISSING')
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    # Total weight of the entries
+    size: int
+
+
+class LRUCache(object):
+    """A thread safe LRU mapping whose entries also expire `ttl` seconds
+    after they were stored. The total weight of the entries, one each
+    unless :meth:`put` says otherwise, is kept at most `max_size`."""
+
+    def __init__(self, max_size=1024, ttl=5.0, clock=time.monotonic):
+        check_argument(max_size > 0, 'max_size must be positive, got {}', max_size)
+        check_argument(ttl > 0, 'ttl must be positive, got {}', ttl)
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, value, weight)
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: Hashable, default=Missing):
+        with self._lock:
+            item = self._entries.get(key, Missing)
+            if item is not Missing:
+                expires, value, _ = item
+                if expires > self._clock():
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return value
+                self._remove(key)
+            self._misses += 1
+            return default
+
+    def _remove(self, key):
+        item = self._entries.pop(key, Missing)
+        if item is not Missing:
+            self._size -= item[2]
+        return item
+
+    def put(self, key: Hashable, value, weight=1):
+        """Store `value` under `key`. A value weighing more than the whole
+        cache is not stored."""
+        with self._lock:
+            self._remove(key)
+            if weight > self.max_size:
+                return
+            self._entries[key] = (self._clock() + self.ttl, value, weight)
+            self._size += weight
+            while self._size > self.max_size:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._size -= evicted
+                self._evictions += 1
+
+    def pop(self, key: Hashable, default=None):
+        with self._lock:
+            item = self._remove(key)
+        return default if item is Missing else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions, self._size)
+
+
+def _copy(message: Message) -> Message:
+    copy = type(message)()
+    copy.CopyFrom(message)
+    return copy
+
+
+class CachedStorage(object):
+    """Read-through cache in front of :class:`Storage` holding already
+    unpacked messages, bounded by the number of messages held.
+
+    Single messages are cached by key and message type, and listing pages
+    per message type under a generation number that every write to that
+    type bumps, so a put invalidates all cached pages of its type at once
+    and the stale entries simply age out of the LRU. Iterating over
+    everything of a type reads straight from storage, so it neither floods
+    the cache nor is answered from it. Cached messages are copied on the
+    way out so callers may mutate them.
+
+    With `changes`, the change feed invalidates the entries written by
+    other processes, such as the other pre-forked workers, as their writes
+    commit; without it those writes are only seen once the affected
+    entries expire, so keep the ttl short.
+    """
+
+    def __init__(self, storage: Storage, cache: LRUCache, changes: ChangeHub=None):
+        self.storage = storage
+        self.cache = cache
+        self._generations = {}  # type: Dict[str, int]
+        # Bumped when changes may have been missed, invalidating every type
+        self._epoch = 0
+        # Keys invalidated, with the count of invalidations at the time, so
+        # that a read begun before a write is not cached after it. Reads
+        # begun before `_floor` are not cached, which lets the keys be
+        # forgotten once there are as many as the cache holds.
+        self._invalidations = 0
+        self._invalidated = {}  # type: Dict[str, int]
+        self._floor = 0
+        # Message types read with get, each of which may have cached a key
+        self._get_prefixes = set()
+        self._lock = threading.Lock()
+        if changes is not None:
+            changes.listen(self._changed, self._resync)
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def _generation(self, prefix):
+        with self._lock:
+            return self._epoch, self._generations.get(prefix, 0)
+
+    def _invalidate(self, prefixes: Iterable[str], keys: Iterable[str]=()):
+        with self._lock:
+            for prefix in set(prefixes):
+                self._generations[prefix] = self._generations.get(prefix, 0) + 1
+            for key in keys:
+                self._invalidations += 1
+                self._invalidated[key] = self._invalidations
+                for get_prefix in self._get_prefixes:
+                    self.cache.pop(('get', get_prefix, key))
+            if len(self._invalidated) > self.cache.max_size:
+                self._invalidated.clear()
+                self._floor = self._invalidations
+
+    def _changed(self, changes: List[Change]):
+        self._invalidate([c.resource_type for c in changes], [c.key for c in changes])
+
+    def _resync(self):
+        # Changes were missed while the feed was down
+        with self._lock:
+            self._epoch += 1
+            self._floor = self._invalidations = self._invalidations + 1
+            self._invalidated.clear()
+            self.cache.clear()
+
+    def stats(self) -> CacheStats:
+        return self.cache.stats()
+
+    def put(self, message: google.protobuf.message.Message, key: str=None, existing_session: Session=None):
+        entry = self.storage.put(message, key=key, existing_session=existing_session)
+        self._invalidate([prefix_for(message)], [entry.key])
+        return entry
+
+    def upsert(self, message: google.protobuf.message.Message, key: str, existing_session: Session=None):
+        revision = self.storage.upsert(message, key, existing_session=existing_session)
+        self._invalidate([prefix_for(message)], [key])
+        return revision
+
+    def delete(self, key: str, Message, existing_session: Session=None) -> bool:
+        deleted = self.storage.delete(key, Message, existing_session=existing_session)
+        self._invalidate([prefix_for(Message)], [key])
+        return deleted
+
+    def put_many(self, messages: Iterable[google.protobuf.message.Message],
+                 existing_session: Session=None) -> List[str]:
+        messages = list(messages)
+        keys = self.storage.put_many(messages, existing_session=existing_session)
+        self._invalidate((prefix_for(m) for m in messages), keys)
+        return keys
+
+    def upsert_many(self, items: Iterable[Tuple[google.protobuf.message.Message, str]],
+                    existing_session: Session=None) -> List[Revision]:
+        items = list(items)
+        revisions = self.storage.upsert_many(items, existing_session=existing_session)
+        self._invalidate((prefix_for(m) for m, _ in items), (key for _, key in items))
+        return revisions
+
+    def get(self, key: str, Message, existing_session: Session=None) -> Optional[Message]:
+        prefix = prefix_for(Message)
+        cache_key = ('get', prefix, key)
+        message = self.cache.get(cache_key)
+        if message is Missing:
+            with self._lock:
+                started = self._invalidations
+                self._get_prefixes.add(prefix)
+            message = self.storage.get(key, Message, existing_session=existing_session)
+            if message is None:
+                return None
+            with self._lock:
+                # Left out when the key was written while it was read
+                if started >= self._floor and self._invalidated.get(key, 0) <= started:
+                    self.cache.put(cache_key, message)
+        return _copy(message)
+
+    def page(self, Message, after_key: str=None, page_size: int=None, owner: str=None,
+             existing_session: Session=None) -> Page:
+        page_size = page_size or self.storage.page_size
+        prefix = prefix_for(Message)
+        cache_key = ('page', prefix, self._generation(prefix), after_key, page_size, owner)
+
+        page = self.cache.get(cache_key)
+        if page is Missing:
+            page = self.storage.page(Message, after_key, page_size, owner,
+                                     existing_session=existing_session)
+            self.cache.put(cache_key, page, weight=max(len(page.messages), 1))
+        return Page([_copy(m) for m in page.messages], page.next_key)
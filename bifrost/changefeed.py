@@ -0,0 +1,435 @@
+"""Change notifications for stored messages.
+
+Every write to storage is given a revision, a number that only grows and
+is handed out in commit order. Once a write commits, its changes are
+announced: on postgres through ``NOTIFY`` from inside the writing
+transaction, elsewhere by the storage publishing to its in-process
+:class:`ChangeHub` directly.
+
+A process runs a single :class:`PostgresListener`, which relays the
+database notifications to the hub. Any number of subscribers share that
+listener. :class:`Watch` builds on both to produce a watch stream of one
+message type: a snapshot, or a catch-up from a revision, followed by the
+changes as they commit. :class:`AsyncWatch` is the same stream for the
+asyncio storage.
+"""
+import asyncio
+import heapq
+import json
+import logging
+import select
+import threading
+from collections import deque
+from enum import Enum
+from typing import AsyncIterator, Callable, Iterator, List, NamedTuple, Optional
+
+from google.protobuf.message import Message
+
+from bifrost.error import BifrostError
+from bifrost.id import prefix_for
+
+
+__all__ = (
+    'CHANNEL',
+    'ChangeType',
+    'Change',
+    'Tombstone',
+    'ChangeFeedLaggedError',
+    'TooManySubscriptionsError',
+    'encode_changes',
+    'decode_changes',
+    'Subscription',
+    'ChangeHub',
+    'PostgresListener',
+    'EventType',
+    'WatchEvent',
+    'Watch',
+    'AsyncWatch',
+)
+
+
+LOG = logging.getLogger(__name__)
+
+# The postgres NOTIFY channel that storage announces changes on
+CHANNEL = 'bifrost_changes'
+
+# NOTIFY payloads must stay below 8000 bytes
+MAX_PAYLOAD_SIZE = 7900
+
+
+class ChangeFeedLaggedError(BifrostError):
+    """Changes were dropped before a subscriber saw them, either because
+    it fell too far behind or because the database listener reconnected.
+    Watchers resume from the last revision they processed."""
+
+
+class TooManySubscriptionsError(BifrostError):
+    pass
+
+
+class ChangeType(Enum):
+    added = 'A'
+    updated = 'U'
+    deleted = 'D'
+
+
+class Change(NamedTuple):
+    type: ChangeType
+    revision: int
+    resource_type: str
+    key: str
+
+
+class Tombstone(NamedTuple):
+    """The entry under `key` was deleted by the change given `revision`"""
+    key: str
+    revision: int
+
+
+def encode_changes(changes: List[Change]) -> List[str]:
+    """Serialize `changes` into as few NOTIFY payloads as fit the limit"""
+    payloads, items, size = [], [], 2
+    for change in changes:
+        item = json.dumps([change.type.value, change.revision, change.resource_type, change.key])
+        if items and size + len(item) + 1 > MAX_PAYLOAD_SIZE:
+            payloads.append('[' + ','.join(items) + ']')
+            items, size = [], 2
+        items.append(item)
+        size += len(item) + 1
+    if items:
+        payloads.append('[' + ','.join(items) + ']')
+    return payloads
+
+
+def decode_changes(payload: str) -> List[Change]:
+    return [Change(ChangeType(type), revision, resource_type, key)
+            for type, revision, resource_type, key in json.loads(payload)]
+
+
+class Subscription(object):
+    """One subscriber's queue of changes. A subscriber more than
+    `max_pending` changes behind is marked lagged instead of buffering
+    without bound."""
+
+    def __init__(self, hub, max_pending):
+        self._hub = hub
+        self._max_pending = max_pending
+        self._condition = threading.Condition()
+        self._pending = deque()
+        self._lagged = False
+        self._closed = False
+
+    def _offer(self, changes: List[Change]):
+        with self._condition:
+            if self._closed or self._lagged:
+                return
+            if len(self._pending) + len(changes) > self._max_pending:
+                self._lag()
+            else:
+                self._pending.extend(changes)
+            self._condition.notify_all()
+
+    def _lag(self):
+        with self._condition:
+            self._lagged = True
+            self._pending.clear()
+            self._condition.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def get(self, timeout: float=None) -> List[Change]:
+        """Wait up to `timeout` seconds for changes and return everything
+        pending. Returns an empty list on timeout or once closed."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending or self._lagged or self._closed, timeout)
+            if self._lagged and not self._closed:
+                raise ChangeFeedLaggedError('change feed subscriber fell behind')
+            changes = list(self._pending)
+            self._pending.clear()
+            return changes
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._pending.clear()
+            self._condition.notify_all()
+        self._hub._unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ChangeHub(object):
+    """Fans published changes out to every subscription in the process.
+
+    A watch stream holds a server thread for as long as it is open, so
+    at most `max_subscriptions` are allowed at once, leaving the rest of
+    the thread pool to other RPCs.
+    """
+
+    def __init__(self, max_pending=10000, max_subscriptions: int=None):
+        self.max_pending = max_pending
+        self.max_subscriptions = max_subscriptions
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+        self._listeners = []
+
+    def listen(self, on_changes: Callable[[List[Change]], None], on_resync: Callable[[], None]):
+        """Call `on_changes` with every published list of changes and
+        `on_resync` whenever changes may have been missed, both on the
+        publishing thread. Unlike a subscription a listener never lags and
+        does not count against `max_subscriptions`; it must return quickly."""
+        with self._lock:
+            self._listeners.append((on_changes, on_resync))
+
+    def _listening(self):
+        with self._lock:
+            return list(self._listeners)
+
+    @staticmethod
+    def _call(listener, *args):
+        # A failing listener must not fail the write that published
+        try:
+            listener(*args)
+        except Exception:
+            LOG.exception('Change feed listener failed')
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self, self.max_pending)
+        with self._lock:
+            if self.max_subscriptions is not None and len(self._subscriptions) >= self.max_subscriptions:
+                raise TooManySubscriptionsError(
+                    f'the limit of {self.max_subscriptions} change feed subscriptions is reached')
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._subscriptions)
+
+    def publish(self, changes: List[Change]):
+        if not changes:
+            return
+        for on_changes, _ in self._listening():
+            self._call(on_changes, changes)
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription._offer(changes)
+
+    def resync(self):
+        """Mark every subscriber lagged, for when changes may have been
+        missed and only a catch-up from storage can tell which."""
+        for _, on_resync in self._listening():
+            self._call(on_resync)
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription._lag()
+
+
+class PostgresListener(object):
+    """LISTENs for change notifications on a dedicated connection of the
+    psycopg2 `engine` and publishes them to `hub` from a daemon thread.
+
+    Notifications sent while the connection is down are lost, so after
+    every reconnect the subscribers are resynced.
+    """
+
+    def __init__(self, engine, hub: ChangeHub, channel=CHANNEL, poll_interval=1.0,
+                 initial_backoff=0.1, max_backoff=10.0):
+        self.engine = engine
+        self.hub = hub
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='change-listener', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _connect(self):
+        connection = self.engine.raw_connection()
+        # LISTEN outlives a checkout, so never hand this connection back
+        connection.detach()
+        dbapi_connection = connection.connection
+        dbapi_connection.autocommit = True
+        with dbapi_connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {self.channel}')
+        return connection, dbapi_connection
+
+    def _run(self):
+        backoff = self.initial_backoff
+        while not self._stopped.is_set():
+            connection = None
+            try:
+                connection, dbapi_connection = self._connect()
+                self.hub.resync()
+                backoff = self.initial_backoff
+                while not self._stopped.is_set():
+                    if select.select([dbapi_connection], [], [], self.poll_interval) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notify = dbapi_connection.notifies.pop(0)
+                        self.hub.publish(decode_changes(notify.payload))
+            except Exception:
+                LOG.exception('Change listener failed, reconnecting in %.1fs', backoff)
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+
+class EventType(Enum):
+    snapshot = 'SNAPSHOT'
+    synced = 'SYNCED'
+    added = 'ADDED'
+    updated = 'UPDATED'
+    deleted = 'DELETED'
+
+
+class WatchEvent(NamedTuple):
+    type: EventType
+    message: Optional[Message]
+    revision: int
+    # Only set on DELETED events, which have no message
+    key: Optional[str] = None
+
+
+def _revision(change) -> int:
+    return change.revision
+
+
+async def _anext(iterator: AsyncIterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def _amerge(*iterators: AsyncIterator, key) -> AsyncIterator:
+    """:func:`heapq.merge` for async iterators, which must not yield None"""
+    heads = [await _anext(iterator) for iterator in iterators]
+    while True:
+        pending = [i for i, head in enumerate(heads) if head is not None]
+        if not pending:
+            return
+        i = min(pending, key=lambda i: key(heads[i]))
+        yield heads[i]
+        heads[i] = await _anext(iterators[i])
+
+
+class Watch(object):
+    """Watch every `Message` in `storage`.
+
+    Without `since_revision` the watch starts with a SNAPSHOT event per
+    stored message. With it, the watch starts with an ADDED, UPDATED or
+    DELETED event per message changed after that revision. Either way a
+    SYNCED event follows, and then an event for each change as it commits.
+    Every event carries a revision to resume from after a reconnect.
+    DELETED events only carry the key of the entry, read from the
+    tombstone the delete left.
+
+    Catching up always uses the same revision range queries, so a burst of
+    notifications costs one query for the messages and one for the
+    tombstones, not one read per change. A message
+    changed again while it is being delivered may be delivered twice,
+    never skipped. The hub subscription is taken before the catch-up
+    query, so nothing that commits in between is missed.
+    """
+
+    def __init__(self, storage, hub: ChangeHub, Message, since_revision: int=0,
+                 poll_interval: float=1.0):
+        self.storage = storage
+        self.Message = Message
+        self.revision = since_revision
+        self.poll_interval = poll_interval
+        self._resource_type = prefix_for(Message)
+        self._subscription = hub.subscribe()
+
+    def close(self):
+        """End the watch; safe to call from another thread, such as an RPC
+        cancellation callback."""
+        self._subscription.close()
+
+    def _event(self, change, snapshot: bool) -> WatchEvent:
+        """The event for a Revision or Tombstone of the catch-up, which
+        moves the watch on to its revision"""
+        self.revision = max(self.revision, change.revision)
+        if snapshot:
+            return WatchEvent(EventType.snapshot, change.message, change.revision)
+        if isinstance(change, Tombstone):
+            return WatchEvent(EventType.deleted, None, change.revision, change.key)
+        return WatchEvent(EventType.added if change.added else EventType.updated,
+                          change.message, change.revision)
+
+    def _concerns(self, changes: List[Change]) -> bool:
+        return any(c.resource_type == self._resource_type and c.revision > self.revision for c in changes)
+
+    def _catch_up(self, snapshot: bool) -> Iterator[WatchEvent]:
+        changes = self.storage.changed_since(self.Message, self.revision)
+        if not snapshot:
+            # A snapshot only holds what exists
+            changes = heapq.merge(changes, self.storage.deleted_since(self.Message, self.revision), key=_revision)
+        for change in changes:
+            yield self._event(change, snapshot)
+
+    def __iter__(self) -> Iterator[WatchEvent]:
+        try:
+            yield from self._catch_up(snapshot=self.revision == 0)
+            yield WatchEvent(EventType.synced, None, self.revision)
+
+            while not self._subscription.closed:
+                changes = self._subscription.get(self.poll_interval)
+                if self._concerns(changes):
+                    yield from self._catch_up(snapshot=False)
+        finally:
+            self.close()
+
+
+class AsyncWatch(Watch):
+    """:class:`Watch` over an asyncio `storage`, such as
+    :class:`bifrost.aiostorage.AsyncStorage`, iterated with ``async for``.
+    Waiting on the hub subscription runs on the loop's default executor,
+    so the loop is never blocked and a closed watch frees its thread
+    within `poll_interval`."""
+
+    async def _catch_up(self, snapshot: bool) -> AsyncIterator[WatchEvent]:
+        changes = self.storage.changed_since(self.Message, self.revision)
+        if not snapshot:
+            changes = _amerge(changes, self.storage.deleted_since(self.Message, self.revision), key=_revision)
+        async for change in changes:
+            yield self._event(change, snapshot)
+
+    async def __aiter__(self) -> AsyncIterator[WatchEvent]:
+        loop = asyncio.get_running_loop()
+        try:
+            async for event in self._catch_up(snapshot=self.revision == 0):
+                yield event
+            yield WatchEvent(EventType.synced, None, self.revision)
+
+            while not self._subscription.closed:
+                changes = await loop.run_in_executor(None, self._subscription.get, self.poll_interval)
+                if self._concerns(changes):
+                    async for event in self._catch_up(snapshot=False):
+                        yield event
+        finally:
+            self.close()
@@ -0,0 +1,148 @@
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from bifrost.error import BifrostError
+
+
+__all__ = (
+    'ClientConfigError',
+    'InvalidSubdomainError',
+    'RenderedClientConfig',
+    'ClientConfigSource',
+)
+
+
+LOG = logging.getLogger(__name__)
+
+# The ngrok client config, rendered from the settings in the config file
+# plus the subdomain and proxy_uri of the request
+DEFAULT_TEMPLATE = '''\
+server_addr: {{ server_addr }}
+trust_host_root_certs: {{ trust_host_root_certs | default(false) | tojson }}
+'''
+
+# A single lower case DNS label, which also keeps it inert in the YAML it is
+# rendered into. Matched in full, as $ would allow a trailing newline.
+SUBDOMAIN_PATTERN = re.compile(r'[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?')
+
+
+class ClientConfigError(BifrostError):
+    pass
+
+
+class InvalidSubdomainError(ClientConfigError):
+    pass
+
+
+class RenderedClientConfig(NamedTuple):
+    # The ngrok client config file
+    config: str
+    # host:port of the ngrokd tunnel server
+    server_addr: str
+    # Where ngrokd serves the tunnel of the requested subdomain; empty
+    # when no subdomain was requested
+    proxy_uri: str
+
+
+class _Loaded(NamedTuple):
+    stamp: Tuple[int, int]
+    settings: Dict[str, Any]
+    template: 'jinja2.Template'
+    server_addr: str
+    domain: str
+
+
+class ClientConfigSource(object):
+    """The ngrok client config at `path`, parsed once and kept in memory.
+
+    The file is a YAML mapping that holds at least ``server_addr``. Configs
+    are rendered from `template_path`, or :data:`DEFAULT_TEMPLATE`, with
+    every setting of the file plus the requested ``subdomain`` and its
+    ``proxy_uri``. ngrokd serves ``<subdomain>.<domain>``, where the domain
+    is the host of ``server_addr`` without its first label.
+
+    The file is checked for changes at most every `check_interval` seconds
+    and reparsed only when its modification time or size changed. A file
+    that no longer parses is logged and the previous config kept.
+    """
+
+    def __init__(self, path, template_path=None, http_port=4480, check_interval=1.0,
+                 clock=time.monotonic):
+        self.path = path
+        self.template_path = template_path
+        self.http_port = http_port
+        self.check_interval = check_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._loaded = None  # type: Optional[_Loaded]
+        self._checked = None
+
+    def _stamp(self) -> Tuple[int, int]:
+        stamp = (0, 0)
+        for path in filter(None, (self.path, self.template_path)):
+            stat = os.stat(path)
+            stamp = (max(stamp[0], stat.st_mtime_ns), stamp[1] + stat.st_size)
+        return stamp
+
+    def _parse(self, stamp) -> _Loaded:
+        import jinja2
+        import yaml
+
+        with open(self.path, 'r') as infile:
+            settings = yaml.safe_load(infile)
+        if not isinstance(settings, dict) or 'server_addr' not in settings:
+            raise ClientConfigError(f'{self.path} does not set server_addr')
+        if self.template_path is None:
+            source = DEFAULT_TEMPLATE
+        else:
+            with open(self.template_path, 'r') as infile:
+                source = infile.read()
+        server_addr = str(settings['server_addr'])
+        host = server_addr.rpartition(':')[0] or server_addr
+        template = jinja2.Environment(undefined=jinja2.StrictUndefined, keep_trailing_newline=True) \
+            .from_string(source)
+        return _Loaded(stamp, settings, template, server_addr, host.partition('.')[2])
+
+    def refresh_due(self) -> bool:
+        return self._checked is None or self._clock() - self._checked >= self.check_interval
+
+    def refresh(self):
+        """Reparse the file if it changed since it was last loaded"""
+        self._refresh(only_if_due=False)
+
+    def _refresh(self, only_if_due):
+        import jinja2
+        import yaml
+
+        with self._lock:
+            if only_if_due and not self.refresh_due():
+                # Another thread checked while this one waited for the lock
+                return
+            self._checked = self._clock()
+            try:
+                stamp = self._stamp()
+                if self._loaded is None or stamp != self._loaded.stamp:
+                    self._loaded = self._parse(stamp)
+                    LOG.info('Loaded the client config from %s', self.path)
+            except (OSError, yaml.YAMLError, jinja2.TemplateError, ClientConfigError) as e:
+                if self._loaded is None:
+                    self._checked = None
+                    raise ClientConfigError(f'cannot load the client config from {self.path}: {e}') from e
+                LOG.exception('Keeping the previous client config, %s failed to load', self.path)
+
+    def render(self, subdomain: str='') -> RenderedClientConfig:
+        # DNS labels are case insensitive
+        if subdomain and not SUBDOMAIN_PATTERN.fullmatch(subdomain.lower()):
+            raise InvalidSubdomainError(f'{subdomain!r} is not a valid subdomain')
+        subdomain = subdomain.lower()
+        if self.refresh_due():
+            self._refresh(only_if_due=True)
+
+        loaded = self._loaded
+        proxy_uri = f'http://{subdomain}.{loaded.domain}:{self.http_port}' if subdomain else ''
+        config = loaded.template.render(loaded.settings, subdomain=subdomain, proxy_uri=proxy_uri)
+        return RenderedClientConfig(config, loaded.server_addr, proxy_uri)
@@ -1,6 +1,10 @@
 from enum import IntEnum
 
 
+# DATABASE_URI selecting bifrost.memorystorage.MemoryStorage instead of a database
+MEMORY_URI = 'memory://'
+
+
 class Size(IntEnum):
     KiB = 2**10
     MiB = 2**20
@@ -0,0 +1,255 @@
+"""Docker access that keeps the gRPC worker threads off the daemon.
+
+Every Docker call runs on the small thread pool of a :class:`DockerExecutor`.
+A caller waits at most a timeout for it, and once too many calls are
+queued new ones fail at once. A slow or wedged daemon then costs failed
+requests, not the whole server.
+
+:class:`ContainerIndex` keeps the state of the containers bifrost runs in
+memory. It lists them once and then follows the Docker events stream, so
+reading container state never waits on the daemon.
+"""
+import concurrent.futures
+import logging
+import threading
+from typing import Callable, Dict, List, NamedTuple, Optional, TypeVar
+
+from thundersnow.precondition import check_argument
+
+from bifrost.error import BifrostError
+
+
+__all__ = (
+    'DockerUnavailableError',
+    'DockerBusyError',
+    'DockerTimeoutError',
+    'DockerExecutor',
+    'ContainerState',
+    'ContainerIndex',
+)
+
+
+LOG = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Container events after which the container is gone for good
+REMOVED_ACTIONS = frozenset(('destroy',))
+
+
+class DockerUnavailableError(BifrostError):
+    pass
+
+
+class DockerBusyError(DockerUnavailableError):
+    pass
+
+
+class DockerTimeoutError(DockerUnavailableError):
+    pass
+
+
+class DockerExecutor(object):
+    """Runs Docker client calls on `max_workers` dedicated threads.
+
+    At most `max_pending` calls are queued or running; beyond that
+    :meth:`submit` raises :class:`DockerBusyError`. :meth:`call` waits
+    `timeout` seconds for the result and raises
+    :class:`DockerTimeoutError` after that. The call itself runs on to
+    completion and keeps its slot until it does.
+    """
+
+    def __init__(self, client, max_workers=4, max_pending=64, timeout=30.0):
+        check_argument(max_pending >= max_workers,
+                       'max_pending must be at least max_workers ({}), got {}', max_workers, max_pending)
+        self.client = client
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='docker')
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._pending
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def submit(self, fn: Callable[..., T], *args, **kwargs) -> 'concurrent.futures.Future[T]':
+        """Schedule ``fn(client, *args, **kwargs)``"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise DockerBusyError(f'{self._pending} docker calls are already waiting')
+            self._pending += 1
+        try:
+            future = self._executor.submit(fn, self.client, *args, **kwargs)
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def call(self, fn: Callable[..., T], *args, timeout: float=None, **kwargs) -> T:
+        """Run ``fn(client, *args, **kwargs)`` and wait for its result"""
+        future = self.submit(fn, *args, **kwargs)
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise DockerTimeoutError(f'docker did not answer within {timeout:.1f}s') from None
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class ContainerState(NamedTuple):
+    id: str
+    name: str
+    # created, restarting, running, removing, paused, exited or dead
+    status: str
+    labels: Dict[str, str]
+    # Published container port, such as 4443/tcp, to its host port
+    ports: Dict[str, str]
+
+    @classmethod
+    def from_attrs(cls, attrs: dict) -> 'ContainerState':
+        """From the attributes of a ``docker inspect``"""
+        ports = {}
+        for port, bindings in (attrs.get('NetworkSettings', {}).get('Ports') or {}).items():
+            if bindings:
+                ports[port] = bindings[0]['HostPort']
+        return cls(id=attrs['Id'],
+                   name=attrs.get('Name', '').lstrip('/'),
+                   status=attrs['State']['Status'],
+                   labels=dict(attrs.get('Config', {}).get('Labels') or {}),
+                   ports=ports)
+
+
+class ContainerIndex(object):
+    """The state of every container carrying the label `label`, kept up
+    to date from the Docker events stream by a daemon thread.
+
+    The events stream is opened before the containers are listed, so
+    nothing that happens in between is missed. An event only names a
+    container; its state is then inspected, which makes applying an event
+    twice or late harmless. After the stream breaks, the index reconnects
+    and lists the containers again.
+
+    Listeners are called on the index thread with the id and new state of
+    every container that changed, the state being None once it is gone.
+    """
+
+    def __init__(self, client, label: str, initial_backoff=0.1, max_backoff=10.0):
+        self.client = client
+        self.label = label
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._containers = {}  # type: Dict[str, ContainerState]
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._events = None
+        self._listeners = []  # type: List[Callable[[str, Optional[ContainerState]], None]]
+        self._thread = threading.Thread(target=self._run, name='container-index', daemon=True)
+
+    def add_listener(self, listener: Callable[[str, Optional[ContainerState]], None]):
+        self._listeners.append(listener)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        events = self._events
+        if events is not None:
+            # Unblocks the thread waiting on the stream
+            events.close()
+        self._thread.join()
+
+    @property
+    def synced(self) -> bool:
+        """Whether the containers were listed at least once"""
+        return self._synced.is_set()
+
+    def wait_synced(self, timeout: float=None) -> bool:
+        return self._synced.wait(timeout)
+
+    def get(self, container_id: str) -> Optional[ContainerState]:
+        with self._lock:
+            return self._containers.get(container_id)
+
+    def containers(self, labels: Dict[str, str]=None) -> List[ContainerState]:
+        """Every indexed container, or those with all of `labels`"""
+        with self._lock:
+            containers = list(self._containers.values())
+        labels = labels or {}
+        return [c for c in containers if all(c.labels.get(k) == v for k, v in labels.items())]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._containers)
+
+    def _changed(self, container_id: str, state: Optional[ContainerState]):
+        with self._lock:
+            if state is None:
+                self._containers.pop(container_id, None)
+            else:
+                self._containers[container_id] = state
+        for listener in self._listeners:
+            try:
+                listener(container_id, state)
+            except Exception:
+                LOG.exception('Container listener %r failed', listener)
+
+    def _inspect(self, container_id) -> Optional[ContainerState]:
+        import docker.errors
+
+        try:
+            return ContainerState.from_attrs(self.client.api.inspect_container(container_id))
+        except docker.errors.NotFound:
+            return None
+
+    def _resync(self):
+        ids = [summary['Id'] for summary in self.client.api.containers(all=True, filters=dict(label=self.label))]
+        with self._lock:
+            gone = set(self._containers).difference(ids)
+        for container_id in gone:
+            self._changed(container_id, None)
+        for container_id in ids:
+            self._changed(container_id, self._inspect(container_id))
+        self._synced.set()
+
+    def _apply(self, event: dict):
+        container_id = event.get('id') or event.get('Actor', {}).get('ID')
+        if not container_id:
+            return
+        if event.get('Action', event.get('status')) in REMOVED_ACTIONS:
+            self._changed(container_id, None)
+        else:
+            self._changed(container_id, self._inspect(container_id))
+
+    def _run(self):
+        backoff = self.initial_backoff
+        while not self._stopped.is_set():
+            try:
+                self._events = self.client.events(
+                    decode=True, filters=dict(type='container', label=self.label))
+                self._resync()
+                backoff = self.initial_backoff
+                for event in self._events:
+                    self._apply(event)
+                    if self._stopped.is_set():
+                        break
+            except Exception:
+                if self._stopped.is_set():
+                    break
+                LOG.exception('Docker events stream failed, reconnecting in %.1fs', backoff)
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                events, self._events = self._events, None
+                if events is not None:
+                    events.close()
@@ -1,49 +1,147 @@
+import hashlib
 import logging
 import subprocess
-import os
-import stat
 from tempfile import TemporaryDirectory
 from pathlib import Path
+
+import grpc
+import requests
+
+from bifrost.artifact import IDENTITY, DigestMismatchError, UnsupportedEncodingError, available_encodings, \
+    decoder_for
+from bifrost.binarycache import BinaryCache
+from bifrost.error import BifrostError
 from bifrostv1.client import BifrostClient
-from bifrostv1.bifrost_pb2 import StreamProxyClientBinaryRequest, ClientConfigRequest
-import yaml
+from bifrostv1.bifrost_pb2 import StreamProxyClientBinaryRequest, ClientConfigRequest, \
+    ProxyClientBinaryInfoRequest
 import time
 
 LOG = logging.getLogger(__name__)
 
 
+class TunnelNotReadyError(BifrostError):
+    pass
+
+
+def tunnel_is_up(proxy_uri, timeout=1.0):
+    """True once ngrokd routes `proxy_uri` to a connected client. Until then
+    ngrokd itself answers with a 404 'Tunnel ... not found'; anything else,
+    including the client's 502 when nothing listens locally yet, means
+    traffic is being forwarded."""
+    try:
+        response = requests.get(proxy_uri, timeout=timeout, allow_redirects=False)
+    except requests.RequestException:
+        return False
+    return not (response.status_code == 404 and response.text.startswith('Tunnel ')
+                and 'not found' in response.text)
+
+
 class ExternalProxyTunnel(object):
-    def __init__(self, name, local_port='5001', bifrost_host='127.0.0.1', bifrost_port='8080'):
+    def __init__(self, name, local_port='5001', bifrost_host='127.0.0.1', bifrost_port='8080',
+                 download_attempts=3, cache_dir=None, ready_timeout=10.0,
+                 initial_backoff=0.05, max_backoff=1.0):
         self.client = BifrostClient(bifrost_host, bifrost_port)
         self.local_port = local_port
         self.session_name = None
         self.name = name
+        self.download_attempts = download_attempts
+        self.binary_cache = BinaryCache(cache_dir)
+        self.ready_timeout = ready_timeout
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.startup_seconds = None
+
+    def _session_is_alive(self):
+        return subprocess.call(['tmux', 'has-session', '-t', self.session_name],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+    def _wait_until_ready(self, proxy_uri, started):
+        """Poll the public proxy uri with exponential backoff until it
+        forwards traffic, the client exits, or `ready_timeout` passes."""
+        deadline = started + self.ready_timeout
+        delay = self.initial_backoff
+        while True:
+            if tunnel_is_up(proxy_uri, timeout=min(1.0, self.ready_timeout)):
+                return
+            if not self._session_is_alive():
+                raise TunnelNotReadyError(f'proxy client for {proxy_uri} exited before the tunnel came up')
+            if time.monotonic() + delay > deadline:
+                raise TunnelNotReadyError(
+                    f'tunnel {proxy_uri} was not ready after {self.ready_timeout:.1f} seconds')
+            time.sleep(delay)
+            delay = min(2 * delay, self.max_backoff)
+
+    def _download_client_binary(self, fileobj, expected_digest=None, total_size=None):
+        """Stream the proxy client binary into `fileobj`, compressed with
+        the best encoding both sides support and decompressed on the way to
+        disk. An interrupted stream is resumed from the last byte received
+        in the same encoding, and the result is checked against the
+        expected digest, or the one the server advertised when none is
+        given."""
+        digest = hashlib.sha256()
+        accept_encoding = list(available_encodings())
+        encoding = decoder = None
+        offset = written = 0
+
+        def write(data):
+            nonlocal written
+            fileobj.write(data)
+            digest.update(data)
+            written += len(data)
+
+        for attempt in range(1, self.download_attempts + 1):
+            request = StreamProxyClientBinaryRequest(uuid='12312', offset=offset, accept_encoding=accept_encoding)
+            try:
+                for part in self.client.stream_proxy_client_binary(request):
+                    if part.sha256:
+                        if expected_digest is None:
+                            expected_digest, total_size = part.sha256, part.total_size
+                        part_encoding = part.encoding or IDENTITY
+                        if decoder is None:
+                            encoding, decoder = part_encoding, decoder_for(part_encoding)
+                            # Resume in the encoding the offset counts
+                            accept_encoding = [encoding]
+                        elif part_encoding != encoding:
+                            raise UnsupportedEncodingError(
+                                f'download resumed as {part_encoding}, started as {encoding}')
+                    write(decoder.decompress(part.chunk))
+                    offset += len(part.chunk)
+                break
+            except grpc.RpcError:
+                if attempt == self.download_attempts:
+                    raise
+                LOG.warning('Client binary download interrupted at byte %d, resuming', offset)
+
+        if decoder is not None:
+            write(decoder.flush())
+        if written != total_size or digest.hexdigest() != expected_digest:
+            raise DigestMismatchError(
+                f'downloaded {written} bytes with sha256 {digest.hexdigest()}, '
+                f'expected {total_size} bytes with sha256 {expected_digest}')
+        LOG.info('Downloaded the client binary as %s, %d bytes for %d', encoding, offset, written)
+
+    def client_binary(self) -> Path:
+        """Path to the proxy client binary the server currently serves,
+        downloading it only when it is not already in the local cache."""
+        info = self.client.get_proxy_client_binary_info(ProxyClientBinaryInfoRequest())
+        return self.binary_cache.fetch(
+            info.sha256, info.total_size,
+            lambda fileobj: self._download_client_binary(fileobj, info.sha256, info.total_size))
 
     def __enter__(self):
 
+        filepath = self.client_binary()
         with TemporaryDirectory() as tmpdir:
-            filepath = Path(tmpdir) / 'ngrok'
-
-            with filepath.open('w+b') as tmp:
-                for chunk in self.client.stream_proxy_client_binary(StreamProxyClientBinaryRequest(uuid='12312')):
-                    tmp.write(chunk.chunk)
-
-                tmp.flush()
-
             config_path= Path(tmpdir) / 'ngrok.yml'
-            response = self.client.client_config(ClientConfigRequest())
-            data = yaml.load(response.config)
-            uri = data['server_addr'].replace('ngrok', self.name).replace('4443', '4480')
-            proxy_uri = f'http://{uri}'
+            response = self.client.client_config(ClientConfigRequest(subdomain=self.name))
+            proxy_uri = response.proxy_uri
 
             with config_path.open('w') as configfile:
                 configfile.write(response.config)
 
             LOG.info('Config: %s', response.config)
-            st = os.stat(str(filepath))
-            os.chmod(str(filepath), st.st_mode | stat.S_IEXEC)
 
-            self.session_name = f'ngrok-{filepath.parent.name}'
+            self.session_name = f'ngrok-{Path(tmpdir).name}'
 
             ngrok_cmd = '{} -config={} -subdomain={} {}'.format(
                 filepath, config_path, self.name, self.local_port)
@@ -53,10 +151,21 @@ class ExternalProxyTunnel(object):
                 '-d', ngrok_cmd]
 
             LOG.info('Starting bridge client: %s', args)
+            started = time.monotonic()
             subprocess.check_call(args)
-            time.sleep(1.0)  # Bad
+            try:
+                # The client reads its config from tmpdir, so wait for the
+                # tunnel before it is cleaned up.
+                self._wait_until_ready(proxy_uri, started)
+            except TunnelNotReadyError:
+                self.__exit__(None, None, None)
+                raise
+
+            self.startup_seconds = time.monotonic() - started
+            LOG.info('Tunnel %s ready after %.3f seconds', proxy_uri, self.startup_seconds)
 
         return proxy_uri
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        subprocess.check_call(['tmux', 'kill-session', '-t', self.session_name])
+        if self._session_is_alive():
+            subprocess.check_call(['tmux', 'kill-session', '-t', self.session_name])
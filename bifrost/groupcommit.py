@@ -0,0 +1,188 @@
+"""Group commit for :class:`bifrost.storage.Storage` writes.
+
+Every transaction waits for its own commit, and on postgres for the WAL
+flush behind it, so a burst of single-message writes from the gRPC worker
+threads turns into a burst of commits. :class:`GroupCommitStorage` queues
+those writes instead, and a background thread writes whatever is queued
+in one transaction, every `interval` seconds or once `max_batch` writes
+are waiting. A caller returns once the transaction holding its write has
+committed, so a write that was acknowledged is as durable as before.
+"""
+import concurrent.futures
+import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, List, NamedTuple, Optional
+
+import google.protobuf.message
+from sqlalchemy.orm import Session
+from thundersnow.precondition import check_argument
+
+from bifrost.error import BifrostError
+from bifrost.model import KeyValue
+from bifrost.storage import Revision, Storage
+
+
+__all__ = (
+    'GroupCommitError',
+    'GroupCommitStats',
+    'GroupCommitStorage',
+)
+
+
+LOG = logging.getLogger(__name__)
+
+
+class GroupCommitError(BifrostError):
+    """The writer thread died, so writes can no longer be queued"""
+
+
+class GroupCommitStats(NamedTuple):
+    # Transactions committed by the writer
+    batches: int
+    # Writes committed in them
+    writes: int
+    # Writes queued for the next one
+    pending: int
+
+
+class _Write(NamedTuple):
+    upsert: bool
+    message: google.protobuf.message.Message
+    key: Optional[str]
+    future: concurrent.futures.Future
+    queued: float
+
+
+class GroupCommitStorage(object):
+    """Queues :meth:`put` and :meth:`upsert` calls for a writer thread
+    that commits them in groups with :meth:`Storage.write_group`.
+
+    A failed group is retried one write at a time, so only the writes
+    that fail on their own, for instance a put under a key that exists,
+    raise to their callers. Writes that join a caller's `existing_session`
+    and every other method go straight to `storage`.
+
+    Should the writer die, the writes it was committing and those queued
+    fail with its error, and later ones with :class:`GroupCommitError`.
+    """
+
+    def __init__(self, storage: Storage, interval=0.002, max_batch=256, clock=time.monotonic):
+        check_argument(interval >= 0, 'interval must not be negative, got {}', interval)
+        check_argument(max_batch > 0, 'max_batch must be positive, got {}', max_batch)
+        self.storage = storage
+        self.interval = interval
+        self.max_batch = max_batch
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._queue = deque()  # type: Deque[_Write]
+        self._stopped = False
+        self._error = None  # type: Optional[BaseException]
+        self._batches = 0
+        self._writes = 0
+        self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Commit what is queued and stop the writer; later writes are
+        made one at a time"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def stats(self) -> GroupCommitStats:
+        with self._condition:
+            return GroupCommitStats(self._batches, self._writes, len(self._queue))
+
+    def _submit(self, upsert: bool, message, key):
+        future = concurrent.futures.Future()
+        with self._condition:
+            if self._error is not None:
+                raise GroupCommitError('the group commit writer died') from self._error
+            if self._stopped:
+                return None
+            self._queue.append(_Write(upsert, message, key, future, self._clock()))
+            if len(self._queue) == 1 or len(self._queue) >= self.max_batch:
+                self._condition.notify_all()
+        return future.result()
+
+    def put(self, message: google.protobuf.message.Message, key: str=None,
+            existing_session: Session=None) -> KeyValue:
+        if existing_session is None:
+            entry = self._submit(False, message, key)
+            if entry is not None:
+                return entry
+        return self.storage.put(message, key=key, existing_session=existing_session)
+
+    def upsert(self, message: google.protobuf.message.Message, key: str,
+               existing_session: Session=None) -> Revision:
+        if existing_session is None:
+            revision = self._submit(True, message, key)
+            if revision is not None:
+                return revision
+        return self.storage.upsert(message, key, existing_session=existing_session)
+
+    def _next_batch(self) -> List[_Write]:
+        with self._condition:
+            self._condition.wait_for(lambda: self._queue or self._stopped)
+            if self._queue:
+                # Give the writes arriving meanwhile until `interval` after
+                # the oldest one to join it
+                deadline = self._queue[0].queued + self.interval
+                while len(self._queue) < self.max_batch and not self._stopped:
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            return [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch))]
+
+    def _commit(self, batch: List[_Write]):
+        puts = [w for w in batch if not w.upsert]
+        upserts = [w for w in batch if w.upsert]
+        try:
+            entries, revisions = self.storage.write_group([(w.message, w.key) for w in puts],
+                                                          [(w.message, w.key) for w in upserts])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].future.set_exception(e)
+                return
+            LOG.exception('Group commit of %d writes failed, retrying them one at a time', len(batch))
+            for write in batch:
+                self._commit([write])
+            return
+
+        with self._condition:
+            self._batches += 1
+            self._writes += len(batch)
+        for write, result in zip(puts + upserts, entries + revisions):
+            write.future.set_result(result)
+
+    def _fail(self, batch: List[_Write], error: BaseException):
+        with self._condition:
+            self._error = error
+            batch = batch + list(self._queue)
+            self._queue.clear()
+        for write in batch:
+            if not write.future.done():
+                write.future.set_exception(error)
+
+    def _run(self):
+        batch = []
+        try:
+            while True:
+                batch = self._next_batch()
+                if not batch:
+                    return
+                self._commit(batch)
+        except BaseException as e:
+            # Never leave a caller waiting
+            self._fail(batch, e)
+            raise
@@ -1,13 +1,20 @@
-from typing import NamedTuple
+import os
+import threading
+import time
 from itertools import chain
+from typing import List, NamedTuple
+
 from thundersnow.precondition import check_argument
 from thundersnow.reflection import class_name
-import os
-from base64 import b16encode
 
 
 SEPARATOR = ':'
-UID_BYTES_SIZE = 6
+PREFIX = 'hackday'
+PARTITION = 'api'
+
+TIMESTAMP_BITS = 48
+RANDOM_BITS = 80
+RANDOM_BYTES_SIZE = RANDOM_BITS // 8
 
 
 def prefix_for(message):
@@ -20,8 +27,87 @@ def uuid_for(message):
     return f'{prefix}-{uid}'
 
 
+def key_for(message, *parts: str) -> str:
+    """A deterministic key for `message` built from the fields that
+    identify it, so storing it again addresses the same entry"""
+    return '{}-{}'.format(prefix_for(message), '/'.join(parts))
+
+
+def encode_id(value: int) -> str:
+    """Encode a 128 bit id as 32 upper case hex digits, the same alphabet as
+    the original random ids. Fixed width hex sorts like the integer it
+    encodes."""
+    return '%032X' % value
+
+
+class IdGenerator(object):
+    """Generates ULID style ids: a 48 bit millisecond timestamp followed by
+    80 random bits, encoded so that they sort by creation time.
+
+    Ids generated within the same millisecond increment the random part of
+    the previous id, which keeps them strictly increasing within a process
+    and makes new keys land on the right-most leaf of a btree index rather
+    than on a random page. Randomness is drawn from a buffer refilled with
+    one os.urandom call per `buffer_size` bytes.
+    """
+
+    def __init__(self, buffer_size=4096, clock=time.time):
+        check_argument(buffer_size >= RANDOM_BYTES_SIZE,
+                       'buffer_size must hold at least one id, got {}', buffer_size)
+        self.buffer_size = buffer_size - buffer_size % RANDOM_BYTES_SIZE
+        self._clock = clock
+        self._reset()
+
+    def _reset(self):
+        # A forked child gets a copy of the lock as it was, held if another
+        # thread of the parent was generating an id
+        self._lock = threading.Lock()
+        self._buffer = b''
+        self._offset = 0
+        self._last = 0
+
+    def _random(self) -> int:
+        if self._offset == len(self._buffer):
+            self._buffer = os.urandom(self.buffer_size)
+            self._offset = 0
+        start = self._offset
+        self._offset += RANDOM_BYTES_SIZE
+        return int.from_bytes(self._buffer[start:self._offset], 'big')
+
+    def _next(self) -> int:
+        timestamp = int(self._clock() * 1000) << RANDOM_BITS
+        if timestamp > self._last:
+            self._last = timestamp | self._random()
+        else:
+            # Same millisecond, or the clock stepped back: stay monotonic.
+            # An overflowing random part carries into the timestamp.
+            self._last += 1
+        return self._last
+
+    def generate(self) -> str:
+        with self._lock:
+            value = self._next()
+        return encode_id(value)
+
+    def generate_many(self, count) -> List[str]:
+        with self._lock:
+            values = [self._next() for _ in range(count)]
+        return [encode_id(v) for v in values]
+
+
+_generator = IdGenerator()
+
+# A forked child must not replay the parent's buffered randomness
+os.register_at_fork(after_in_child=_generator._reset)
+
+
 def generate_uuid():
-    return b16encode(os.urandom(UID_BYTES_SIZE)).decode('ascii')
+    return _generator.generate()
+
+
+def generate_uuids(count):
+    """Generate `count` increasing ids under a single lock acquisition"""
+    return _generator.generate_many(count)
 
 
 class ResourceID(NamedTuple):
@@ -46,7 +132,7 @@ class ResourceID(NamedTuple):
 class BifrostResourceID(ResourceID):
     def __new__(cls,  service='', version='', owner='', type='', id=''):
         return super().__new__(
-            cls, 'hackday', 'api', str(service), str(version), str(owner), str(type), str(id))
+            cls, PREFIX, PARTITION, str(service), str(version), str(owner), str(type), str(id))
 
     def __repr__(self):
         fields = self._asdict()
@@ -61,6 +147,62 @@ class BifrostResourceID(ResourceID):
     def parse(string):
         check_argument(string.count(SEPARATOR) == 6, 'Not the correct resource id format {!r}', string)
         parts = string.split(SEPARATOR)
-        check_argument(parts[0] == 'bifrost')
-        check_argument(parts[1] == 'api')
+        check_argument(parts[0] == PREFIX, 'Not a {} resource id {!r}', PREFIX, string)
+        check_argument(parts[1] == PARTITION, 'Not a {} resource id {!r}', PARTITION, string)
         return BifrostResourceID(*parts[2:])
+
+
+class LazyResourceID(object):
+    """A stored resource id that is only parsed into a
+    :class:`BifrostResourceID` when it is first used as one. It has the
+    fields of one and compares, hashes, indexes and unpacks like one; code
+    that just passes the id along with str() never pays for the parse.
+
+    Like the tuple it stands in for, it is not a str: isinstance(tag, str)
+    is False and it never equals its string. Use str(tag) for that."""
+
+    __slots__ = ('_string', '_resource_id')
+
+    def __init__(self, string: str):
+        self._string = string
+        self._resource_id = None
+
+    @property
+    def resource_id(self) -> BifrostResourceID:
+        if self._resource_id is None:
+            self._resource_id = BifrostResourceID.parse(self._string)
+        return self._resource_id
+
+    prefix = property(lambda self: self.resource_id.prefix)
+    partition = property(lambda self: self.resource_id.partition)
+    service = property(lambda self: self.resource_id.service)
+    version = property(lambda self: self.resource_id.version)
+    owner = property(lambda self: self.resource_id.owner)
+    type = property(lambda self: self.resource_id.type)
+    id = property(lambda self: self.resource_id.id)
+
+    def _asdict(self):
+        return self.resource_id._asdict()
+
+    def __str__(self):
+        return self._string
+
+    def __repr__(self):
+        return '{}({!r})'.format(class_name(self), self._string)
+
+    def __iter__(self):
+        return iter(self.resource_id)
+
+    def __len__(self):
+        return len(ResourceID._fields)
+
+    def __getitem__(self, index):
+        return self.resource_id[index]
+
+    def __eq__(self, other):
+        if isinstance(other, LazyResourceID):
+            return self._string == other._string
+        return self.resource_id == other
+
+    def __hash__(self):
+        return hash(self.resource_id)
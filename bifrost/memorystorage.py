@@ -0,0 +1,219 @@
+import threading
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import google.protobuf.message
+from google.protobuf import any_pb2
+from google.protobuf.message import Message
+from thundersnow.precondition import check_argument
+
+from bifrost.changefeed import Change, ChangeHub, ChangeType, Tombstone
+from bifrost.const import MEMORY_URI
+from bifrost.id import prefix_for
+from bifrost.storage import DEFAULT_BATCH_SIZE, DEFAULT_PAGE_SIZE, EnvelopeFormat, Page, Revision, \
+    next_key_for, rows_for, tagged, unpack_entry
+
+
+__all__ = (
+    'MEMORY_URI',
+    'Entry',
+    'MemoryStorage',
+)
+
+
+class Entry(NamedTuple):
+    """A stored message, shaped like a row of KeyValue so the helpers in
+    :mod:`bifrost.storage` apply to it unchanged."""
+    key: str
+    uuid: str
+    owner_id: str
+    resource_type: str
+    value: Optional[any_pb2.Any]
+    value_bin: Optional[any_pb2.Any]
+    revision: int
+    created_revision: int
+
+
+class MemoryStorage(object):
+    """Process local :class:`bifrost.storage.Storage` without a database,
+    for ephemeral deployments, development and benchmarks.
+
+    Keys, resource tags and pagination behave exactly as they do in the
+    database: every resource type keeps its keys sorted, so a page is a
+    bisect and a slice. Nothing survives a restart and nothing is shared
+    between processes. The `existing_session` arguments are accepted for
+    compatibility and ignored. Changes are published to `changes` as
+    they are made.
+    """
+
+    def __init__(self, page_size=DEFAULT_PAGE_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 envelope_format=EnvelopeFormat.binary, changes: ChangeHub=None):
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.envelope_format = envelope_format
+        self.changes = changes
+        self._lock = threading.RLock()
+        self._entries = {}  # type: Dict[str, Entry]
+        self._keys = {}  # type: Dict[str, List[str]]
+        # (revision, key) per resource type in revision order; an entry
+        # written again leaves its older pair behind, skipped when read
+        self._revisions = {}  # type: Dict[str, List[Tuple[int, str]]]
+        # (revision, key) of the deleted entries per resource type in
+        # revision order
+        self._tombstones = {}  # type: Dict[str, List[Tuple[int, str]]]
+        self._revision = 0
+
+    def _insert(self, rows: List[dict]) -> List[Entry]:
+        with self._lock:
+            for row in rows:
+                check_argument(row['key'] not in self._entries, 'duplicate key {}', row['key'])
+            entries = []
+            for row in rows:
+                self._revision += 1
+                entries.append(Entry(row['key'], str(row['uuid']), row['owner_id'], row['resource_type'],
+                                     row['value'], row['value_bin'], self._revision, self._revision))
+            for entry in entries:
+                self._revisions.setdefault(entry.resource_type, []).append((entry.revision, entry.key))
+                self._entries[entry.key] = entry
+                keys = self._keys.setdefault(entry.resource_type, [])
+                # New keys are time ordered, so this is nearly always an append
+                if not keys or keys[-1] < entry.key:
+                    keys.append(entry.key)
+                else:
+                    insort(keys, entry.key)
+            if self.changes is not None:
+                self.changes.publish([Change(ChangeType.added, e.revision, e.resource_type, e.key)
+                                      for e in entries])
+        return entries
+
+    def put(self, message: google.protobuf.message.Message, key: str=None, existing_session=None) -> Entry:
+        row, = rows_for([message], self.envelope_format)
+        if key:
+            row['key'] = key
+        entry, = self._insert([row])
+        return entry
+
+    def upsert(self, message: google.protobuf.message.Message, key: str, existing_session=None) -> Revision:
+        row, = rows_for([message], self.envelope_format)
+        row['key'] = key
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing is None:
+                entry, = self._insert([row])
+                return Revision(tagged(message, entry.uuid), entry.revision, True)
+
+            self._revision += 1
+            entry = existing._replace(value=row['value'], value_bin=row['value_bin'], revision=self._revision)
+            self._entries[key] = entry
+            self._revisions[entry.resource_type].append((entry.revision, key))
+            if self.changes is not None:
+                self.changes.publish([Change(ChangeType.updated, entry.revision, entry.resource_type, key)])
+        return Revision(tagged(message, entry.uuid), entry.revision, False)
+
+    def upsert_many(self, items: Iterable[Tuple[google.protobuf.message.Message, str]],
+                    existing_session=None) -> List[Revision]:
+        with self._lock:
+            return [self.upsert(message, key) for message, key in items]
+
+    def delete(self, key: str, Message, existing_session=None) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.resource_type != prefix_for(Message):
+                return False
+            del self._entries[key]
+            keys = self._keys[entry.resource_type]
+            del keys[bisect_left(keys, key)]
+            # The revision list keeps its pair, skipped since the entry is gone
+            self._revision += 1
+            self._tombstones.setdefault(entry.resource_type, []).append((self._revision, key))
+            if self.changes is not None:
+                self.changes.publish([Change(ChangeType.deleted, self._revision, entry.resource_type, key)])
+        return True
+
+    def put_many(self, messages: Iterable[google.protobuf.message.Message],
+                 existing_session=None) -> List[str]:
+        return [entry.key for entry in self._insert(rows_for(list(messages), self.envelope_format))]
+
+    def get(self, key: str, Message, existing_session=None) -> Optional[Message]:
+        entry = self._entries.get(key)
+        # Like a read of the database, which looks in the partition of Message
+        if entry is None or entry.resource_type != prefix_for(Message):
+            return None
+        return unpack_entry(Message, entry)
+
+    def _scan(self, Message, after_key: str=None, owner: str=None) -> Iterator[Entry]:
+        """Yield the `Message` entries after `after_key` in key order. Holds
+        no lock between items; entries added meanwhile may or may not be
+        seen, as with a read committed database."""
+        keys = self._keys.get(prefix_for(Message), [])
+        while True:
+            with self._lock:
+                # Bisect again each step since an out of order insert may
+                # have shifted the list
+                position = 0 if after_key is None else bisect_right(keys, after_key)
+                if position >= len(keys):
+                    return
+                entry = self._entries[keys[position]]
+            after_key = entry.key
+            if owner is None or entry.owner_id == owner:
+                yield entry
+
+    def page(self, Message, after_key: str=None, page_size: int=None, owner: str=None,
+             existing_session=None) -> Page:
+        page_size = page_size or self.page_size
+        check_argument(page_size > 0, 'page_size must be positive, got {}', page_size)
+
+        entries = []
+        for entry in self._scan(Message, after_key, owner):
+            entries.append(entry)
+            if len(entries) == page_size:
+                break
+
+        messages = [unpack_entry(Message, e) for e in entries]
+        return Page(messages, next_key_for(entries, page_size))
+
+    def iter(self, Message, page_size: int=None, owner: str=None,
+             existing_session=None) -> Iterator[Message]:
+        for entry in self._scan(Message, owner=owner):
+            yield unpack_entry(Message, entry)
+
+    def all(self, Message, owner: str=None, existing_session=None) -> List[Message]:
+        return list(self.iter(Message, owner=owner))
+
+    def keys(self, Message, page_size: int=None, owner: str=None,
+             existing_session=None) -> Iterator[str]:
+        for entry in self._scan(Message, owner=owner):
+            yield entry.key
+
+    def changed_since(self, Message, after_revision: int=0, page_size: int=None, owner: str=None,
+                      existing_session=None) -> Iterator[Revision]:
+        revisions = self._revisions.get(prefix_for(Message), [])
+        while True:
+            with self._lock:
+                position = bisect_left(revisions, (after_revision + 1,))
+                if position >= len(revisions):
+                    return
+                revision, key = revisions[position]
+                entry = self._entries.get(key)
+            after_revision = revision
+            if entry is None or entry.revision != revision or (owner is not None and entry.owner_id != owner):
+                continue
+            yield Revision(unpack_entry(Message, entry), revision, entry.revision == entry.created_revision)
+
+    def deleted_since(self, Message, after_revision: int=0, page_size: int=None,
+                      existing_session=None) -> Iterator[Tombstone]:
+        tombstones = self._tombstones.get(prefix_for(Message), [])
+        with self._lock:
+            deleted = tombstones[bisect_left(tombstones, (after_revision + 1,)):]
+        for revision, key in deleted:
+            yield Tombstone(key, revision)
+
+    def count(self, Message, owner: str=None, existing_session=None) -> int:
+        if owner is None:
+            return len(self._keys.get(prefix_for(Message), ()))
+        return sum(1 for _ in self._scan(Message, owner=owner))
+
+    def migrate_envelopes(self, batch_size: int=None, existing_session=None) -> int:
+        """Nothing to migrate; entries keep the envelope they were put with
+        and reads accept either format."""
+        return 0
@@ -0,0 +1,392 @@
+"""In-process metrics with a Prometheus text exposition.
+
+Instruments the gRPC server through :class:`MetricsInterceptor` and the
+SQLAlchemy connection pool through :class:`TimedQueuePool` and
+:func:`instrument_engine`. Everything is registered in :data:`REGISTRY`,
+which can be scraped over HTTP with :class:`MetricsServer` or written to
+the log on a signal with :func:`install_dump_handler`.
+"""
+import logging
+import signal
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, Tuple
+
+import grpc
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from thundersnow.precondition import check_argument
+
+
+__all__ = (
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'Registry',
+    'REGISTRY',
+    'MetricsInterceptor',
+    'AsyncMetricsInterceptor',
+    'TimedQueuePool',
+    'instrument_engine',
+    'MetricsServer',
+    'install_dump_handler',
+)
+
+
+LOG = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels) -> Tuple[str, ...]:
+        check_argument(set(labels) == set(self.labelnames),
+                       '{} expects labels {}, got {}', self.name, self.labelnames, tuple(labels))
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labelnames, key), value
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{name}{labels} {value}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down. With a `callback` the value is read
+    from it at scrape time instead of being set explicitly; such a gauge
+    has a single series and takes no labels."""
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), callback: Callable[[], float]=None):
+        super().__init__(name, help, labels)
+        self.callback = None
+        if callback is not None:
+            self.read_from(callback)
+
+    def read_from(self, callback: Callable[[], float]):
+        """Read the value from `callback` from now on"""
+        check_argument(not self.labelnames, 'gauge {} has labels {} and cannot read a callback',
+                       self.name, self.labelnames)
+        self.callback = callback
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.callback is not None:
+            yield self.name, '', self.callback()
+        else:
+            yield from super().samples()
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield self.name + '_bucket', _format_labels(self.labelnames, key, [('le', le)]), cumulative
+            yield self.name + '_sum', _format_labels(self.labelnames, key), total
+            yield self.name + '_count', _format_labels(self.labelnames, key), cumulative
+
+
+class Registry(object):
+    """Named collection of metrics. Asking for an existing name returns the
+    metric already registered under it, so instrumentation can be set up
+    more than once without duplicating series. A gauge asked for again with
+    a callback reads the new one, which belongs to the objects built last."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}  # type: Dict[str, _Metric]
+
+    def _get_or_create(self, Metric, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = Metric(name, *args, **kwargs)
+            check_argument(isinstance(metric, Metric),
+                           'metric {} is already registered as a {}', name, metric.type)
+            return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._get_or_create(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=(), callback=None) -> Gauge:
+        gauge = self._get_or_create(Gauge, name, help, labels, callback=callback)
+        if callback is not None and gauge.callback is not callback:
+            gauge.read_from(callback)
+        return gauge
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    """Records latency, in-flight calls, status codes and streamed bytes for
+    every RPC. Streaming calls are timed until the stream is exhausted or
+    cancelled, not just until the handler returns its generator."""
+
+    def __init__(self, registry: Registry=REGISTRY):
+        self.latency = registry.histogram(
+            'bifrost_rpc_latency_seconds', 'RPC latency by method', ['method'])
+        self.in_flight = registry.gauge(
+            'bifrost_rpc_in_flight', 'RPCs currently being handled', ['method'])
+        self.handled = registry.counter(
+            'bifrost_rpc_handled_total', 'Completed RPCs by method and status code', ['method', 'code'])
+        self.streamed_bytes = registry.counter(
+            'bifrost_rpc_streamed_bytes_total', 'Bytes of streamed messages', ['method', 'direction'])
+
+    def _start(self, method):
+        self.in_flight.inc(method=method)
+        return time.perf_counter()
+
+    def _finish(self, method, started, context, error=None):
+        code = getattr(context, 'code', lambda: None)()
+        if code is None:
+            code = grpc.StatusCode.OK if error is None else grpc.StatusCode.UNKNOWN
+        self.in_flight.dec(method=method)
+        self.latency.observe(time.perf_counter() - started, method=method)
+        self.handled.inc(method=method, code=code.name)
+
+    def _count_requests(self, method, requests):
+        for request in requests:
+            self.streamed_bytes.inc(request.ByteSize(), method=method, direction='received')
+            yield request
+
+    def _wrap_unary_response(self, method, behavior, request_streaming):
+        def wrapper(request, context):
+            if request_streaming:
+                request = self._count_requests(method, request)
+            started = self._start(method)
+            try:
+                response = behavior(request, context)
+            except Exception as e:
+                self._finish(method, started, context, e)
+                raise
+            self._finish(method, started, context)
+            return response
+        return wrapper
+
+    def _wrap_stream_response(self, method, behavior, request_streaming):
+        def wrapper(request, context):
+            if request_streaming:
+                request = self._count_requests(method, request)
+            started = self._start(method)
+            error = None
+            try:
+                for response in behavior(request, context):
+                    self.streamed_bytes.inc(response.ByteSize(), method=method, direction='sent')
+                    yield response
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                self._finish(method, started, context, error)
+        return wrapper
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+
+        method = handler_call_details.method.rsplit('/', 1)[-1]
+        if handler.unary_unary is not None:
+            return grpc.unary_unary_rpc_method_handler(
+                self._wrap_unary_response(method, handler.unary_unary, False),
+                handler.request_deserializer, handler.response_serializer)
+        if handler.stream_unary is not None:
+            return grpc.stream_unary_rpc_method_handler(
+                self._wrap_unary_response(method, handler.stream_unary, True),
+                handler.request_deserializer, handler.response_serializer)
+        if handler.unary_stream is not None:
+            return grpc.unary_stream_rpc_method_handler(
+                self._wrap_stream_response(method, handler.unary_stream, False),
+                handler.request_deserializer, handler.response_serializer)
+        return grpc.stream_stream_rpc_method_handler(
+            self._wrap_stream_response(method, handler.stream_stream, True),
+            handler.request_deserializer, handler.response_serializer)
+
+
+class AsyncMetricsInterceptor(MetricsInterceptor, grpc.aio.ServerInterceptor):
+    """:class:`MetricsInterceptor` for a grpc.aio server, whose handlers are
+    coroutines and async generators. Both record into the same series."""
+
+    async def _count_requests(self, method, requests):
+        async for request in requests:
+            self.streamed_bytes.inc(request.ByteSize(), method=method, direction='received')
+            yield request
+
+    def _wrap_unary_response(self, method, behavior, request_streaming):
+        async def wrapper(request, context):
+            if request_streaming:
+                request = self._count_requests(method, request)
+            started = self._start(method)
+            try:
+                response = await behavior(request, context)
+            except Exception as e:
+                self._finish(method, started, context, e)
+                raise
+            self._finish(method, started, context)
+            return response
+        return wrapper
+
+    def _wrap_stream_response(self, method, behavior, request_streaming):
+        async def wrapper(request, context):
+            if request_streaming:
+                request = self._count_requests(method, request)
+            started = self._start(method)
+            error = None
+            try:
+                async for response in behavior(request, context):
+                    self.streamed_bytes.inc(response.ByteSize(), method=method, direction='sent')
+                    yield response
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                self._finish(method, started, context, error)
+        return wrapper
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        return super().intercept_service(lambda details: handler, handler_call_details)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a
+    connection, including the time to open a new one."""
+
+    checkout_wait = REGISTRY.histogram(
+        'bifrost_db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection')
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.checkout_wait.observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine, registry: Registry=REGISTRY):
+    """Export checked out connections and pool saturation of `engine`"""
+    pool = engine.pool
+    checkouts = registry.counter('bifrost_db_pool_checkouts_total', 'Connections checked out of the pool')
+    event.listen(pool, 'checkout', lambda *args: checkouts.inc())
+
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(getattr(pool, '_max_overflow', 0), 0)
+        registry.gauge('bifrost_db_pool_checked_out', 'Connections currently in use',
+                       callback=pool.checkedout)
+        registry.gauge('bifrost_db_pool_saturation', 'Fraction of the pool capacity in use',
+                       callback=lambda: pool.checkedout() / capacity)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug(format, *args)
+
+
+class MetricsServer(object):
+    """Serves the registry at http://host:port/metrics from a daemon thread"""
+
+    def __init__(self, port, host='', registry: Registry=REGISTRY):
+        Handler = type('MetricsHandler', (_MetricsHandler,), dict(registry=registry))
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def install_dump_handler(signum=signal.SIGUSR1, registry: Registry=REGISTRY):
+    """Log the current metrics whenever the process receives `signum`"""
+    signal.signal(signum, lambda *_: LOG.info('Metrics:\n%s', registry.render()))
@@ -2,19 +2,24 @@ from functools import partial
 
 import arrow
 from google.protobuf import any_pb2
-from sqlalchemy import Column, String
+from sqlalchemy import BigInteger, Column, Index, Integer, Sequence, String, Table
+from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm import deferred
 from thundersnow.reflection import module_name
 
 import bifrost
 from bifrost.const import Size
 from bifrost.sqlaext import SQLAlchemyBaseModel, ResourceTagMixin, UTCDateTime, MessageEnvelope, \
-    PackageMetadata, \
-    ModelMetadata
+    BinaryMessageEnvelope, PackageMetadata, ModelMetadata, Template
 from bifrost.type import Version
 
 
 __all__ = (
-    'KeyValue'
+    'KeyValue',
+    'REVISION_SEQUENCE',
+    'SCHEMA_VERSION',
+    'SCHEMA_VERSION_TABLE',
+    'TOMBSTONE_TABLE',
 )
 
 
@@ -29,8 +34,15 @@ def utcnow():
 
 
 class TimestampMixin(object):
-    created = Column(UTCDateTime, default=utcnow)
-    updated = Column(UTCDateTime, default=utcnow, onupdate=utcnow)
+    # Bookkeeping only; loaded on first access rather than with every row.
+
+    @declared_attr
+    def created(cls):
+        return deferred(Column(UTCDateTime, default=utcnow), group='timestamps')
+
+    @declared_attr
+    def updated(cls):
+        return deferred(Column(UTCDateTime, default=utcnow, onupdate=utcnow), group='timestamps')
 
 
 class PkgBaseModel(SQLAlchemyBaseModel, ResourceTagMixin, TimestampMixin):
@@ -44,11 +56,78 @@ class PkgBaseModel(SQLAlchemyBaseModel, ResourceTagMixin, TimestampMixin):
 
 
 class KeyValue(PkgBaseModel):
+    # On postgres each message type gets a partition of its own, so its
+    # reads and writes only touch its own rows and indexes
     __bifrost_model_metadata__ = ModelMetadata(
         table='key_value',
-        resource_type='kv'
+        resource_type='kv',
+        partition_by='resource_type',
+        partitions=('endpoint', 'proxy'),
     )
 
+    @declared_attr
+    def __table_args__(cls):
+        # Listing by type (optionally scoped to an owner) must not fall back
+        # to a LIKE scan over the key, which a non-C collation cannot serve
+        # from the primary key btree. Pages filter on the type and walk the
+        # keys in order, which the primary key cannot do since it leads with
+        # the key: (resource_type, key) serves both without a sort.
+        return (
+            Index(f'ix_{cls.__tablename__}_resource_type_owner_id', 'resource_type', 'owner_id'),
+            Index(f'ix_{cls.__tablename__}_resource_type_key', 'resource_type', 'key'),
+            Index(f'ix_{cls.__tablename__}_resource_type_revision', 'resource_type', 'revision'),
+        )
+
     key = Column(String(2 * Size.KiB), primary_key=True)
-    value = Column(MessageEnvelope(Message=any_pb2.Any))
+    # Exactly one of the envelope columns is set. `value` is the original
+    # JSON encoding, kept readable so existing rows continue to load until
+    # they are migrated to `value_bin`.
+    value = Column(MessageEnvelope(Message=any_pb2.Any), nullable=True)
+    value_bin = Column(BinaryMessageEnvelope(Message=any_pb2.Any), nullable=True)
     owner_id = Column(SmallString)
+    # Part of the primary key as it is the partition key
+    resource_type = Column(SmallString, primary_key=True)
+    # Bumped on every write and assigned by the storage in commit order,
+    # see bifrost.changefeed
+    revision = Column(BigInteger, server_default='0')
+
+    @property
+    def envelope(self):
+        return self.value_bin if self.value_bin is not None else self.value
+
+
+# Hands out KeyValue revisions on databases with sequences; created and
+# dropped along with the tables.
+REVISION_SEQUENCE = Sequence(f'{KeyValue.__tablename__}_revision_seq', metadata=KeyValue.metadata)
+
+# The version of the tables above. Bump it with every change to them, and
+# add a step to bifrost.schema.MIGRATIONS when create_all alone does not
+# bring an existing database up to date.
+SCHEMA_VERSION = 3
+
+# One row per schema version applied to the database, so that a start only
+# needs to read the latest one to know the tables are current
+SCHEMA_VERSION_TABLE = Table(
+    Template.tablename.format(prefix=PkgBaseModel.__bifrost_metadata__.package,
+                              major=PkgBaseModel.__bifrost_metadata__.version.major,
+                              table='schema_version').lower(),
+    KeyValue.metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('applied', UTCDateTime, default=utcnow),
+)
+
+
+# One row per deleted KeyValue entry, under the revision of the delete, so
+# that a change feed resuming from an earlier revision learns of it
+TOMBSTONE_TABLE = Table(
+    Template.tablename.format(prefix=PkgBaseModel.__bifrost_metadata__.package,
+                              major=PkgBaseModel.__bifrost_metadata__.version.major,
+                              table='key_value_tombstone').lower(),
+    KeyValue.metadata,
+    Column('revision', BigInteger, primary_key=True, autoincrement=False),
+    Column('resource_type', SmallString),
+    Column('key', String(2 * Size.KiB)),
+    Column('deleted', UTCDateTime, default=utcnow),
+)
+Index(f'ix_{TOMBSTONE_TABLE.name}_resource_type_revision', TOMBSTONE_TABLE.c.resource_type,
+      TOMBSTONE_TABLE.c.revision)
@@ -0,0 +1,135 @@
+import logging
+import os
+import signal
+import time
+from typing import Callable, Dict
+
+from thundersnow.precondition import check_argument
+
+
+__all__ = (
+    'Supervisor',
+    'worker_share',
+)
+
+
+LOG = logging.getLogger(__name__)
+
+
+def worker_share(total: int, workers: int, index: int) -> int:
+    """The part of `total` that worker `index` of `workers` gets when it is
+    split between them as evenly as possible. The parts add up to `total`;
+    the lower indexes get one more when it does not divide evenly."""
+    check_argument(0 <= index < workers, 'index must be below {}, got {}', workers, index)
+    return total // workers + (index < total % workers)
+
+
+class Supervisor(object):
+    """Forks `workers` processes that each run `target(index)` and keeps
+    them running until the supervisor is interrupted.
+
+    Workers that die are restarted; one that dies within `min_uptime`
+    seconds of starting is restarted only after `restart_delay` so a
+    worker that cannot start does not turn into a fork loop. On SIGTERM or
+    SIGINT every worker is sent SIGTERM, which a worker sees as a
+    KeyboardInterrupt, and is killed if it has not exited within
+    `shutdown_timeout` seconds.
+
+    Only the workers are waited for, every `poll_interval` seconds, so the
+    process may run other children of its own.
+
+    `target` runs after the fork, so anything it creates -- database
+    engines, gRPC servers, thread pools -- belongs to that worker alone.
+    """
+
+    def __init__(self, target: Callable[[int], None], workers: int, restart_delay=1.0,
+                 min_uptime=5.0, shutdown_timeout=10.0, poll_interval=0.1):
+        check_argument(workers > 0, 'workers must be positive, got {}', workers)
+        self.target = target
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.min_uptime = min_uptime
+        self.shutdown_timeout = shutdown_timeout
+        self.poll_interval = poll_interval
+        self._children = {}  # type: Dict[int, (int, float)]
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            code = 0
+            try:
+                self.target(index)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                LOG.exception('Worker %d failed', index)
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+
+        LOG.info('Started worker %d with pid %d', index, pid)
+        self._children[pid] = (index, time.monotonic())
+
+    def _exited(self):
+        """Reap the workers that exited, without touching other children of
+        the process such as the proxy server, returning (pid, exit code)
+        pairs"""
+        exited = []
+        for pid in list(self._children):
+            try:
+                waited, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                # Reaped elsewhere, its exit code is gone
+                exited.append((pid, -1))
+                continue
+            if waited:
+                exited.append((pid, os.waitstatus_to_exitcode(status)))
+        return exited
+
+    def _supervise(self):
+        while self._children:
+            exited = self._exited()
+            if not exited:
+                time.sleep(self.poll_interval)
+            for pid, code in exited:
+                index, started = self._children.pop(pid)
+                LOG.warning('Worker %d (pid %d) exited with code %d, restarting', index, pid, code)
+                if time.monotonic() - started < self.min_uptime:
+                    time.sleep(self.restart_delay)
+                self._spawn(index)
+
+    def stop(self):
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self._children.pop(pid)
+
+        deadline = time.monotonic() + self.shutdown_timeout
+        while self._children and time.monotonic() < deadline:
+            exited = self._exited()
+            if not exited:
+                time.sleep(0.05)
+            for pid, _ in exited:
+                self._children.pop(pid, None)
+
+        for pid in list(self._children):
+            LOG.warning('Worker pid %d did not stop in time, killing it', pid)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self._children.pop(pid)
+
+    def run(self):
+        previous = signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            for index in range(self.workers):
+                self._spawn(index)
+            self._supervise()
+        except KeyboardInterrupt:
+            LOG.info('Stopping %d workers', len(self._children))
+        finally:
+            self.stop()
+            signal.signal(signal.SIGTERM, previous)
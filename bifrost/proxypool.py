@@ -0,0 +1,335 @@
+import logging
+import os
+import threading
+from collections import deque
+from typing import Deque, Iterator, NamedTuple, Optional, Set
+
+from thundersnow.precondition import check_argument
+
+from bifrost.dockerops import ContainerIndex, ContainerState, DockerExecutor
+from bifrost.error import BifrostError
+from bifrost.id import generate_uuid, prefix_for
+from bifrostv1.bifrost_pb2 import Proxy
+
+
+__all__ = (
+    'ProxyPoolError',
+    'ProxyNotFoundError',
+    'ProxyPoolDisabledError',
+    'ProxyPoolExhaustedError',
+    'ProxyPool',
+)
+
+
+LOG = logging.getLogger(__name__)
+
+# Every pool container carries these labels: the pool it belongs to and
+# the pid of the process that started it.
+POOL_LABEL = 'bifrost.pool'
+OWNER_LABEL = 'bifrost.owner'
+
+TUNNEL_PORT = '4443/tcp'
+HTTP_PORT = '4480/tcp'
+
+# States of a container that will not serve tunnels without a restart
+STOPPED_STATES = frozenset(('exited', 'dead'))
+
+
+class ProxyPoolError(BifrostError):
+    pass
+
+
+class ProxyNotFoundError(ProxyPoolError):
+    pass
+
+
+class ProxyPoolExhaustedError(ProxyPoolError):
+    pass
+
+
+class ProxyPoolDisabledError(ProxyPoolError):
+    pass
+
+
+class WarmProxy(NamedTuple):
+    """A started ngrokd container that is not assigned to anyone"""
+    container_id: str
+    server_addr: str
+    http_addr: str
+
+
+def proxy_key(uuid: str) -> str:
+    return f'{prefix_for(Proxy)}-{uuid}'
+
+
+def _pid_is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ProxyPool(object):
+    """Keeps `size` ngrokd containers started and idle so that a proxy is
+    handed out without waiting on Docker.
+
+    Assignments are stored in `storage` as Proxy messages keyed by their
+    uuid. They outlive the process; warm containers do not. A background
+    thread refills the pool after every acquire. Released containers are
+    restarted, which clears their tunnels, and put back in the pool when
+    `recycle` is set, or removed and replaced otherwise. The pool never
+    runs more than `max_proxies` containers, assigned ones included.
+
+    Several processes may each run a pool of the same `name`. Each manages
+    the containers it started; once started it also removes idle
+    containers left behind by processes that are no longer running.
+
+    Docker is only called through `executor`. The pool learns from `index`
+    when one of its containers stops or is removed, including by another
+    process, instead of polling for it.
+    """
+
+    def __init__(self, executor: DockerExecutor, index: ContainerIndex, storage, image, domain,
+                 name='ngrokd', size=2, max_proxies=16, host='127.0.0.1', recycle=True,
+                 stop_timeout=5, retry_interval=5.0):
+        check_argument(size >= 0, 'size must not be negative, got {}', size)
+        check_argument(max_proxies >= size, 'max_proxies must be at least size ({}), got {}', size, max_proxies)
+        self.executor = executor
+        self.index = index
+        self.storage = storage
+        self.image = image
+        self.domain = domain
+        self.name = name
+        self.size = size
+        self.max_proxies = max_proxies
+        self.host = host
+        self.recycle = recycle
+        self.stop_timeout = stop_timeout
+        self.retry_interval = retry_interval
+        self._pid = str(os.getpid())
+        self._condition = threading.Condition()
+        self._idle = deque()  # type: Deque[WarmProxy]
+        self._released = deque()  # type: Deque[str]
+        # Every container this process started and has not removed
+        self._containers = set()  # type: Set[str]
+        # Containers being started, whose slots under max_proxies are taken
+        self._starting = 0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='proxy-pool', daemon=True)
+
+    @property
+    def labels(self):
+        return {POOL_LABEL: self.name, OWNER_LABEL: self._pid}
+
+    def idle_count(self) -> int:
+        with self._condition:
+            return len(self._idle)
+
+    def container_count(self) -> int:
+        with self._condition:
+            return len(self._containers)
+
+    def _slots_taken(self) -> int:
+        return len(self._containers) + self._starting
+
+    def _run_container(self) -> WarmProxy:
+        """Start a container in the slot taken by incrementing `_starting`
+        under the lock, which it holds from then on or frees on failure"""
+        try:
+            container = self.executor.call(
+                lambda client: client.containers.run(
+                    self.image,
+                    command=['-httpAddr=:4480', '-httpsAddr=:4444', f'-domain={self.domain}'],
+                    # Publish on random host ports so any number can run side by side
+                    ports={TUNNEL_PORT: (self.host, None), HTTP_PORT: (self.host, None)},
+                    labels=self.labels,
+                    detach=True))
+        except BaseException:
+            with self._condition:
+                self._starting -= 1
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            self._starting -= 1
+            self._containers.add(container.id)
+        try:
+            return self._warm_proxy(container.id)
+        except Exception:
+            self._remove(container.id)
+            raise
+
+    def _warm_proxy(self, container_id) -> WarmProxy:
+        # Host ports are only known once the container runs, and change
+        # when it is restarted, so the index may not have them yet
+        state = ContainerState.from_attrs(
+            self.executor.call(lambda client: client.api.inspect_container(container_id)))
+        return WarmProxy(container_id,
+                         f'{self.host}:{state.ports[TUNNEL_PORT]}',
+                         f'{self.host}:{state.ports[HTTP_PORT]}')
+
+    def _remove(self, container_id):
+        import docker.errors
+
+        with self._condition:
+            self._containers.discard(container_id)
+            self._condition.notify_all()
+        try:
+            self.executor.call(lambda client: client.api.remove_container(container_id, force=True))
+        except docker.errors.NotFound:
+            pass
+        except Exception:
+            LOG.exception('Failed to remove proxy container %s', container_id)
+
+    def _recycle(self, container_id):
+        if self.recycle:
+            try:
+                self.executor.call(lambda client: client.api.restart(container_id, timeout=self.stop_timeout))
+                warm = self._warm_proxy(container_id)
+            except Exception:
+                LOG.exception('Failed to recycle proxy container %s, replacing it', container_id)
+            else:
+                with self._condition:
+                    self._idle.append(warm)
+                return
+        self._remove(container_id)
+
+    def _reconcile(self):
+        """Adopt the assignments of earlier runs and clean up after the
+        processes that are gone"""
+        assigned = {p.container_id for p in self.storage.iter(Proxy)}
+        containers = self.executor.call(
+            lambda client: client.api.containers(all=True, filters=dict(label=f'{POOL_LABEL}={self.name}')))
+        for container in containers:
+            owner = (container['Labels'] or {}).get(OWNER_LABEL, '')
+            if container['Id'] in assigned or (owner.isdigit() and _pid_is_alive(int(owner))):
+                continue
+            LOG.info('Removing idle proxy container %s left by pid %s', container['Id'][:12], owner)
+            self._remove(container['Id'])
+
+    def _container_changed(self, container_id: str, state: Optional[ContainerState]):
+        """Forget containers removed behind the pool's back, for instance
+        released by another process, and replace warm ones that stopped."""
+        if state is not None and state.status not in STOPPED_STATES:
+            return
+        with self._condition:
+            if container_id not in self._containers:
+                return
+            idle = len(self._idle)
+            self._idle = deque(w for w in self._idle if w.container_id != container_id)
+            if state is None:
+                self._containers.discard(container_id)
+            elif len(self._idle) < idle:
+                self._released.append(container_id)
+            self._condition.notify_all()
+
+    def _needs_work(self):
+        return self._stopped or self._released or (
+            len(self._idle) < self.size and self._slots_taken() < self.max_proxies)
+
+    def _reconcile_until_done(self) -> bool:
+        """Reconcile, retrying every `retry_interval` while Docker cannot be
+        reached. Returns False when the pool is stopped first."""
+        while True:
+            try:
+                self._reconcile()
+                return True
+            except Exception:
+                LOG.exception('Failed to reconcile the proxy pool, retrying in %.1fs', self.retry_interval)
+            with self._condition:
+                if self._condition.wait_for(lambda: self._stopped, self.retry_interval):
+                    return False
+
+    def _run(self):
+        if not self._reconcile_until_done():
+            return
+        while True:
+            with self._condition:
+                self._condition.wait_for(self._needs_work)
+                if self._stopped:
+                    return
+                released = self._released.popleft() if self._released else None
+                if released is None:
+                    self._starting += 1
+
+            try:
+                if released is not None:
+                    self._recycle(released)
+                else:
+                    warm = self._run_container()
+                    with self._condition:
+                        self._idle.append(warm)
+            except Exception:
+                LOG.exception('Failed to refill the proxy pool')
+                with self._condition:
+                    self._condition.wait(self.retry_interval)
+
+    def start(self):
+        """Start reconciling and then refilling the pool on its thread, so
+        that a Docker daemon which is down does not hold up the caller"""
+        self.index.add_listener(self._container_changed)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop refilling and remove the idle containers. Assigned ones are
+        left running for their users."""
+        with self._condition:
+            self._stopped = True
+            idle, self._idle = list(self._idle), deque()
+            self._condition.notify_all()
+        self._thread.join()
+        for warm in idle:
+            self._remove(warm.container_id)
+
+    def acquire(self, user: str) -> Proxy:
+        """Assign a proxy to `user`, from the pool when one is warm or by
+        starting a container otherwise."""
+        with self._condition:
+            warm = self._idle.popleft() if self._idle else None
+            if warm is None:
+                if self._slots_taken() >= self.max_proxies:
+                    raise ProxyPoolExhaustedError(f'all {self.max_proxies} proxies are in use')
+                # Taken before starting, so concurrent acquires cannot
+                # start more than max_proxies between them
+                self._starting += 1
+            self._condition.notify_all()
+
+        if warm is None:
+            LOG.warning('Proxy pool is empty, starting a container for %s', user)
+            warm = self._run_container()
+
+        proxy = Proxy(uuid=generate_uuid(), user=user, container_id=warm.container_id,
+                      server_addr=warm.server_addr, http_addr=warm.http_addr)
+        try:
+            self.storage.put(proxy, key=proxy_key(proxy.uuid))
+        except Exception:
+            self._release_container(warm.container_id)
+            raise
+        return proxy
+
+    def _release_container(self, container_id):
+        with self._condition:
+            self._released.append(container_id)
+            self._condition.notify_all()
+
+    def release(self, uuid: str) -> Proxy:
+        """Unassign the proxy `uuid` and recycle its container"""
+        key = proxy_key(uuid)
+        proxy = self.storage.get(key, Proxy)
+        if proxy is None or not self.storage.delete(key, Proxy):
+            raise ProxyNotFoundError(f'there is no proxy {uuid}')
+
+        with self._condition:
+            ours = proxy.container_id in self._containers
+        if ours:
+            self._release_container(proxy.container_id)
+        else:
+            # Started by another process, which notices on its next sync
+            self._remove(proxy.container_id)
+        return proxy
+
+    def assigned(self) -> Iterator[Proxy]:
+        return self.storage.iter(Proxy)
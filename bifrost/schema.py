@@ -0,0 +1,208 @@
+"""Creating and upgrading the tables, checked against the schema version
+recorded in the database.
+
+A start reads the latest applied version with a single query. Only when
+it differs from :data:`bifrost.model.SCHEMA_VERSION` are the tables
+created, the :data:`MIGRATIONS` in between run and the new version
+recorded, rather than inspecting every table on every start.
+"""
+import logging
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import func, inspect, literal_column, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import DropIndex
+from thundersnow.precondition import check_argument, check_state
+
+from bifrost.model import REVISION_SEQUENCE, SCHEMA_VERSION, SCHEMA_VERSION_TABLE, KeyValue, SQLAlchemyBaseModel
+from bifrost.sqlaext import create_partitions, partition_name
+
+
+__all__ = (
+    'MIGRATIONS',
+    'schema_version',
+    'upgrade_schema',
+    'ensure_schema',
+    'ensure_schema_async',
+    'detach_partition',
+)
+
+
+LOG = logging.getLogger(__name__)
+
+# pg_advisory_xact_lock key held while upgrading, so that servers starting
+# together upgrade one after the other
+SCHEMA_LOCK_ID = 0x62696673
+
+
+def _add_column(connection: Connection, table, column, ddl: str) -> bool:
+    """Add `column` to `table` as `ddl` unless a table from before the
+    version table already has it. Returns whether it was added."""
+    if column in {c['name'] for c in inspect(connection).get_columns(table.name)}:
+        return False
+    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column} {ddl}'))
+    return True
+
+
+def _binary_envelopes(connection: Connection, table):
+    """Make room for binary envelopes next to the JSON ones, which
+    Storage.migrate_envelopes then moves over"""
+    binary = table.c.value_bin.type.compile(dialect=connection.dialect)
+    _add_column(connection, table, 'value_bin', f'{binary} NULL')
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(f'ALTER TABLE {table.name} ALTER COLUMN value DROP NOT NULL'))
+    # SQLite cannot change a column; the rebuild of version 2 makes value
+    # nullable there
+
+
+def _resource_types(connection: Connection, table):
+    """Tag every entry with its type, the prefix of its key"""
+    _add_column(connection, table, 'resource_type', "VARCHAR(255) NOT NULL DEFAULT ''")
+    if connection.dialect.name == 'postgresql':
+        prefix = func.split_part(table.c.key, '-', 1)
+    else:
+        prefix = func.substr(table.c.key, 1, func.instr(table.c.key, '-') - 1)
+    connection.execute(table.update().where(table.c.resource_type == '').values(resource_type=prefix))
+
+
+def _revisions(connection: Connection, table):
+    """Give every entry written before revisions existed one of its own.
+    The change feed only reads entries above revision 0, so left at the
+    column default they would never show up in a watch snapshot."""
+    _add_column(connection, table, 'revision', 'BIGINT NOT NULL DEFAULT 0')
+    unrevised = table.update().where(table.c.revision == 0)
+    if connection.dialect.name == 'postgresql':
+        connection.execute(unrevised.values(revision=REVISION_SEQUENCE.next_value()))
+    else:
+        latest = connection.execute(select(func.max(table.c.revision))).scalar() or 0
+        connection.execute(unrevised.values(revision=literal_column('rowid') + latest))
+
+
+def _version_1(connection: Connection):
+    """Bring a KeyValue table created before the version table, which
+    create_all left as it was, up to the model of version 1"""
+    table = KeyValue.__table__
+    _binary_envelopes(connection, table)
+    _resource_types(connection, table)
+    _revisions(connection, table)
+
+
+def _partition_key_value(connection: Connection):
+    """Rebuild KeyValue with resource_type in its primary key, partitioned
+    by it on postgres, and copy the entries over.
+
+    On postgres the resource tag loses its unique constraint, since a
+    partitioned table can only enforce uniqueness on indexes that include
+    the partition column; tags stay apart by their random id. Indexes of
+    the old table are dropped along with it."""
+    table = KeyValue.__table__
+    legacy = f'{table.name}_legacy'
+    # Index names are shared by every table of a schema
+    # and tables from before the version table may lack some of these
+    for index in table.indexes:
+        connection.execute(DropIndex(index, if_exists=True))
+    connection.execute(text(f'ALTER TABLE {table.name} RENAME TO {legacy}'))
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(f'ALTER TABLE {legacy} RENAME CONSTRAINT {table.name}_pkey TO {legacy}_pkey'))
+    table.create(connection)
+    columns = ', '.join(column.name for column in table.columns)
+    connection.execute(text(f'INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {legacy}'))
+    connection.execute(text(f'DROP TABLE {legacy}'))
+
+
+# Steps that bring the tables of version - 1 to version, for the changes
+# create_all does not make to existing tables. They run in order, after
+# create_all, in the transaction that records the new version.
+MIGRATIONS = {
+    1: _version_1,
+    2: _partition_key_value,
+}  # type: Dict[int, Callable[[Connection], None]]
+
+
+def schema_version(connection: Connection) -> Optional[int]:
+    """The latest version applied to the database, None when the tables
+    were never versioned"""
+    try:
+        return connection.execute(select(func.max(SCHEMA_VERSION_TABLE.c.version))).scalar()
+    except DBAPIError:
+        # The version table does not exist
+        return None
+
+
+def upgrade_schema(connection: Connection, version: int=SCHEMA_VERSION):
+    """Create the missing tables, run the migrations up to `version` and
+    record it. Call it in a transaction."""
+    if connection.dialect.name == 'postgresql':
+        connection.execute(select(func.pg_advisory_xact_lock(SCHEMA_LOCK_ID)))
+    tables = inspect(connection).get_table_names()
+    # A KeyValue table without a version table predates versioning and
+    # is older than every version
+    unversioned = KeyValue.__tablename__ in tables and SCHEMA_VERSION_TABLE.name not in tables
+    SQLAlchemyBaseModel.metadata.create_all(connection, checkfirst=True)
+
+    # Read again, now that the version table exists and another server
+    # may have upgraded while this one waited for the lock
+    current = 0 if unversioned else schema_version(connection)
+    if current is not None and current >= version:
+        return
+    if current is not None:
+        for step in range(current + 1, version + 1):
+            migration = MIGRATIONS.get(step)
+            if migration is not None:
+                LOG.info('Migrating the schema to version %d', step)
+                migration(connection)
+    # Partitions added to a model since the table was created
+    for table in SQLAlchemyBaseModel.metadata.sorted_tables:
+        create_partitions(connection, table)
+    connection.execute(SCHEMA_VERSION_TABLE.insert().values(version=version))
+    LOG.info('Upgraded the schema from version %s to %d', current, version)
+
+
+def _needs_upgrade(current: Optional[int], version: int) -> bool:
+    if current is not None and current > version:
+        # A newer server already upgraded, as happens during a rolling
+        # deploy; its changes are left alone
+        LOG.warning('The schema is at version %d, newer than %d', current, version)
+    return current is None or current < version
+
+
+def ensure_schema(engine: Engine, version: int=SCHEMA_VERSION) -> bool:
+    """Upgrade the schema when it is older than `version`. Returns whether
+    it was upgraded."""
+    with engine.connect() as connection:
+        current = schema_version(connection)
+    if not _needs_upgrade(current, version):
+        return False
+    with engine.begin() as connection:
+        upgrade_schema(connection, version)
+    return True
+
+
+async def ensure_schema_async(engine, version: int=SCHEMA_VERSION) -> bool:
+    """:func:`ensure_schema` for an ``AsyncEngine``"""
+    async with engine.connect() as connection:
+        current = await connection.run_sync(schema_version)
+    if not _needs_upgrade(current, version):
+        return False
+    async with engine.begin() as connection:
+        await connection.run_sync(upgrade_schema, version)
+    return True
+
+
+def detach_partition(connection: Connection, Model, partition: str) -> str:
+    """Detach the partition of `Model` holding the rows whose partition
+    column is `partition`. Only the catalog changes; the rows stay in a
+    table of their own, whose name is returned for the caller to archive
+    or drop. Rows written with that value afterwards go to the default
+    partition; remove it from the partitions in the ModelMetadata of
+    `Model` as well."""
+    table = Model.__table__
+    check_state(connection.dialect.name == 'postgresql',
+                'partitions only exist on postgres, not {}', connection.dialect.name)
+    check_argument(partition in table.info.get('partitions', ()),
+                   '{} has no partition {!r}', table.name, partition)
+    name = partition_name(table, partition)
+    connection.execute(text(f'ALTER TABLE {table.name} DETACH PARTITION {name}'))
+    LOG.info('Detached %s from %s', name, table.name)
+    return name
@@ -1,47 +1,198 @@
-from bifrost.storage import Storage
-from bifrostv1.bifrost_pb2 import Endpoint
+import binascii
+import logging
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from bifrost.artifact import IDENTITY, ArtifactNotFoundError, ClientBinary
+from bifrost.cache import CachedStorage, LRUCache
+from bifrost.changefeed import ChangeHub, PostgresListener, Watch
+from bifrost.clientconfig import ClientConfigSource, RenderedClientConfig
+from bifrost.dockerops import ContainerIndex, DockerExecutor
+from bifrost.error import BifrostError
+from bifrost.groupcommit import GroupCommitStorage
+from bifrost.id import key_for
+from bifrost.memorystorage import MEMORY_URI, MemoryStorage
+from bifrost.metrics import REGISTRY, TimedQueuePool, instrument_engine
+from bifrost.proxypool import POOL_LABEL, ProxyPool, ProxyPoolDisabledError
+from bifrost.singleflight import SingleFlight
+from bifrost.storage import EnvelopeFormat, Storage, batched
+from bifrostv1.bifrost_pb2 import CreateEndpointRequest, Endpoint, Proxy
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from thundersnow.precondition import check_state
 from bifrost.storage import SessionFactory
-import docker
-from pathlib import Path
-from bifrost.const import Size
 
 
 __all__ = (
     'BifrostService',
-    'BifrostServiceFactory'
+    'BifrostServiceFactory',
+    'InvalidPageTokenError',
+    'InvalidEndpointError',
 )
 
 
+LOG = logging.getLogger(__name__)
+
+MAX_PAGE_SIZE = 1000
+
+BYTES_SAVED = REGISTRY.counter('bifrost_client_binary_bytes_saved_total',
+                               'Client binary bytes not sent thanks to compression', ['encoding'])
+
+
+class InvalidPageTokenError(BifrostError):
+    pass
+
+
+class InvalidEndpointError(BifrostError):
+    pass
+
+
+def encode_page_token(key):
+    if key is None:
+        return ''
+    return urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(token):
+    if not token:
+        return None
+    try:
+        return urlsafe_b64decode(token.encode('ascii')).decode('utf-8')
+    except (binascii.Error, UnicodeError) as e:
+        raise InvalidPageTokenError(f'malformed page token {token!r}') from e
+
+
+def endpoint_key(owner: str, name: str) -> str:
+    """Endpoints are stored under their owner and name, so registering one
+    again overwrites it instead of adding a duplicate."""
+    if not name:
+        raise InvalidEndpointError('an endpoint needs a name')
+    if '/' in owner:
+        # Keeps the owner/name split of a key unambiguous
+        raise InvalidEndpointError(f'owner {owner!r} must not contain "/"')
+    return key_for(Endpoint, owner, name)
+
+
+def endpoint_from_request(request: CreateEndpointRequest) -> Endpoint:
+    return Endpoint(name=request.name, service_name=request.service_name, url=request.url,
+                    forward_to=request.forward_to, owner=request.owner, tags=request.tags)
+
+
+def with_container_status(proxy: Proxy, containers: Optional[ContainerIndex]) -> Proxy:
+    """`proxy` with the state of its container as last reported by the
+    Docker events stream, once the index has synced"""
+    if containers is not None and containers.synced:
+        state = containers.get(proxy.container_id)
+        proxy.status = state.status if state is not None else 'removed'
+    return proxy
+
+
+def count_bytes_saved(binary: ClientBinary, encoding, chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """Count what streaming `chunks` of the `encoding` form saves over
+    sending the same part of the uncompressed binary"""
+    if encoding == IDENTITY:
+        yield from chunks
+        return
+    expansion = binary.size / binary.encoded_size(encoding) - 1
+    for chunk in chunks:
+        yield chunk
+        BYTES_SAVED.inc(len(chunk) * expansion, encoding=encoding)
+
+
 class BifrostService(object):
 
-    def __init__(self, config, storage: Storage, client):
+    def __init__(self, config, storage: Storage, docker: DockerExecutor=None, changes: ChangeHub=None,
+                 proxies: ProxyPool=None, containers: ContainerIndex=None,
+                 group_commit: GroupCommitStorage=None, client_binary: ClientBinary=None):
         self.config = config
         self.storage = storage
-        self.docker = client
+        self.group_commit = group_commit
+        self.docker = docker
+        self.changes = changes
+        self.proxies = proxies
+        self.containers = containers
+        # Bursts of identical reads, such as a CI wave of clients starting
+        # up, share one backend call
+        self.flight = SingleFlight()
+        self.client_configs = ClientConfigSource(config.client_config.PATH,
+                                                 template_path=config.client_config.TEMPLATE_PATH,
+                                                 http_port=config.client_config.HTTP_PORT,
+                                                 check_interval=config.client_config.CHECK_INTERVAL_SECONDS)
+        self._client_binary = client_binary
+
+    def create_endpoint(self, endpoint: Endpoint) -> Endpoint:
+        """Store `endpoint`, replacing the one of the same owner and name.
+        Returns it as stored, with its resource tag."""
+        return self.storage.upsert(endpoint, endpoint_key(endpoint.owner, endpoint.name)).message
+
+    def create_endpoints(self, endpoints: Iterable[Endpoint]) -> int:
+        """Bulk load endpoints, committing one batch at a time so a long
+        client stream neither buffers in memory nor holds one huge
+        transaction open. Like :meth:`create_endpoint`, each replaces the
+        one of the same owner and name. Returns the number of endpoints
+        stored."""
+        created = 0
+        for batch in batched(endpoints, self.storage.batch_size):
+            created += len(self.storage.upsert_many([(e, endpoint_key(e.owner, e.name)) for e in batch]))
+        return created
+
+    def list_endpoints(self, page_size=0, page_token='') -> Tuple[List[Endpoint], str]:
+        """Return one page of endpoints and the token for the next page, which
+        is empty once the listing is exhausted."""
+        page_size = min(page_size or self.storage.page_size, MAX_PAGE_SIZE)
+        after_key = decode_page_token(page_token)
+        page = self.flight.do(('list_endpoints', after_key, page_size),
+                              lambda: self.storage.page(Endpoint, after_key, page_size))
+        return page.messages, encode_page_token(page.next_key)
+
+    def iter_endpoints(self) -> Iterator[Endpoint]:
+        return self.storage.iter(Endpoint)
+
+    def watch_endpoints(self, since_revision=0) -> Watch:
+        check_state(self.changes is not None, 'the change feed is not enabled')
+        return Watch(self.storage, self.changes, Endpoint, since_revision)
+
+    def _proxy_pool(self) -> ProxyPool:
+        if self.proxies is None:
+            raise ProxyPoolDisabledError('the proxy pool is not enabled')
+        return self.proxies
 
-    def create_endpoint(self, endpoint: Endpoint):
-        self.storage.put(endpoint.name, endpoint)
-        return f'{endpoint.owner} is a winner'
+    def start_proxy(self, user) -> Proxy:
+        return self._proxy_pool().acquire(user)
 
-    def list_endpoints(self):
-        return self.storage.all(Endpoint)
+    def stop_proxy(self, uuid) -> Proxy:
+        return self._proxy_pool().release(uuid)
 
-    def create_proxy(self, user):
-        proxy = None
-        self.storage.put(proxy)
-        self.docker.containers.run(self.config.docker.IMAGE_NAME, detach=True)
+    def iter_proxies(self) -> Iterator[Proxy]:
+        """Every assigned proxy with the state of its container as last
+        reported by the Docker events stream"""
+        for proxy in self.storage.iter(Proxy):
+            yield with_container_status(proxy, self.containers)
 
-    def iter_client_binary(self):
-        with Path('.local/bin/ngrok').open('rb') as binfile:
-            chunk = [None]
-            while len(chunk) > 0:
-                chunk = binfile.read(8 * Size.KiB)
-                yield chunk
+    def close(self):
+        if self.proxies is not None:
+            self.proxies.stop()
+        if self.group_commit is not None:
+            self.group_commit.stop()
+        if self.containers is not None:
+            self.containers.stop()
+        if self.docker is not None:
+            self.docker.shutdown()
 
-    def client_config(self):
-        with Path('ngrokclientconfig.yml').open('r') as infile:
-            return infile.read()
+    def client_binary(self) -> ClientBinary:
+        """The proxy client binary, mapped, hashed and compressed while the
+        service was built and shared by every download."""
+        if self._client_binary is None:
+            raise ArtifactNotFoundError(f'there is no client binary at {self.config.client_binary.PATH}')
+        return self._client_binary
+
+    def iter_client_binary(self, offset=0, encoding=IDENTITY) -> Iterator[bytes]:
+        binary = self.client_binary()
+        chunks = binary.iter_chunks(offset, self.config.client_binary.CHUNK_SIZE, encoding)
+        return count_bytes_saved(binary, encoding, chunks)
+
+    def client_config(self, subdomain='') -> RenderedClientConfig:
+        return self.flight.do(('client_config', subdomain), lambda: self.client_configs.render(subdomain))
 
 
 class BifrostServiceFactory(object):
@@ -49,9 +200,107 @@ class BifrostServiceFactory(object):
     def __init__(self):
         pass
 
-    def create(config):
+    def create_database_engine(config):
+        url = make_url(config.DATABASE_URI)
+        engine_options = dict(echo=config.DATABASE_ECHO)
+        if url.get_backend_name() == 'sqlite':
+            # Sessions are used from the gRPC worker threads
+            engine_options.update(connect_args=dict(check_same_thread=False))
+        if config.metrics.ENABLED:
+            engine_options.update(poolclass=TimedQueuePool)
+        engine = create_engine(url, **engine_options)
+        if config.metrics.ENABLED:
+            instrument_engine(engine)
+        return engine
+
+    def create_storage(config, changes: ChangeHub=None):
+        if config.DATABASE_URI == MEMORY_URI:
+            return MemoryStorage(page_size=config.storage.PAGE_SIZE,
+                                 batch_size=config.storage.BATCH_SIZE,
+                                 envelope_format=EnvelopeFormat(config.storage.ENVELOPE_FORMAT),
+                                 changes=changes)
+
+        engine = BifrostServiceFactory.create_database_engine(config)
+        if changes is not None and engine.dialect.name == 'postgresql':
+            # Other processes write too, so changes arrive through the
+            # database rather than from this process's storage
+            PostgresListener(engine, changes).start()
+        return Storage(SessionFactory(engine),
+                       page_size=config.storage.PAGE_SIZE,
+                       batch_size=config.storage.BATCH_SIZE,
+                       envelope_format=EnvelopeFormat(config.storage.ENVELOPE_FORMAT),
+                       changes=changes)
+
+    def load_client_binary(config) -> Optional[ClientBinary]:
+        """Load the client binary while the service starts rather than on
+        the first download; None when there is none to serve"""
+        try:
+            return ClientBinary(config.client_binary.PATH, config.client_binary.ENCODINGS)
+        except FileNotFoundError:
+            LOG.warning('There is no client binary at %s to serve', config.client_binary.PATH)
+            return None
+
+    def create_proxy_pool(config, storage) -> Tuple[DockerExecutor, ContainerIndex, ProxyPool]:
+        """The Docker executor, container index and started proxy pool, for
+        configs that enable the pool. Nothing here waits on the Docker
+        daemon, which the index and the pool retry reaching in the
+        background."""
+        # Slow to import and only needed once the service is built
+        import docker
+
         client = docker.from_env()
-        session_factory = SessionFactory(create_engine(config.DATABASE_URI))
-        storage = Storage(session_factory)
-        return BifrostService(config, storage, client)
+        executor = DockerExecutor(client,
+                                  max_workers=config.docker.WORKERS,
+                                  max_pending=config.docker.MAX_PENDING,
+                                  timeout=config.docker.TIMEOUT_SECONDS)
+        containers = ContainerIndex(client, POOL_LABEL).start()
+        proxies = ProxyPool(executor, containers, storage, config.docker.IMAGE_NAME,
+                            domain=config.proxy_pool.DOMAIN,
+                            size=config.proxy_pool.SIZE,
+                            max_proxies=config.proxy_pool.MAX_PROXIES,
+                            host=config.proxy_pool.HOST,
+                            recycle=config.proxy_pool.RECYCLE).start()
+        if config.metrics.ENABLED:
+            REGISTRY.gauge('bifrost_docker_pending_calls', 'Docker calls queued or running',
+                           callback=executor.pending)
+            REGISTRY.gauge('bifrost_docker_containers', 'Containers in the Docker state index',
+                           callback=lambda: len(containers))
+            REGISTRY.gauge('bifrost_proxy_pool_idle', 'Warm proxy containers waiting to be assigned',
+                           callback=proxies.idle_count)
+            REGISTRY.gauge('bifrost_proxy_pool_containers', 'Proxy containers run by this process',
+                           callback=proxies.container_count)
+        return executor, containers, proxies
 
+    def create(config):
+        changes = ChangeHub(max_pending=config.changefeed.MAX_PENDING,
+                            max_subscriptions=config.changefeed.MAX_WATCHES)
+        storage = BifrostServiceFactory.create_storage(config, changes)
+        group_commit = None
+        if config.storage.GROUP_COMMIT and isinstance(storage, Storage):
+            storage = group_commit = GroupCommitStorage(
+                storage,
+                interval=config.storage.GROUP_COMMIT_INTERVAL_SECONDS,
+                max_batch=config.storage.GROUP_COMMIT_MAX_BATCH).start()
+            if config.metrics.ENABLED:
+                for field in ('batches', 'writes', 'pending'):
+                    REGISTRY.gauge(f'bifrost_group_commit_{field}', f'Group commit {field}',
+                                   callback=lambda field=field: getattr(group_commit.stats(), field))
+        if config.metrics.ENABLED:
+            REGISTRY.gauge('bifrost_changefeed_subscribers', 'Open change feed subscriptions',
+                           callback=lambda: len(changes))
+        if config.cache.ENABLED:
+            storage = CachedStorage(storage, LRUCache(config.cache.MAX_SIZE, config.cache.TTL_SECONDS), changes)
+            if config.metrics.ENABLED:
+                for field in ('hits', 'misses', 'evictions', 'size'):
+                    REGISTRY.gauge(f'bifrost_storage_cache_{field}', f'Storage cache {field}',
+                                   callback=lambda field=field, cache=storage.cache: getattr(cache.stats(), field))
+        executor = containers = proxies = None
+        if config.proxy_pool.ENABLED:
+            executor, containers, proxies = BifrostServiceFactory.create_proxy_pool(config, storage)
+        service = BifrostService(config, storage, executor, changes, proxies, containers, group_commit,
+                                 BifrostServiceFactory.load_client_binary(config))
+        if config.metrics.ENABLED:
+            for field in ('executed', 'coalesced', 'in_flight'):
+                REGISTRY.gauge(f'bifrost_singleflight_{field}', f'Single-flight reads {field}',
+                               callback=lambda field=field: getattr(service.flight.stats(), field))
+        return service
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, Hashable, NamedTuple, TypeVar
+
+
+__all__ = (
+    'SingleFlightStats',
+    'SingleFlight',
+    'AsyncSingleFlight',
+)
+
+
+T = TypeVar('T')
+
+
+class SingleFlightStats(NamedTuple):
+    # Calls that went to the backend
+    executed: int
+    # Calls that waited for an identical call already in flight instead
+    coalesced: int
+    in_flight: int
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key: the first runs `fn`,
+    the ones arriving while it runs wait for it and return its result, or
+    raise its exception.
+
+    Nothing is kept once the call returns, so unlike a cache a result is
+    never older than the call that asked for it. Every waiter gets the
+    same object; treat it as read only.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # type: Dict[Hashable, _Call]
+        self._executed = 0
+        self._coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._executed += 1
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self) -> SingleFlightStats:
+        with self._lock:
+            return SingleFlightStats(self._executed, self._coalesced, len(self._calls))
+
+
+class AsyncSingleFlight(object):
+    """:class:`SingleFlight` for coroutines on one event loop. A waiter
+    that is cancelled does not cancel the shared call."""
+
+    def __init__(self):
+        self._calls = {}  # type: Dict[Hashable, asyncio.Future]
+        self._executed = 0
+        self._coalesced = 0
+
+    async def _run(self, key, fn):
+        try:
+            return await fn()
+        finally:
+            del self._calls[key]
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = asyncio.ensure_future(self._run(key, fn))
+            self._executed += 1
+        else:
+            self._coalesced += 1
+        return await asyncio.shield(call)
+
+    def stats(self) -> SingleFlightStats:
+        return SingleFlightStats(self._executed, self._coalesced, len(self._calls))
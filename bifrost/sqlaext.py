@@ -1,20 +1,18 @@
 from __future__ import absolute_import
 
-import datetime
-
-from typing import NamedTuple
+import re
+from typing import NamedTuple, Optional, Tuple
 import google.protobuf.message
 import pytz
 from google.protobuf.json_format import MessageToDict, ParseDict
-from sqlalchemy import DateTime, String, Column
-from sqlalchemy.ext.declarative.api import DeclarativeMeta
+from sqlalchemy import JSON, DateTime, LargeBinary, String, Column, Table, event, text
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.types import TypeDecorator
-from sqlalchemy.ext.declarative.api import DeclarativeMeta, declarative_base, declared_attr
+from sqlalchemy.ext.declarative import DeclarativeMeta, declarative_base, declared_attr
 from thundersnow.type import immutable, sentinel
 from thundersnow.precondition import check_argument, check_state
 from bifrost.const import Size
-from bifrost.id import BifrostResourceID, generate_uuid
+from bifrost.id import BifrostResourceID, LazyResourceID, generate_uuid
 from bifrost.error import BifrostError
 from bifrost.type import Version
 
@@ -24,14 +22,23 @@ __all__ = (
     'Template',
     'package_metadata',
     'model_metadata',
+    'partition_name',
+    'create_partitions',
 )
 
 
 Template = immutable(
     'Format',
     tablename='{prefix}_v{major}_{table}',
+    partition='{table}_{partition}',
 )
 
+# The partition of a partitioned table holding the rows no other takes
+DEFAULT_PARTITION = 'default'
+
+# Partition values end up in table names and DDL
+PARTITION_PATTERN = re.compile(r'^[a-z0-9_]+$')
+
 
 Attribute = immutable(
     'Attribute',
@@ -52,6 +59,12 @@ class MissingRegistryEntryError(DataModelError):
 class ModelMetadata(NamedTuple):
     table: str
     resource_type: str
+    # Column the table is list partitioned by on postgres, None for a
+    # plain table. It has to be part of the primary key.
+    partition_by: Optional[str] = None
+    # Values of `partition_by` with a partition of their own; rows with any
+    # other value go to the default partition
+    partitions: Tuple[str, ...] = ()
 
 
 class PackageMetadata(NamedTuple):
@@ -63,6 +76,7 @@ class PackageMetadata(NamedTuple):
 class UTCDateTime(TypeDecorator):
 
     impl = DateTime
+    cache_ok = True
 
     def process_bind_param(self, value, engine):
         if value is not None:
@@ -72,15 +86,23 @@ class UTCDateTime(TypeDecorator):
 
     def process_result_value(self, value, engine):
         if value is not None:
-            return datetime.datetime(value.year, value.month, value.day,
-                                     value.hour, value.minute, value.second,
-                                     value.microsecond, tzinfo=pytz.UTC)
+            return value.replace(tzinfo=pytz.UTC)
 
 
 class MessageEnvelope(TypeDecorator):
     # TODO-dillon: This is possible but is it necessary?
     # reflection_schema = sentinel('REFLECTION_SCHEMA')
-    impl = JSONB
+    impl = JSON(none_as_null=True)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        # JSONB on postgres, the generic JSON type (e.g. TEXT on sqlite)
+        # everywhere else. None is stored as SQL NULL rather than as the
+        # JSON null, so that an envelope kept in the binary column leaves
+        # this one NULL.
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(JSONB(none_as_null=True))
+        return dialect.type_descriptor(JSON(none_as_null=True))
 
     def __init__(self, *args, Message, **kwargs):
         check_argument(issubclass(Message, google.protobuf.message.Message),
@@ -88,6 +110,12 @@ class MessageEnvelope(TypeDecorator):
         self._Message = Message
         super().__init__(*args, **kwargs)
 
+    @property
+    def _static_cache_key(self):
+        # The cache key covers the positional arguments of __init__ only;
+        # statements on envelopes of other messages must not share one
+        return super()._static_cache_key + (('Message', self._Message),)
+
 
     def process_bind_param(self, value, engine):
         if value is None:
@@ -106,8 +134,45 @@ class MessageEnvelope(TypeDecorator):
             return ParseDict(value, self._Message())
 
 
+class BinaryMessageEnvelope(TypeDecorator):
+    """Stores a message in its protobuf wire format. Several times smaller
+    than the JSON form and decoded natively instead of through a
+    reflection walk. When `Message` is an Any only the type url and payload
+    bytes are split out on load; the payload itself is decoded on Unpack."""
+    impl = LargeBinary
+    cache_ok = True
+
+    def __init__(self, *args, Message, **kwargs):
+        check_argument(issubclass(Message, google.protobuf.message.Message),
+                       'Message must be a protobuf message class, got {}', Message)
+        self._Message = Message
+        super().__init__(*args, **kwargs)
+
+    @property
+    def _static_cache_key(self):
+        # The cache key covers the positional arguments of __init__ only;
+        # statements on envelopes of other messages must not share one
+        return super()._static_cache_key + (('Message', self._Message),)
+
+    def process_bind_param(self, value, engine):
+        if value is None:
+            return value
+        else:
+            check_argument(isinstance(value, self._Message),
+                'value is not an instance of {}', self._Message)
+
+            return value.SerializeToString()
+
+    def process_result_value(self, value, engine):
+        if value is None:
+            return value
+        else:
+            return self._Message.FromString(value)
+
+
 class ResourceID(TypeDecorator):
     impl = String(4 * Size.KiB)
+    cache_ok = True
 
     def process_bind_param(self, value, engine):
         if value is None:
@@ -120,7 +185,7 @@ class ResourceID(TypeDecorator):
         if value is None:
             return value
         else:
-            return BifrostResourceID.parse(value)
+            return LazyResourceID(value)
 
 
 # Implementation specific attributes
@@ -190,6 +255,47 @@ class SQLAlchemyModelMeta(DeclarativeMeta):
         Model = super(SQLAlchemyModelMeta, cls).__new__(cls, name, bases, dct)
         return Model
 
+    def __init__(cls, name, bases, dct):
+        # The table only exists once the declarative base has mapped it
+        super(SQLAlchemyModelMeta, cls).__init__(name, bases, dct)
+        metadata = dct.get(Attribute.model_metadata)
+        if '__table__' in cls.__dict__ and isinstance(metadata, ModelMetadata) and metadata.partition_by:
+            _partition(cls.__table__, metadata)
+
+
+def _partition(table: Table, metadata: ModelMetadata):
+    """Make `table` a postgres table list partitioned by
+    `metadata.partition_by`, created along with its partitions"""
+    check_state(metadata.partition_by in table.primary_key.columns,
+                'partition column {} of {} is not part of its primary key', metadata.partition_by, table.name)
+    for partition in metadata.partitions:
+        check_argument(PARTITION_PATTERN.match(partition) and partition != DEFAULT_PARTITION,
+                       'invalid partition {!r} of {}', partition, table.name)
+    table.dialect_kwargs['postgresql_partition_by'] = f'LIST ({metadata.partition_by})'
+    table.info.update(partitions=tuple(metadata.partitions))
+
+    @event.listens_for(table, 'after_create')
+    def after_create(target, connection, **kwargs):
+        create_partitions(connection, target)
+
+
+def partition_name(table: Table, partition: str=DEFAULT_PARTITION) -> str:
+    return Template.partition.format(table=table.name, partition=partition)
+
+
+def create_partitions(connection, table: Table):
+    """Create the partitions of `table` that do not exist yet, on postgres.
+    A partition added for values the default partition already holds
+    rows of fails to create; move those rows first."""
+    if connection.dialect.name != 'postgresql' or 'partitions' not in table.info:
+        return
+    # The default partition last, as adding one next to it scans it
+    for partition in table.info['partitions']:
+        connection.execute(text(f'CREATE TABLE IF NOT EXISTS {partition_name(table, partition)} '
+                                f"PARTITION OF {table.name} FOR VALUES IN ('{partition}')"))
+    connection.execute(text(f'CREATE TABLE IF NOT EXISTS {partition_name(table)} '
+                            f'PARTITION OF {table.name} DEFAULT'))
+
 
 class _DataModelBase(object):
     __abstract__ = True
@@ -213,23 +319,35 @@ class ResourceTagMixin(object):
     each model class
     """
 
-    @declared_attr
-    def uuid(cls):
+    @classmethod
+    def resource_tag(cls, owner='', uid=None):
+        """Build the resource tag for a row of this model. Bulk writers pass
+        in a pre-generated `uid` to avoid drawing randomness per row."""
         pkg_metadata = package_metadata(cls)
         metadata = model_metadata(cls)
         check_state(pkg_metadata is not None)
         check_state(metadata is not None)
 
+        return BifrostResourceID(
+            service=pkg_metadata.package,
+            version='v' + pkg_metadata.version.major,
+            owner=owner,
+            type=metadata.resource_type,
+            id='{}-{}'.format(metadata.resource_type, uid or generate_uuid()))
+
+    @declared_attr
+    def uuid(cls):
+        check_state(package_metadata(cls) is not None)
+        check_state(model_metadata(cls) is not None)
+
         def resource_tag_generator(context):
             # Try to get the owner if the resouce is an owned resouce.
             # TODO-dillon: How do we mark a resource as owned?
             owner = context.current_parameters.get('owner_id', '')
-            return BifrostResourceID(
-                service=pkg_metadata.package,
-                version='v' + pkg_metadata.version.major,
-                owner=owner,
-                type=metadata.resource_type,
-                id='{}-{}'.format(metadata.resource_type, generate_uuid()))
-
-        return Column(ResourceID, unique=True, index=True, default=resource_tag_generator)
+            return cls.resource_tag(owner)
 
+        # Postgres can only enforce uniqueness across the partitions of a
+        # table for indexes on the partition column; the random id keeps
+        # tags apart regardless
+        unique = model_metadata(cls).partition_by is None
+        return Column(ResourceID, unique=unique, index=True, default=resource_tag_generator)
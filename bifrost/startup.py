@@ -0,0 +1,41 @@
+import logging
+import time
+from typing import List, Tuple
+
+
+__all__ = (
+    'StartupTimer',
+)
+
+
+LOG = logging.getLogger(__name__)
+
+
+class StartupTimer(object):
+    """Times the phases of a server start. Each :meth:`mark` ends the
+    phase that began at the previous mark, or at `started`."""
+
+    def __init__(self, started: float=None, clock=time.perf_counter):
+        self._clock = clock
+        self.started = clock() if started is None else started
+        self._last = self.started
+        self._phases = []  # type: List[Tuple[str, float]]
+
+    def mark(self, phase: str) -> float:
+        now = self._clock()
+        seconds, self._last = now - self._last, now
+        self._phases.append((phase, seconds))
+        return seconds
+
+    def phases(self) -> List[Tuple[str, float]]:
+        return list(self._phases)
+
+    def total(self) -> float:
+        return self._last - self.started
+
+    def report(self) -> str:
+        phases = ', '.join(f'{phase} {seconds:.3f}s' for phase, seconds in self._phases)
+        return f'started in {self.total():.3f}s ({phases})'
+
+    def log(self, name: str='server'):
+        LOG.info('%s %s', name, self.report())
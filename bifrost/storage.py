@@ -1,25 +1,55 @@
 import contextlib
-import os
-from base64 import b16encode
+import threading
 from enum import Enum
-from typing import Optional, List
+from itertools import islice
+from typing import Dict, Optional, List, NamedTuple, Iterator, Iterable, Tuple
 
 import google
 from google.protobuf import any_pb2
 from google.protobuf.message import Message
+from sqlalchemy import delete, func, select, text, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm import sessionmaker
-from bifrost.id import uuid_for, prefix_for
-from bifrost.model import KeyValue
+from thundersnow.precondition import check_argument, check_state
+from bifrost.changefeed import CHANNEL, Change, ChangeHub, ChangeType, Tombstone, encode_changes
+from bifrost.id import uuid_for, prefix_for, generate_uuids
+from bifrost.model import KeyValue, REVISION_SEQUENCE, TOMBSTONE_TABLE, utcnow
 
 
 __all__ = (
     'IsolationLevel',
+    'EnvelopeFormat',
     'SessionFactory',
     'BaseRepository',
+    'Page',
+    'Revision',
+    'Storage',
 )
 
 
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_BATCH_SIZE = 1000
+
+# pg_advisory_xact_lock key held from drawing revisions until commit
+REVISION_LOCK_ID = 0x62696672
+
+# Revision of the rows a postgres transaction writes until it draws the
+# real ones right before committing
+PENDING_REVISION = 0
+
+# SQLite limits the bound parameters of a single statement, to 999 before 3.32
+SQLITE_MAX_VARIABLES = 999
+
+# INSERT constructs supporting ON CONFLICT, by dialect
+UPSERT_INSERTS = dict(postgresql=postgresql.insert, sqlite=sqlite.insert)
+
+# What an upsert overwrites in an existing entry; its key, resource tag
+# and creation time stay
+UPSERT_COLUMNS = ('value', 'value_bin', 'updated', 'revision')
+
+
 class IsolationLevel(Enum):
     """Define the names of common database isolation levels"""
     read_committed = "READ COMMITTED"
@@ -29,6 +59,18 @@ class IsolationLevel(Enum):
     engine_default = "ENGINE DEFAULT ISOLATION_LEVEL"
 
 
+class EnvelopeFormat(Enum):
+    """How message envelopes are written to KeyValue. Reads accept either."""
+    json = 'json'
+    binary = 'binary'
+
+
+def envelope_columns(envelope: any_pb2.Any, envelope_format: EnvelopeFormat) -> dict:
+    if envelope_format is EnvelopeFormat.binary:
+        return dict(value=None, value_bin=envelope)
+    return dict(value=envelope, value_bin=None)
+
+
 class SessionFactory(object):
     def __init__(self, engine):
         self._engine = engine
@@ -57,45 +99,657 @@ class SessionFactory(object):
                 session.close()
 
 
-class Storage(object):
-    def __init__(self, session_factory):
-        # type: (SessionFactory, google.protobuf.message.Message) -> None
-        self.session_factory = session_factory
+class Page(NamedTuple):
+    """A single keyset page of messages. `next_key` is the key to resume
+    after, or None when there are no further pages."""
+    messages: List[Message]
+    next_key: Optional[str]
+
+
+class Revision(NamedTuple):
+    """A message as written by the change that gave it `revision`. `added`
+    is true while it has not been updated since it was first stored."""
+    message: Message
+    revision: int
+    added: bool
+
+
+# The columns needed to rebuild a message. Selecting just these instead of
+# the KeyValue entity skips the ORM identity map and the decoding of every
+# other column.
+ENTRY_COLUMNS = (KeyValue.key, KeyValue.uuid, KeyValue.value, KeyValue.value_bin)
+
+
+def unpack_entry(Message, entry) -> Message:
+    """Rebuild a message from a KeyValue entity or a row of ENTRY_COLUMNS"""
+    envelope = entry.value_bin if entry.value_bin is not None else entry.value
+    message = Message()
+    envelope.Unpack(message)
+    if 'tags' in Message.DESCRIPTOR.fields_by_name:
+        message.tags.append(str(entry.uuid))
+    return message
+
+
+# ENTRY_COLUMNS plus what a change feed needs
+REVISION_COLUMNS = ENTRY_COLUMNS + (KeyValue.revision, KeyValue.created, KeyValue.updated)
+
+
+def page_criteria(Message, after_key: str=None, owner: str=None) -> list:
+    """Filter clauses selecting the keyset page of `Message` entries after
+    `after_key`, optionally only those owned by `owner`."""
+    criteria = [KeyValue.resource_type == prefix_for(Message)]
+    if owner is not None:
+        criteria.append(KeyValue.owner_id == owner)
+    if after_key is not None:
+        criteria.append(KeyValue.key > after_key)
+    return criteria
+
+
+def entry_criteria(key: str, resource_type: str) -> list:
+    """Filter clauses selecting the entry under `key`. Naming its type as
+    well lets postgres look in the partition of that type alone."""
+    return [KeyValue.key == key, KeyValue.resource_type == resource_type]
+
+
+def tombstone_query(Message, after_revision: int, page_size: int):
+    """The page of tombstones of `Message` entries deleted after
+    `after_revision`, in revision order"""
+    table = TOMBSTONE_TABLE
+    return select(table.c.key, table.c.revision) \
+        .where(table.c.resource_type == prefix_for(Message), table.c.revision > after_revision) \
+        .order_by(table.c.revision) \
+        .limit(page_size)
+
+
+def tombstone_rows(changes: List[Change]) -> List[dict]:
+    """A TOMBSTONE_TABLE row for every delete among `changes`, whose
+    revisions must be final"""
+    now = utcnow()
+    return [dict(revision=c.revision, resource_type=c.resource_type, key=c.key, deleted=now)
+            for c in changes if c.type is ChangeType.deleted]
+
+
+def next_key_for(entries: List[KeyValue], page_size: int) -> Optional[str]:
+    return entries[-1].key if len(entries) == page_size else None
 
-    def put(self, message: google.protobuf.message.Message,
-            existing_session: Session=None) -> KeyValue:
 
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """Split `iterable` into lists of at most `size` items"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def insert_batch_size(dialect, batch_size: int, row: dict) -> int:
+    """Rows per multi-row insert: `batch_size`, unless that many rows would
+    bind more parameters than SQLite accepts in one statement."""
+    if dialect.name == 'sqlite':
+        return max(1, min(batch_size, SQLITE_MAX_VARIABLES // len(row)))
+    return batch_size
+
+
+def upsert_statement(dialect, row):
+    """INSERT `row`, or a list of rows with distinct keys, into KeyValue
+    or, where a key exists, overwrite the entry with it, in one statement"""
+    insert = UPSERT_INSERTS.get(dialect.name)
+    check_state(insert is not None, 'upserts are not supported on {}', dialect.name)
+    table = KeyValue.__table__
+    statement = insert(table).values(row)
+    return statement.on_conflict_do_update(
+        index_elements=list(table.primary_key.columns),
+        set_={column: statement.excluded[column] for column in UPSERT_COLUMNS})
+
+
+def tagged(message: Message, uuid) -> Message:
+    """A copy of `message` carrying its resource tag, as reads return it"""
+    message = type(message).FromString(message.SerializeToString())
+    if 'tags' in message.DESCRIPTOR.fields_by_name:
+        message.tags.append(str(uuid))
+    return message
+
+
+def rows_for(messages: List[Message], envelope_format=EnvelopeFormat.json) -> List[dict]:
+    """Build KeyValue insert rows for a batch of messages, drawing the keys
+    and resource tags from one bulk id generation call."""
+    now = utcnow()
+    uids = generate_uuids(2 * len(messages))
+    rows = []
+    for i, message in enumerate(messages):
         envelope = any_pb2.Any()
         envelope.Pack(message)
+        owner = getattr(message, 'owner', '')
+        prefix = prefix_for(message)
+        rows.append(dict(
+            key=f'{prefix}-{uids[2 * i]}',
+            owner_id=owner,
+            resource_type=prefix,
+            uuid=KeyValue.resource_tag(owner, uids[2 * i + 1]),
+            created=now,
+            updated=now,
+            **envelope_columns(envelope, envelope_format)
+        ))
+    return rows
+
+
+def upsert_rows(items: List[Tuple[Message, str]], envelope_format=EnvelopeFormat.json) -> List[dict]:
+    """Build KeyValue upsert rows for (message, key) pairs. A statement
+    changes a row at most once, so the last message for a key is the one
+    written."""
+    rows = {}  # type: Dict[str, dict]
+    for row, (_, key) in zip(rows_for([message for message, _ in items], envelope_format), items):
+        row['key'] = key
+        rows[key] = row
+    return list(rows.values())
+
+
+def upserted(write, items: List[Tuple[Message, str]], entries: dict) -> List[Revision]:
+    """The revisions of upserting `items`, from the entries upserted by key
+    once `write` committed. Of the items under one key only the first can
+    count as added."""
+    revisions = []
+    seen = set()
+    for message, key in items:
+        entry = entries[key]
+        revisions.append(Revision(tagged(message, entry.uuid), write.revision_of(key, prefix_for(message)),
+                                  entry.created == entry.updated and key not in seen))
+        seen.add(key)
+    return revisions
+
+
+# The newest revisions of an entry and of a tombstone, which SQLite
+# counts on from
+LATEST_REVISION_QUERY = select(select(func.max(KeyValue.revision)).scalar_subquery(),
+                               select(func.max(TOMBSTONE_TABLE.c.revision)).scalar_subquery())
+
+# Held from drawing revisions on postgres until the commit
+REVISION_LOCK_STATEMENT = select(func.pg_advisory_xact_lock(REVISION_LOCK_ID))
+
+BEGIN_IMMEDIATE = text('BEGIN IMMEDIATE')
+
+# What :meth:`Storage.upsert` learns about the entries it wrote
+UPSERTED_COLUMNS = (KeyValue.key, KeyValue.uuid, KeyValue.created, KeyValue.updated)
+
+
+def new_entry(message: Message, key: str, envelope_format: EnvelopeFormat) -> KeyValue:
+    """The KeyValue entity :meth:`Storage.put` adds for `message`, by
+    default under a new time ordered key for its type"""
+    envelope = any_pb2.Any()
+    envelope.Pack(message)
+    entry = KeyValue()
+    entry.key = key or uuid_for(message)
+    for column, value in envelope_columns(envelope, envelope_format).items():
+        setattr(entry, column, value)
+    entry.owner_id = getattr(message, 'owner', '')
+    entry.resource_type = prefix_for(message)
+    # One timestamp for both, so the entry reads as never updated
+    entry.created = entry.updated = utcnow()
+    return entry
+
+
+def entry_query(key: str, Message):
+    return select(*ENTRY_COLUMNS).where(*entry_criteria(key, prefix_for(Message)))
+
+
+def page_query(Message, after_key: Optional[str], page_size: int, owner: Optional[str]):
+    return select(*ENTRY_COLUMNS) \
+        .where(*page_criteria(Message, after_key, owner)) \
+        .order_by(KeyValue.key) \
+        .limit(page_size)
+
+
+def keys_query(Message, after_key: Optional[str], page_size: int, owner: Optional[str]):
+    return select(KeyValue.key) \
+        .where(*page_criteria(Message, after_key, owner)) \
+        .order_by(KeyValue.key) \
+        .limit(page_size)
+
+
+def changed_query(Message, after_revision: int, page_size: int, owner: Optional[str]):
+    return select(*REVISION_COLUMNS) \
+        .where(*page_criteria(Message, owner=owner), KeyValue.revision > after_revision) \
+        .order_by(KeyValue.revision) \
+        .limit(page_size)
+
+
+def count_query(Message, owner: Optional[str]):
+    return select(func.count(KeyValue.key)).where(*page_criteria(Message, owner=owner))
+
+
+def revision_for(Message, entry) -> Revision:
+    """The Revision held by a row of REVISION_COLUMNS"""
+    return Revision(unpack_entry(Message, entry), entry.revision, entry.created == entry.updated)
+
 
-        with self.session_factory.create_context(existing_session) as session, session.begin():
-            entry = KeyValue()
-            entry.key = uuid_for(message)
-            entry.value = envelope
-            entry.owner_id = getattr(message, 'owner', '')
-            session.add(entry)
+def entry_lock_query(key: str, resource_type: str):
+    return select(KeyValue.key).where(*entry_criteria(key, resource_type)).with_for_update()
 
+
+def delete_statement(key: str, resource_type: str):
+    return delete(KeyValue).where(*entry_criteria(key, resource_type))
+
+
+class Write(object):
+    """State of one write transaction: the revisions handed out and the
+    changes to announce once it commits. It builds every statement the
+    transaction runs, so that :class:`bifrost.aiostorage.AsyncWrite` only
+    differs in awaiting them."""
+
+    def __init__(self, session, dialect, last_revision: int=0):
+        self.session = session
+        self.dialect = dialect
+        self.postgres = dialect.name == 'postgresql'
+        self.changes = []  # type: List[Change]
+        self.last_revision = last_revision
+        self._next_revision = None
+        self._revisions = None
+
+    def revisions(self, count: int) -> List[int]:
+        if self._counts_on_latest():
+            self._count_on(*self.session.execute(LATEST_REVISION_QUERY).one())
+        return self._hand_out(count)
+
+    def _counts_on_latest(self) -> bool:
+        # On postgres they are drawn by assign_revisions
+        return not self.postgres and self._next_revision is None
+
+    def _count_on(self, *latest: Optional[int]):
+        # Without sequences, count on from the latest revision; the storage
+        # holds its write lock, and the transaction SQLite's, until the
+        # commit. A deleted newest entry left its revision on a tombstone,
+        # and never go below the last one this process handed out.
+        self._next_revision = max(*(revision or 0 for revision in latest), self.last_revision) + 1
+
+    def _hand_out(self, count: int) -> List[int]:
+        if self.postgres:
+            return [PENDING_REVISION] * count
+        first, self._next_revision = self._next_revision, self._next_revision + count
+        self.last_revision = self._next_revision - 1
+        return list(range(first, self._next_revision))
+
+    def changed(self, change_type: ChangeType, key: str, resource_type: str, revision: int):
+        self.changes.append(Change(change_type, revision, resource_type, key))
+
+    def begin_immediate(self):
+        """Take the write lock of the SQLite database as the transaction
+        begins rather than at its first INSERT, so that other processes
+        writing the same file, such as the other pre-forked workers, wait
+        for the commit instead of counting on from the same latest
+        revision"""
+        self.session.execute(BEGIN_IMMEDIATE)
+
+    def assign_revisions(self):
+        """On postgres, draw the revisions of the changes from
+        REVISION_SEQUENCE and store them on the rows written, right before
+        the commit. REVISION_LOCK_ID is held from here until the commit, so
+        revisions become visible in the order they were drawn and a reader
+        that has seen revision N never later sees a commit below N, while
+        the rest of the transaction runs alongside other writers."""
+        if not self.changes:
+            return
+        # Entries added through the session are only inserted on flush
+        self.session.flush()
+        self.session.execute(REVISION_LOCK_STATEMENT)
+        assigned = [self.session.execute(statement) for statement in self._revision_updates()]
+        draw = self._draw_query()
+        drawn = self.session.execute(draw).scalars().all() if draw is not None else ()
+        self._apply_revisions(assigned, drawn)
+
+    def _revision_updates(self) -> list:
+        """Statements storing newly drawn revisions on the rows written,
+        returning them by (key, resource_type)"""
+        table = KeyValue.__table__
+        written = sorted({(c.key, c.resource_type) for c in self.changes if c.type is not ChangeType.deleted})
+        # Leaves updated alone, as an entry whose updated equals created is
+        # one that was added
+        return [table.update()
+                .where(tuple_(table.c.key, table.c.resource_type).in_(batch))
+                .values(revision=REVISION_SEQUENCE.next_value(), updated=table.c.updated)
+                .returning(table.c.key, table.c.resource_type, table.c.revision)
+                for batch in batched(written, DEFAULT_BATCH_SIZE)]
+
+    def _draw_query(self):
+        """The query drawing a revision for every delete, which has no row
+        to store it on, or None without deletes"""
+        deleted = sum(c.type is ChangeType.deleted for c in self.changes)
+        if not deleted:
+            return None
+        return select(REVISION_SEQUENCE.next_value()).select_from(func.generate_series(1, deleted))
+
+    def _apply_revisions(self, assigned: Iterable[Iterable[tuple]], drawn: Iterable[int]):
+        revisions = {(key, resource_type): revision
+                     for rows in assigned for key, resource_type, revision in rows}
+        drawn = iter(drawn)
+        self.changes = [c._replace(revision=next(drawn) if c.type is ChangeType.deleted
+                                   else revisions[c.key, c.resource_type])
+                        for c in self.changes]
+
+    def revision_of(self, key: str, resource_type: str) -> int:
+        """The revision written under `key` once the transaction committed"""
+        if self._revisions is None:
+            self._revisions = {(c.key, c.resource_type): c.revision for c in self.changes}
+        return self._revisions[key, resource_type]
+
+    def add(self, entry: KeyValue, revision: int):
+        """Add the new `entry` to the session as written at `revision`"""
+        entry.revision = revision
+        self.session.add(entry)
+        self.changed(ChangeType.added, entry.key, entry.resource_type, revision)
+
+    def inserts(self, rows: List[dict], revisions: List[int], batch_size: int) -> list:
+        """The multi-row inserts of `rows`, as written at `revisions`"""
+        for row, revision in zip(rows, revisions):
+            row['revision'] = revision
+            self.changed(ChangeType.added, row['key'], row['resource_type'], revision)
+        table = KeyValue.__table__
+        return [table.insert().values(batch)
+                for batch in batched(rows, insert_batch_size(self.dialect, batch_size, rows[0]))]
+
+    def upserts(self, rows: List[dict], revisions: List[int], batch_size: int) -> list:
+        """The multi-row upserts of `rows`, as written at `revisions`. On
+        postgres they return the UPSERTED_COLUMNS of the entries they
+        leave, elsewhere :meth:`upserted_queries` reads them back."""
+        for row, revision in zip(rows, revisions):
+            row['revision'] = revision
+        statements = [upsert_statement(self.dialect, batch)
+                      for batch in batched(rows, insert_batch_size(self.dialect, batch_size, rows[0]))]
+        if self.postgres:
+            statements = [statement.returning(*UPSERTED_COLUMNS) for statement in statements]
+        return statements
+
+    def upserted_queries(self, rows: List[dict]) -> list:
+        # No RETURNING here, but the write lock keeps the entries as
+        # written until the transaction ends
+        if self.postgres:
+            return []
+        return [select(*UPSERTED_COLUMNS).where(KeyValue.key.in_(keys))
+                for keys in batched([row['key'] for row in rows], SQLITE_MAX_VARIABLES)]
+
+    def record_upserts(self, rows: List[dict], entries: dict):
+        """Record the changes of upserting `rows`, given the entries they
+        left by key"""
+        # An update keeps the creation time, see changed_since
+        for row in rows:
+            entry = entries[row['key']]
+            self.changed(ChangeType.added if entry.created == entry.updated else ChangeType.updated,
+                         row['key'], row['resource_type'], row['revision'])
+
+    def record_deletes(self):
+        """Leave a tombstone for every entry deleted, so that a change feed
+        resuming from an earlier revision learns of it"""
+        for statement in self._tombstone_inserts():
+            self.session.execute(statement)
+
+    def _tombstone_inserts(self) -> list:
+        tombstones = tombstone_rows(self.changes)
+        if not tombstones:
+            return []
+        batch_size = insert_batch_size(self.dialect, DEFAULT_BATCH_SIZE, tombstones[0])
+        return [TOMBSTONE_TABLE.insert().values(batch) for batch in batched(tombstones, batch_size)]
+
+    def notify(self):
+        for statement in self._notifications():
+            self.session.execute(statement)
+
+    def _notifications(self) -> list:
+        return [select(func.pg_notify(CHANNEL, payload)) for payload in encode_changes(self.changes)]
+
+
+class Storage(object):
+    def __init__(self, session_factory, page_size=DEFAULT_PAGE_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE, envelope_format=EnvelopeFormat.json,
+                 changes: ChangeHub=None):
+        # type: (SessionFactory, int, int, EnvelopeFormat, ChangeHub) -> None
+        self.session_factory = session_factory
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.envelope_format = envelope_format
+        self.changes = changes
+        self._write_lock = threading.Lock()
+        self._last_revision = 0
+
+    @contextlib.contextmanager
+    def _write(self, existing_session: Session=None) -> Iterator[Write]:
+        """Run a write transaction whose changes are announced once it
+        commits: with NOTIFY inside the transaction on postgres, otherwise
+        by publishing to `changes` after the commit."""
+        with self.session_factory.create_context(existing_session) as session:
+            dialect = session.get_bind().dialect
+            postgres = dialect.name == 'postgresql'
+            with contextlib.nullcontext() if postgres else self._write_lock:
+                write = Write(session, dialect, self._last_revision)
+                with session.begin():
+                    if not postgres:
+                        write.begin_immediate()
+                    yield write
+                    if postgres:
+                        write.assign_revisions()
+                    write.record_deletes()
+                    if postgres:
+                        write.notify()
+                if not postgres:
+                    self._last_revision = write.last_revision
+                    if self.changes is not None:
+                        self.changes.publish(write.changes)
+
+    def put(self, message: google.protobuf.message.Message, key: str=None,
+            existing_session: Session=None) -> KeyValue:
+        """Store `message` under `key`, by default a new time ordered key
+        for its type."""
+
+        entry = new_entry(message, key, self.envelope_format)
+        with self._write(existing_session) as write:
+            write.add(entry, *write.revisions(1))
+
+        set_committed_value(entry, 'revision', write.revision_of(entry.key, entry.resource_type))
         return entry
 
-    def get(self, key: str, message, existing_session: Session=None) -> Optional[Message]:
+    def put_many(self, messages: Iterable[google.protobuf.message.Message],
+                 existing_session: Session=None) -> List[str]:
+        """Store every message in a single transaction using multi-row
+        inserts of up to `batch_size` rows each. Returns the generated keys
+        in the order of `messages`."""
+        rows = rows_for(list(messages), self.envelope_format)
+        if not rows:
+            return []
+
+        with self._write(existing_session) as write:
+            self._insert(write, rows)
+
+        return [row['key'] for row in rows]
+
+    def _insert(self, write: Write, rows: List[dict]):
+        for statement in write.inserts(rows, write.revisions(len(rows)), self.batch_size):
+            write.session.execute(statement)
+
+    def upsert(self, message: google.protobuf.message.Message, key: str,
+               existing_session: Session=None) -> Revision:
+        """Store `message` under `key`, replacing whatever is stored there,
+        with a single INSERT ... ON CONFLICT DO UPDATE and no read first.
+        Returns the message as stored, with its resource tag, and whether
+        the entry was added rather than updated."""
+        revision, = self.upsert_many([(message, key)], existing_session)
+        return revision
+
+    def upsert_many(self, items: Iterable[Tuple[google.protobuf.message.Message, str]],
+                    existing_session: Session=None) -> List[Revision]:
+        """:meth:`upsert` every (message, key) pair in a single transaction,
+        with multi-row statements of up to `batch_size` rows each. Returns
+        their revisions in the order of `items`.
+
+        When a key comes up more than once its last message is the one
+        stored, and only the first of them can count as added.
+        """
+        items = list(items)
+        if not items:
+            return []
+
+        with self._write(existing_session) as write:
+            entries = self._upsert(write, items)
+        return upserted(write, items, entries)
+
+    def _upsert(self, write: Write, items: List[Tuple[Message, str]]) -> dict:
+        """Write the upserts of `items`, returning the entries they left by
+        key. Their revisions are known once `write` committed."""
+        rows = upsert_rows(items, self.envelope_format)
+        entries = {}
+        for statement in write.upserts(rows, write.revisions(len(rows)), self.batch_size):
+            result = write.session.execute(statement)
+            if result.returns_rows:
+                entries.update((entry.key, entry) for entry in result)
+        for query in write.upserted_queries(rows):
+            entries.update((entry.key, entry) for entry in write.session.execute(query))
+        write.record_upserts(rows, entries)
+        return entries
+
+    def write_group(self, puts: List[Tuple[google.protobuf.message.Message, Optional[str]]],
+                    upserts: List[Tuple[google.protobuf.message.Message, str]],
+                    existing_session: Session=None) -> Tuple[List[KeyValue], List[Revision]]:
+        """:meth:`put` and :meth:`upsert` many messages in one transaction.
+        Returns the entries put, detached and in the order of `puts`, and
+        the revisions upserted in the order of `upserts`."""
+        rows = rows_for([message for message, _ in puts], self.envelope_format)
+        for row, (_, key) in zip(rows, puts):
+            if key:
+                row['key'] = key
+
+        entries = {}
+        with self._write(existing_session) as write:
+            if rows:
+                self._insert(write, rows)
+            if upserts:
+                entries = self._upsert(write, upserts)
+
+        for row in rows:
+            row['revision'] = write.revision_of(row['key'], row['resource_type'])
+        return [KeyValue(**row) for row in rows], upserted(write, upserts, entries)
+
+    def delete(self, key: str, Message, existing_session: Session=None) -> bool:
+        """Remove the `Message` entry stored under `key`; False if there
+        was none"""
+        resource_type = prefix_for(Message)
+        with self._write(existing_session) as write:
+            if write.session.execute(entry_lock_query(key, resource_type)).first() is None:
+                return False
+            revision, = write.revisions(1)
+            write.session.execute(delete_statement(key, resource_type))
+            write.changed(ChangeType.deleted, key, resource_type, revision)
+        return True
+
+    def get(self, key: str, Message, existing_session: Session=None) -> Optional[Message]:
 
         with self.session_factory.create_context(existing_session) as session:
-            entry = session.query(KeyValue).filter(KeyValue.key == key).first()
+            entry = session.execute(entry_query(key, Message)).first()
 
         if entry is None:
             return None
 
-        return entry.value.UnPack(message)
+        return unpack_entry(Message, entry)
+
+    def page(self, Message, after_key: str=None, page_size: int=None, owner: str=None,
+             existing_session: Session=None) -> Page:
+        """Return at most `page_size` messages of type `Message` ordered by
+        key, starting after `after_key`, optionally only those of `owner`.
+
+        Uses keyset pagination over the (resource_type, key) index so the cost
+        of a page depends on the page size, not on the size of the table or
+        how deep into the listing it is.
+        """
+        page_size = page_size or self.page_size
+        check_argument(page_size > 0, 'page_size must be positive, got {}', page_size)
+
+        with self.session_factory.create_context(existing_session) as session:
+            entries = session.execute(page_query(Message, after_key, page_size, owner)).all()
+
+        messages = [unpack_entry(Message, e) for e in entries]
+        return Page(messages, next_key_for(entries, page_size))
 
-    def all(self, Message, existing_session: Session=None) -> List[Message]:
-        prefix = prefix_for(Message)
+    def iter(self, Message, page_size: int=None, owner: str=None,
+             existing_session: Session=None) -> Iterator[Message]:
+        """Lazily yield every message of type `Message`, fetching one page
+        at a time so memory stays bounded by the page size."""
         with self.session_factory.create_context(existing_session) as session:
-            entries = session.query(KeyValue).filter(KeyValue.key.startswith(prefix)).all()
+            after_key = None
+            while True:
+                page = self.page(Message, after_key, page_size, owner, existing_session=session)
+                yield from page.messages
+                if page.next_key is None:
+                    break
+                after_key = page.next_key
 
-        def unpack(entry):
-            message = Message()
-            entry.value.Unpack(message)
-            message.tags.append(str(entry.uuid))
-            return message
+    def all(self, Message, owner: str=None, existing_session: Session=None) -> List[Message]:
+        return list(self.iter(Message, owner=owner, existing_session=existing_session))
+
+    def keys(self, Message, page_size: int=None, owner: str=None,
+             existing_session: Session=None) -> Iterator[str]:
+        """Lazily yield the keys of every `Message` entry without loading or
+        decoding any other column."""
+        page_size = page_size or self.page_size
+        with self.session_factory.create_context(existing_session) as session:
+            after_key = None
+            while True:
+                keys = session.execute(keys_query(Message, after_key, page_size, owner)).scalars().all()
+                yield from keys
+                if len(keys) < page_size:
+                    break
+                after_key = keys[-1]
 
-        return [unpack(e) for e in entries]
+    def changed_since(self, Message, after_revision: int=0, page_size: int=None, owner: str=None,
+                      existing_session: Session=None) -> Iterator[Revision]:
+        """Lazily yield every `Message` written after `after_revision` in
+        revision order, a page at a time. A message written again while
+        this runs may be yielded twice, never skipped."""
+        page_size = page_size or self.page_size
+        with self.session_factory.create_context(existing_session) as session:
+            while True:
+                entries = session.execute(changed_query(Message, after_revision, page_size, owner)).all()
+                for entry in entries:
+                    yield revision_for(Message, entry)
+                if len(entries) < page_size:
+                    break
+                after_revision = entries[-1].revision
+
+    def deleted_since(self, Message, after_revision: int=0, page_size: int=None,
+                      existing_session: Session=None) -> Iterator[Tombstone]:
+        """Lazily yield a tombstone for every `Message` entry deleted after
+        `after_revision` in revision order, a page at a time. Tombstones are
+        kept, one small row per delete, so that a change feed can resume
+        from any revision."""
+        page_size = page_size or self.page_size
+        with self.session_factory.create_context(existing_session) as session:
+            while True:
+                tombstones = session.execute(tombstone_query(Message, after_revision, page_size)).all()
+                for key, revision in tombstones:
+                    yield Tombstone(key, revision)
+                if len(tombstones) < page_size:
+                    break
+                after_revision = tombstones[-1].revision
+
+    def count(self, Message, owner: str=None, existing_session: Session=None) -> int:
+        with self.session_factory.create_context(existing_session) as session:
+            return session.execute(count_query(Message, owner)).scalar()
+
+    def migrate_envelopes(self, batch_size: int=None, existing_session: Session=None) -> int:
+        """Rewrite rows still holding a JSON envelope into the binary column,
+        one committed batch at a time. Safe to run while the service is up
+        and to interrupt; returns the number of rows converted."""
+        batch_size = batch_size or self.batch_size
+        migrated = 0
+        with self.session_factory.create_context(existing_session) as session:
+            while True:
+                with session.begin():
+                    entries = session.query(KeyValue) \
+                        .filter(KeyValue.value_bin.is_(None)) \
+                        .filter(KeyValue.value.isnot(None)) \
+                        .order_by(KeyValue.key) \
+                        .limit(batch_size) \
+                        .with_for_update(skip_locked=True) \
+                        .all()
+                    for entry in entries:
+                        entry.value_bin = entry.value
+                        entry.value = None
+                migrated += len(entries)
+                if len(entries) < batch_size:
+                    return migrated
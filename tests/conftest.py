@@ -0,0 +1,16 @@
+import pytest
+
+from bifrost.const import MEMORY_URI
+from server import load_config
+
+
+@pytest.fixture
+def config(tmp_path):
+    """The server config on in-memory storage, with a client config file
+    and no client binary under `tmp_path`"""
+    path = tmp_path / 'ngrok.yml'
+    path.write_text('server_addr: tunnel.bifrost.valhalla:4443\n')
+    config = load_config()
+    return config._replace(DATABASE_URI=MEMORY_URI,
+                           client_config=config.client_config._replace(PATH=str(path)),
+                           client_binary=config.client_binary._replace(PATH=str(tmp_path / 'ngrok')))
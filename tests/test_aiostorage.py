@@ -0,0 +1,38 @@
+import asyncio
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from bifrost.aiostorage import AsyncSessionFactory, AsyncStorage, async_database_uri
+from bifrost.schema import ensure_schema_async
+from bifrost.storage import SessionFactory, Storage
+from bifrostv1.bifrost_pb2 import Endpoint
+
+
+def test_async_and_sync_storages_write_the_same_entries(tmp_path):
+    uri = f'sqlite:///{tmp_path}/parity.db'
+    storage = Storage(SessionFactory(create_engine(uri)), page_size=2)
+
+    async def write():
+        engine = create_async_engine(async_database_uri(uri))
+        await ensure_schema_async(engine)
+        async_storage = AsyncStorage(AsyncSessionFactory(engine), page_size=2)
+        entry = await async_storage.put(Endpoint(owner='alice', name='web'))
+        keys = await async_storage.put_many([Endpoint(owner='alice', name=f'api-{i}') for i in range(3)])
+        added = await async_storage.upsert(Endpoint(owner='bob', name='web'), 'endpoint-bob/web')
+        updated = await async_storage.upsert(Endpoint(owner='bob', name='www'), 'endpoint-bob/web')
+        assert await async_storage.delete(keys[0], Endpoint)
+        changed = [(r.message.name, r.revision, r.added) async for r in async_storage.changed_since(Endpoint)]
+        deleted = [t async for t in async_storage.deleted_since(Endpoint)]
+        listed = [key async for key in async_storage.keys(Endpoint)]
+        await engine.dispose()
+        return entry, keys, added, updated, changed, deleted, listed
+
+    entry, keys, added, updated, changed, deleted, listed = asyncio.run(write())
+
+    assert (entry.revision, added.revision, added.added, updated.revision, updated.added) == (1, 5, True, 6, False)
+    assert changed == [('web', 1, True), ('api-1', 3, True), ('api-2', 4, True), ('www', 6, False)]
+    assert [(r.message.name, r.revision, r.added) for r in storage.changed_since(Endpoint)] == changed
+    assert list(storage.deleted_since(Endpoint)) == deleted
+    assert [t.key for t in deleted] == keys[:1]
+    assert list(storage.keys(Endpoint)) == listed
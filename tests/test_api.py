@@ -0,0 +1,70 @@
+import grpc
+import pytest
+
+from bifrost.api import BifrostAPI
+from bifrost.service import BifrostServiceFactory
+from bifrostv1.bifrost_pb2 import ProxyClientBinaryInfoRequest, StreamProxyClientBinaryRequest
+
+
+class Aborted(Exception):
+    pass
+
+
+class Context(object):
+    """Records the status of an aborted RPC, raising like grpc does"""
+
+    def __init__(self):
+        self.code = None
+        self.details = None
+
+    def abort(self, code, details):
+        self.code, self.details = code, details
+        raise Aborted(details)
+
+    def add_callback(self, callback):
+        pass
+
+
+@pytest.fixture
+def api(config):
+    service = BifrostServiceFactory.create(config._replace(metrics=config.metrics._replace(ENABLED=False)))
+    yield BifrostAPI(service=service)
+    service.close()
+
+
+def test_a_missing_client_binary_is_not_found(api):
+    context = Context()
+    with pytest.raises(Aborted):
+        api.GetProxyClientBinaryInfo(ProxyClientBinaryInfoRequest(), context)
+    assert context.code is grpc.StatusCode.NOT_FOUND
+
+    context = Context()
+    with pytest.raises(Aborted):
+        list(api.StreamProxyClientBinary(StreamProxyClientBinaryRequest(), context))
+    assert context.code is grpc.StatusCode.NOT_FOUND
+    assert 'no client binary' in context.details
+
+
+def test_client_binary_downloads_resume_at_an_offset(config):
+    data = bytes(range(256)) * 16
+    with open(config.client_binary.PATH, 'wb') as f:
+        f.write(data)
+    config = config._replace(metrics=config.metrics._replace(ENABLED=False),
+                             client_binary=config.client_binary._replace(CHUNK_SIZE=1000, ENCODINGS=()))
+    service = BifrostServiceFactory.create(config)
+    api = BifrostAPI(service=service)
+    try:
+        parts = list(api.StreamProxyClientBinary(StreamProxyClientBinaryRequest(offset=1500), Context()))
+        at_end = list(api.StreamProxyClientBinary(StreamProxyClientBinaryRequest(offset=len(data)), Context()))
+        context = Context()
+        with pytest.raises(Aborted):
+            list(api.StreamProxyClientBinary(StreamProxyClientBinaryRequest(offset=len(data) + 1), context))
+    finally:
+        service.close()
+
+    assert [(p.offset, len(p.chunk)) for p in parts] == [(1500, 1000), (2500, 1000), (3500, 596)]
+    assert b''.join(p.chunk for p in parts) == data[1500:]
+    # Only the first part carries the digest and size
+    assert parts[0].total_size == len(data) and not parts[1].sha256
+    assert [(p.offset, p.chunk, p.total_size) for p in at_end] == [(len(data), b'', len(data))]
+    assert context.code is grpc.StatusCode.OUT_OF_RANGE
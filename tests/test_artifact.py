@@ -0,0 +1,67 @@
+import hashlib
+
+import pytest
+
+from bifrost.artifact import IDENTITY, ClientBinary, InvalidRangeError, available_encodings, decoder_for, \
+    encoded_path, precompress
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def binary(tmp_path):
+    path = tmp_path / 'ngrok'
+    path.write_bytes(DATA)
+    binary = ClientBinary(path, encodings=())
+    yield binary
+    binary.close()
+
+
+def test_chunks_resume_from_any_offset(binary):
+    assert (binary.size, binary.sha256) == (len(DATA), hashlib.sha256(DATA).hexdigest())
+    assert b''.join(binary.iter_chunks(chunk_size=1000)) == DATA
+    assert [len(c) for c in binary.iter_chunks(9000, chunk_size=1000)] == [1000, 240]
+    assert b''.join(binary.iter_chunks(4321, chunk_size=1000)) == DATA[4321:]
+    assert list(binary.iter_chunks(len(DATA))) == []
+
+
+def test_ranges_outside_of_the_binary_are_refused_up_front(binary):
+    with pytest.raises(InvalidRangeError):
+        binary.iter_chunks(len(DATA) + 1)
+    with pytest.raises(InvalidRangeError):
+        binary.iter_chunks(-1)
+    assert binary.encodings == (IDENTITY,)
+
+
+def test_encodings_are_negotiated_in_the_order_the_client_prefers(tmp_path):
+    path = tmp_path / 'ngrok'
+    path.write_bytes(DATA)
+    written = precompress(path, ('zstd', 'gzip'))
+    sha256 = hashlib.sha256(DATA).hexdigest()
+    assert written == [encoded_path(path, sha256, encoding) for encoding in available_encodings()]
+    assert precompress(path) == []
+
+    binary = ClientBinary(path)
+    try:
+        assert binary.encodings == (IDENTITY,) + available_encodings()
+        assert binary.choose_encoding(['br', 'gzip']) == 'gzip'
+        assert binary.choose_encoding(['br']) == IDENTITY
+        for encoding in binary.encodings:
+            # A download resumed part way decodes to the same bytes
+            encoded = b''.join(binary.iter_chunks(chunk_size=100, encoding=encoding))
+            resumed = encoded[:50] + b''.join(binary.iter_chunks(50, chunk_size=100, encoding=encoding))
+            decoder = decoder_for(encoding)
+            assert decoder.decompress(resumed) + decoder.flush() == DATA
+            assert binary.encoded_size(encoding) == len(encoded)
+    finally:
+        binary.close()
+
+
+def test_forms_of_an_older_binary_are_replaced(tmp_path):
+    path = tmp_path / 'ngrok'
+    path.write_bytes(DATA)
+    old, = precompress(path, ('gzip',))
+    path.write_bytes(DATA[::-1])
+    new, = precompress(path, ('gzip',))
+
+    assert not old.exists() and new.exists() and new != old
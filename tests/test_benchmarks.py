@@ -0,0 +1,30 @@
+import io
+
+import pytest
+
+from benchmarks import envelope, ids, storage, streaming  # noqa: F401 -- registers the benchmarks
+from benchmarks.harness import compare, flatten, load_results, registered, run, save_results
+
+
+@pytest.mark.parametrize('prefix', ['envelope', 'ids.', 'storage.', 'streaming.'])
+def test_the_benchmarks_run_at_a_tiny_size(prefix, tmp_path):
+    benchmarks = registered([prefix])
+    results = run(benchmarks, sizes=[1], log=io.StringIO())
+    assert [r['name'] for r in results] == [b.name for b in benchmarks]
+    for result in results:
+        metrics = dict(flatten(result['metrics']))
+        assert metrics and all(value >= 0 for value in metrics.values())
+
+    save_results(tmp_path / 'results.json', results)
+    baseline = load_results(tmp_path / 'results.json')
+    assert baseline['results'] == results
+    assert all(ratio == 1 for *_, before, after, ratio in compare(baseline, results) if before)
+
+
+def test_metrics_missing_from_the_baseline_have_no_ratio():
+    baseline = dict(results=[dict(name='ids.parse', size=10, metrics=dict(uuid=dict(seconds_per_op=2.0)))])
+    results = [dict(name='ids.parse', size=10, metrics=dict(uuid=dict(seconds_per_op=1.0), bytes=dict(seconds_per_op=3.0)))]
+    assert compare(baseline, results) == [
+        ('ids.parse', 10, 'uuid.seconds_per_op', 2.0, 1.0, 0.5),
+        ('ids.parse', 10, 'bytes.seconds_per_op', None, 3.0, None),
+    ]
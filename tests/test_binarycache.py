@@ -0,0 +1,45 @@
+import hashlib
+
+import pytest
+
+from bifrost.artifact import DigestMismatchError
+from bifrost.binarycache import BinaryCache
+
+BINARY = b'\x7fELF' + bytes(range(256)) * 64
+SHA256 = hashlib.sha256(BINARY).hexdigest()
+
+
+def writer(data):
+    downloads = []
+
+    def download(fileobj):
+        downloads.append(data)
+        fileobj.write(data)
+    return download, downloads
+
+
+def test_a_download_not_matching_the_digest_is_not_cached(tmp_path):
+    cache = BinaryCache(tmp_path)
+    corrupted = bytes([BINARY[0] ^ 1]) + BINARY[1:]
+    download, _ = writer(corrupted)
+
+    with pytest.raises(DigestMismatchError):
+        cache.fetch(SHA256, len(BINARY), download)
+    assert cache.lookup(SHA256, len(BINARY)) is None
+    assert [p.name for p in cache.path_for(SHA256).parent.iterdir()] == ['.lock']
+
+
+def test_hits_need_the_verified_digest_not_just_the_size(tmp_path):
+    cache = BinaryCache(tmp_path)
+    download, downloads = writer(BINARY)
+    path = cache.fetch(SHA256, len(BINARY), download)
+    assert cache.digest_path_for(SHA256).read_text() == f'{SHA256}  ngrok\n'
+    assert cache.fetch(SHA256, len(BINARY), download) == path
+    assert len(downloads) == 1
+
+    # Same size, other contents and no record, as a torn copy would be
+    path.write_bytes(bytes(len(BINARY)))
+    cache.digest_path_for(SHA256).unlink()
+    assert cache.lookup(SHA256, len(BINARY)) is None
+    assert cache.fetch(SHA256, len(BINARY), download).read_bytes() == BINARY
+    assert len(downloads) == 2
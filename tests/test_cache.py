@@ -0,0 +1,108 @@
+import pytest
+from sqlalchemy import create_engine
+
+from bifrost.cache import CachedStorage, CacheStats, LRUCache
+from bifrost.model import SQLAlchemyBaseModel
+from bifrost.service import endpoint_key
+from bifrost.storage import SessionFactory, Storage
+from bifrostv1.bifrost_pb2 import Endpoint, Proxy
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def storage(tmp_path, clock):
+    engine = create_engine(f'sqlite:///{tmp_path}/cache.db')
+    SQLAlchemyBaseModel.metadata.create_all(engine)
+    return CachedStorage(Storage(SessionFactory(engine)), LRUCache(clock=clock))
+
+
+def test_the_least_recently_used_entries_are_evicted_first(clock):
+    cache = LRUCache(max_size=3, clock=clock)
+    for key in 'abc':
+        cache.put(key, key.upper())
+    assert cache.get('a') == 'A'
+
+    cache.put('d', 'D')
+    assert cache.get('b', None) is None
+    assert [cache.get(key) for key in 'acd'] == ['A', 'C', 'D']
+
+    # Weighing two, it takes the place of the two least recently used
+    cache.put('e', 'E', weight=2)
+    assert [cache.get(key, None) for key in 'acde'] == [None, None, 'D', 'E']
+    # Heavier than the whole cache, it is not stored and evicts nothing
+    cache.put('f', 'F', weight=4)
+    assert cache.get('f', None) is None and cache.get('d') == 'D'
+    assert cache.stats() == CacheStats(hits=7, misses=4, evictions=3, size=3)
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = LRUCache(ttl=5, clock=clock)
+    cache.put('a', 'A')
+    clock.now = 4.9
+    assert cache.get('a') == 'A'
+    # Reading does not extend the ttl
+    clock.now = 5.0
+    assert cache.get('a', None) is None
+    assert cache.stats().size == 0
+
+    cache.put('a', 'A2')
+    clock.now = 9.9
+    assert cache.get('a') == 'A2'
+
+
+def test_cache_hits_are_of_the_requested_type(storage):
+    key = endpoint_key('alice', 'web')
+    storage.upsert(Endpoint(owner='alice', name='web'), key)
+
+    assert storage.get(key, Endpoint).name == 'web'
+    assert storage.get(key, Endpoint).name == 'web'
+    assert storage.stats().hits == 1
+    assert storage.get(key, Proxy) is None
+
+
+def test_writes_invalidate_every_type_read(storage):
+    key = endpoint_key('alice', 'web')
+    storage.upsert(Endpoint(owner='alice', name='web'), key)
+    assert storage.get(key, Endpoint).name == 'web'
+    assert storage.get(key, Proxy) is None
+
+    storage.delete(key, Endpoint)
+    storage.put(Proxy(user='alice'), key=key)
+    assert storage.get(key, Endpoint) is None
+    assert storage.get(key, Proxy).user == 'alice'
+
+
+def test_writes_to_a_type_invalidate_its_cached_pages(storage):
+    storage.upsert(Endpoint(owner='alice', name='web'), endpoint_key('alice', 'web'))
+    storage.upsert(Endpoint(owner='alice', name='api'), endpoint_key('alice', 'api'))
+
+    def names():
+        return [e.name for e in storage.page(Endpoint, page_size=10).messages]
+
+    assert names() == ['api', 'web']
+    assert names() == ['api', 'web']
+    assert storage.stats().hits == 1
+
+    # Writes to another type leave the page cached
+    storage.put(Proxy(user='alice'))
+    assert names() == ['api', 'web']
+    assert storage.stats().hits == 2
+
+    storage.put(Endpoint(owner='bob', name='www'), key=endpoint_key('bob', 'www'))
+    assert names() == ['api', 'web', 'www']
+    assert storage.delete(endpoint_key('alice', 'web'), Endpoint)
+    assert names() == ['api', 'www']
+    assert storage.stats().hits == 2
@@ -0,0 +1,71 @@
+import pytest
+from sqlalchemy import create_engine
+
+from bifrost.changefeed import ChangeHub, EventType, Watch
+from bifrost.memorystorage import MemoryStorage
+from bifrost.model import SQLAlchemyBaseModel
+from bifrost.service import endpoint_key
+from bifrost.storage import SessionFactory, Storage
+from bifrostv1.bifrost_pb2 import Endpoint
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def storage(request, tmp_path):
+    hub = ChangeHub()
+    if request.param == 'memory':
+        return MemoryStorage(changes=hub)
+    engine = create_engine(f'sqlite:///{tmp_path}/feed.db')
+    SQLAlchemyBaseModel.metadata.create_all(engine)
+    return Storage(SessionFactory(engine), changes=hub)
+
+
+def upsert(storage, name):
+    return storage.upsert(Endpoint(owner='alice', name=name), endpoint_key('alice', name))
+
+
+def until_synced(events):
+    seen = []
+    for event in events:
+        seen.append(event)
+        if event.type is EventType.synced:
+            return seen
+
+
+def test_deletes_are_watched(storage):
+    upsert(storage, 'web')
+    watch = Watch(storage, storage.changes, Endpoint, poll_interval=0.01)
+    events = iter(watch)
+    assert [e.type for e in until_synced(events)] == [EventType.snapshot, EventType.synced]
+
+    storage.delete(endpoint_key('alice', 'web'), Endpoint)
+    event = next(events)
+    watch.close()
+
+    assert event.type is EventType.deleted
+    assert event.key == endpoint_key('alice', 'web')
+    assert event.message is None
+
+
+def test_deletes_are_caught_up_after_a_reconnect(storage):
+    upsert(storage, 'web')
+    upsert(storage, 'api')
+    watch = Watch(storage, storage.changes, Endpoint)
+    revision = until_synced(iter(watch))[-1].revision
+    watch.close()
+
+    # While the watcher is away
+    storage.delete(endpoint_key('alice', 'web'), Endpoint)
+    upsert(storage, 'api')
+    upsert(storage, 'web')
+
+    watch = Watch(storage, storage.changes, Endpoint, since_revision=revision)
+    events = until_synced(iter(watch))
+    watch.close()
+
+    assert [(e.type, e.key or e.message.name) for e in events[:-1]] == [
+        (EventType.deleted, endpoint_key('alice', 'web')),
+        (EventType.updated, 'api'),
+        (EventType.added, 'web'),
+    ]
+    revisions = [e.revision for e in events]
+    assert revisions == sorted(revisions) and revisions[0] > revision
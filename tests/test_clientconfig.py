@@ -0,0 +1,21 @@
+import pytest
+
+from bifrost.clientconfig import ClientConfigSource, InvalidSubdomainError
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'ngrok.yml'
+    path.write_text('server_addr: tunnel.bifrost.valhalla:4443\n')
+    return ClientConfigSource(str(path))
+
+
+def test_subdomains_are_lower_cased(source):
+    rendered = source.render('My-Tunnel')
+    assert rendered.proxy_uri == 'http://my-tunnel.bifrost.valhalla:4480'
+
+
+@pytest.mark.parametrize('subdomain', ['web\n', 'web.api', '-web', 'web-', 'w' * 64, 'web: x'])
+def test_invalid_subdomains_are_rejected(source, subdomain):
+    with pytest.raises(InvalidSubdomainError):
+        source.render(subdomain)
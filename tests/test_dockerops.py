@@ -0,0 +1,100 @@
+import queue
+import threading
+
+import pytest
+
+from bifrost.dockerops import ContainerIndex, DockerBusyError, DockerExecutor, DockerTimeoutError
+
+
+def test_calls_beyond_the_pending_limit_fail_at_once():
+    release = threading.Event()
+    executor = DockerExecutor(client='docker', max_workers=1, max_pending=2, timeout=0.05)
+    try:
+        with pytest.raises(DockerTimeoutError):
+            executor.call(lambda client: release.wait(5))
+        queued = executor.submit(lambda client: client)
+        assert executor.pending() == 2
+        with pytest.raises(DockerBusyError):
+            executor.submit(lambda client: client)
+
+        release.set()
+        assert queued.result(5) == 'docker'
+        assert executor.call(lambda client, name: f'{client} {name}', 'ps') == 'docker ps'
+        assert executor.pending() == 0
+    finally:
+        executor.shutdown()
+
+
+def attrs(container_id, status='running'):
+    return dict(Id=container_id, Name=f'/{container_id}', State=dict(Status=status),
+                Config=dict(Labels={'bifrost.pool': 'ngrokd'}),
+                NetworkSettings=dict(Ports={'4443/tcp': [dict(HostIp='127.0.0.1', HostPort='32768')]}))
+
+
+class Events(object):
+    """A Docker events stream fed from a queue"""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def __iter__(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        self.queue.put(None)
+
+
+class API(object):
+    """The low level Docker API over `state`, the inspect output of each container by id"""
+
+    def __init__(self, state):
+        self.state = state
+
+    def containers(self, all, filters):
+        return [dict(Id=container_id) for container_id in self.state]
+
+    def inspect_container(self, container_id):
+        import docker.errors
+
+        if container_id not in self.state:
+            raise docker.errors.NotFound(container_id)
+        return self.state[container_id]
+
+
+class Docker(object):
+
+    def __init__(self, state):
+        self.api = API(state)
+        self.stream = Events()
+
+    def events(self, decode, filters):
+        return self.stream
+
+
+def test_the_index_follows_container_events():
+    pytest.importorskip('docker')
+    state = {'a': attrs('a'), 'b': attrs('b', 'exited')}
+    client = Docker(state)
+    changes = queue.Queue()
+    index = ContainerIndex(client, 'bifrost.pool')
+    index.add_listener(lambda container_id, container: changes.put((container_id, container and container.status)))
+    index.start()
+    try:
+        assert index.wait_synced(5)
+        assert index.get('a').ports == {'4443/tcp': '32768'}
+        assert {c.id for c in index.containers({'bifrost.pool': 'ngrokd'})} == {'a', 'b'}
+
+        state['a'] = attrs('a', 'exited')
+        client.stream.queue.put(dict(id='a', Action='die'))
+        del state['b']
+        client.stream.queue.put(dict(Actor=dict(ID='b'), Action='destroy'))
+        seen = [changes.get(timeout=5) for _ in range(4)]
+    finally:
+        index.stop()
+
+    assert seen[2:] == [('a', 'exited'), ('b', None)]
+    assert index.get('a').status == 'exited' and index.get('b') is None and len(index) == 1
@@ -0,0 +1,125 @@
+import hashlib
+import random
+
+import grpc
+import pytest
+
+# Generated with the protos by `make compile`
+pytest.importorskip('bifrostv1.client')
+
+from bifrost import externalproxytunnel
+from bifrost.api import BifrostAPI
+from bifrost.artifact import DigestMismatchError
+from bifrost.externalproxytunnel import ExternalProxyTunnel, TunnelNotReadyError
+from bifrost.service import BifrostServiceFactory
+
+# Compressible, but not into a single part
+BINARY = random.Random(0).randbytes(4096) + b'ngrok client ' * 4096
+
+
+class Interrupted(grpc.RpcError):
+    pass
+
+
+class Client(object):
+    """Serves the client binary RPCs from a BifrostAPI, breaking off the
+    first `interruptions` downloads after their first part"""
+
+    def __init__(self, host, port):
+        self.api = None
+        self.interruptions = 0
+        self.requests = []
+
+    def get_proxy_client_binary_info(self, request):
+        return self.api.GetProxyClientBinaryInfo(request, None)
+
+    def stream_proxy_client_binary(self, request):
+        self.requests.append(request)
+        for i, part in enumerate(self.api.StreamProxyClientBinary(request, None)):
+            if i == 1 and self.interruptions:
+                self.interruptions -= 1
+                raise Interrupted()
+            yield part
+
+
+@pytest.fixture
+def tunnel(monkeypatch, tmp_path):
+    monkeypatch.setattr(externalproxytunnel, 'BifrostClient', Client)
+    return ExternalProxyTunnel('web', cache_dir=tmp_path, ready_timeout=0.2,
+                               initial_backoff=0.01, max_backoff=0.05)
+
+
+def polls(monkeypatch, answers, alive=True):
+    """Make the tunnel come up on the poll answering True"""
+    answers = iter(answers)
+    polled = []
+
+    def tunnel_is_up(proxy_uri, timeout):
+        polled.append(timeout)
+        return next(answers, False)
+    monkeypatch.setattr(externalproxytunnel, 'tunnel_is_up', tunnel_is_up)
+    monkeypatch.setattr(ExternalProxyTunnel, '_session_is_alive', lambda self: alive)
+    return polled
+
+
+def test_the_tunnel_is_ready_once_it_forwards(tunnel, monkeypatch):
+    polled = polls(monkeypatch, [False, False, True])
+    tunnel._wait_until_ready('http://web.bifrost.valhalla', externalproxytunnel.time.monotonic())
+    assert len(polled) == 3
+
+
+def test_a_tunnel_that_never_comes_up_times_out(tunnel, monkeypatch):
+    polled = polls(monkeypatch, [])
+    started = externalproxytunnel.time.monotonic()
+    with pytest.raises(TunnelNotReadyError, match='not ready after 0.2 seconds'):
+        tunnel._wait_until_ready('http://web.bifrost.valhalla', started)
+
+    assert externalproxytunnel.time.monotonic() - started < 0.5
+    # Backs off instead of polling in a tight loop
+    assert 3 < len(polled) < 20
+
+
+def test_a_client_that_exits_fails_at_once(tunnel, monkeypatch):
+    polled = polls(monkeypatch, [], alive=False)
+    with pytest.raises(TunnelNotReadyError, match='exited'):
+        tunnel._wait_until_ready('http://web.bifrost.valhalla', externalproxytunnel.time.monotonic())
+    assert len(polled) == 1
+
+
+@pytest.fixture
+def api(config):
+    with open(config.client_binary.PATH, 'wb') as f:
+        f.write(BINARY)
+    config = config._replace(metrics=config.metrics._replace(ENABLED=False),
+                             client_binary=config.client_binary._replace(CHUNK_SIZE=512, ENCODINGS=('gzip',)))
+    service = BifrostServiceFactory.create(config)
+    yield BifrostAPI(service=service)
+    service.close()
+
+
+def test_client_binaries_are_downloaded_once_and_cached(tunnel, api):
+    tunnel.client.api = api
+    path = tunnel.client_binary()
+    assert path.read_bytes() == BINARY
+    assert tunnel.client_binary() == path
+    assert len(tunnel.client.requests) == 1
+
+
+def test_a_download_not_matching_the_advertised_digest_is_not_cached(tunnel, api):
+    tunnel.client.api = api
+    digest = hashlib.sha256(b'another build').hexdigest()
+    with pytest.raises(DigestMismatchError):
+        tunnel.binary_cache.fetch(digest, len(BINARY),
+                                  lambda fileobj: tunnel._download_client_binary(fileobj, digest, len(BINARY)))
+    assert tunnel.binary_cache.lookup(digest, len(BINARY)) is None
+
+
+def test_interrupted_downloads_resume_in_the_same_encoding(tunnel, api):
+    tunnel.client.api = api
+    tunnel.client.interruptions = 1
+    path = tunnel.client_binary()
+
+    assert path.read_bytes() == BINARY
+    first, resumed = tunnel.client.requests
+    assert first.offset == 0 and 'gzip' in first.accept_encoding
+    assert resumed.offset == 512 and list(resumed.accept_encoding) == ['gzip']
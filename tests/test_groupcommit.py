@@ -0,0 +1,205 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+
+from bifrost.groupcommit import GroupCommitError, GroupCommitStats, GroupCommitStorage
+from bifrost.model import SQLAlchemyBaseModel
+from bifrost.storage import SessionFactory, Storage
+from bifrostv1.bifrost_pb2 import Endpoint
+
+
+class WriterKilled(BaseException):
+    pass
+
+
+class KillingStorage(Storage):
+    """Kills the writer thread in the first group it commits, once
+    released"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.committing = threading.Event()
+        self.release = threading.Event()
+
+    def write_group(self, puts, upserts, existing_session=None):
+        self.committing.set()
+        self.release.wait(5)
+        raise WriterKilled()
+
+
+class GatedStorage(Storage):
+    """Records the size of every group written, holding the first one
+    until released so that the writes after it queue up"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.committing = threading.Event()
+        self.release = threading.Event()
+        self.groups = []
+
+    def write_group(self, puts, upserts, existing_session=None):
+        self.groups.append(len(puts) + len(upserts))
+        self.committing.set()
+        self.release.wait(5)
+        return super().write_group(puts, upserts, existing_session=existing_session)
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/group.db', connect_args=dict(check_same_thread=False))
+    SQLAlchemyBaseModel.metadata.create_all(engine)
+    return SessionFactory(engine)
+
+
+@pytest.fixture
+def storage(session_factory):
+    return KillingStorage(session_factory)
+
+
+@pytest.fixture
+def gated(session_factory):
+    return GatedStorage(session_factory)
+
+
+def until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def in_thread(write, name, errors, results=None):
+    def run():
+        try:
+            result = write(name)
+            if results is not None:
+                results[name] = result
+        except BaseException as e:
+            errors[name] = e
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def put_in_thread(storage, name, errors, results=None):
+    return in_thread(lambda name: storage.put(Endpoint(owner='alice', name=name)), name, errors, results)
+
+
+def test_concurrent_writes_share_transactions(gated):
+    group = GroupCommitStorage(gated, interval=0, max_batch=64).start()
+    errors, results, read = {}, {}, {}
+
+    def put_and_read(name):
+        entry = group.put(Endpoint(owner='alice', name=name))
+        # Readable as soon as the call returns
+        read[name] = gated.get(entry.key, Endpoint)
+        return entry
+
+    def upsert_and_read(name):
+        revision = group.upsert(Endpoint(owner='bob', name=name), f'endpoint-bob/{name}')
+        read[name] = gated.get(f'endpoint-bob/{name}', Endpoint)
+        return revision
+
+    first = in_thread(put_and_read, 'first', errors, results)
+    assert gated.committing.wait(5)
+    threads = [in_thread(put_and_read, f'put{i}', errors, results) for i in range(4)] + \
+              [in_thread(upsert_and_read, f'upsert{i}', errors, results) for i in range(4)]
+    until(lambda: group.stats().pending == 8)
+    # Nobody returns before the transaction holding their write committed
+    assert first.is_alive() and not results
+    gated.release.set()
+    for thread in [first] + threads:
+        thread.join(5)
+    group.stop()
+
+    assert not errors
+    assert gated.groups == [1, 8]
+    assert group.stats() == GroupCommitStats(batches=2, writes=9, pending=0)
+    assert {name: message.name for name, message in read.items()} == {name: name for name in results}
+    revisions = [results[f'upsert{i}'].revision for i in range(4)]
+    assert len(set(revisions)) == 4 and min(revisions) > results['first'].revision
+
+
+def test_max_batch_bounds_a_group(gated):
+    group = GroupCommitStorage(gated, interval=0, max_batch=2).start()
+    errors = {}
+    first = put_in_thread(group, 'first', errors)
+    assert gated.committing.wait(5)
+    threads = [put_in_thread(group, f'web{i}', errors) for i in range(5)]
+    until(lambda: group.stats().pending == 5)
+    gated.release.set()
+    for thread in [first] + threads:
+        thread.join(5)
+    group.stop()
+
+    assert not errors
+    assert gated.groups == [1, 2, 2, 1]
+
+
+def test_the_interval_holds_a_group_open_for_later_writes(gated):
+    gated.release.set()
+    group = GroupCommitStorage(gated, interval=0.05, max_batch=64).start()
+    started = time.monotonic()
+    group.put(Endpoint(owner='alice', name='web'))
+    assert time.monotonic() - started >= 0.05
+
+    # A full group does not wait for the interval
+    slow = GroupCommitStorage(gated, interval=30, max_batch=3).start()
+    errors = {}
+    started = time.monotonic()
+    threads = [put_in_thread(slow, f'api{i}', errors) for i in range(3)]
+    for thread in threads:
+        thread.join(5)
+    assert time.monotonic() - started < 5 and not errors
+    assert gated.groups == [1, 3]
+    group.stop()
+    slow.stop()
+
+
+def test_a_failing_write_is_retried_alone(gated):
+    gated.release.set()
+    existing = gated.put(Endpoint(owner='alice', name='taken'))
+    gated.release.clear()
+    group = GroupCommitStorage(gated, interval=0, max_batch=64).start()
+    errors, results = {}, {}
+    first = put_in_thread(group, 'first', errors, results)
+    assert gated.committing.wait(5)
+    taken = in_thread(lambda name: group.put(Endpoint(owner='alice', name=name), key=existing.key),
+                      'taken', errors, results)
+    threads = [put_in_thread(group, f'web{i}', errors, results) for i in range(2)]
+    until(lambda: group.stats().pending == 3)
+    gated.release.set()
+    for thread in [first, taken] + threads:
+        thread.join(5)
+    group.stop()
+
+    assert set(errors) == {'taken'} and isinstance(errors['taken'], IntegrityError)
+    assert set(results) == {'first', 'web0', 'web1'}
+    # The group of three failed and was written again one write at a time
+    assert gated.groups == [1, 3, 1, 1, 1]
+    assert sorted(e.name for e in gated.all(Endpoint)) == ['first', 'taken', 'web0', 'web1']
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_writes_fail_once_the_writer_died(storage):
+    group = GroupCommitStorage(storage, interval=0, max_batch=1).start()
+    errors = {}
+    first = put_in_thread(group, 'first', errors)
+    assert storage.committing.wait(5)
+    # Queued behind the group that kills the writer
+    second = put_in_thread(group, 'second', errors)
+    while group.stats().pending == 0:
+        time.sleep(0.001)
+    storage.release.set()
+    first.join(5)
+    second.join(5)
+
+    assert not first.is_alive() and not second.is_alive()
+    assert isinstance(errors['first'], WriterKilled)
+    assert isinstance(errors['second'], WriterKilled)
+    with pytest.raises(GroupCommitError):
+        group.put(Endpoint(owner='alice', name='third'))
+    group.stop()
@@ -0,0 +1,71 @@
+import os
+import signal
+
+from sqlalchemy import create_engine, select
+
+from bifrost.id import PARTITION, BifrostResourceID, LazyResourceID, ResourceID, _generator, generate_uuid
+from bifrost.model import SQLAlchemyBaseModel, KeyValue
+from bifrost.storage import SessionFactory, Storage
+from bifrostv1.bifrost_pb2 import Endpoint
+
+
+def test_ids_are_generated_after_a_fork_during_generation():
+    read, write = os.pipe()
+    # As if another thread was generating an id when the process forked
+    with _generator._lock:
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.alarm(5)
+                os.write(write, generate_uuid().encode())
+                code = 0
+            finally:
+                os._exit(code)
+    os.close(write)
+    _, status = os.waitpid(pid, 0)
+    child_id = os.read(read, 64).decode()
+    os.close(read)
+
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert len(child_id) == 32
+    assert generate_uuid() != child_id
+
+
+def test_lazy_resource_ids_read_every_field():
+    tag = BifrostResourceID(service='bifrost', version='v0', owner='alice', type='kv', id='kv-1')
+    lazy = LazyResourceID(str(tag))
+
+    for field in ResourceID._fields:
+        assert getattr(lazy, field) == getattr(tag, field)
+    assert lazy.partition == PARTITION
+    assert lazy._asdict() == tag._asdict()
+    assert str(lazy) == str(tag)
+
+
+def test_lazy_resource_ids_behave_like_the_tuple():
+    tag = BifrostResourceID(service='bifrost', version='v0', owner='alice', type='kv', id='kv-1')
+    lazy = LazyResourceID(str(tag))
+
+    assert lazy == tag and tag == lazy
+    assert not lazy != tag
+    assert lazy != str(tag) and not isinstance(lazy, str)
+    assert hash(lazy) == hash(tag)
+    assert len(lazy) == len(tag)
+    assert lazy[4] == 'alice' and lazy[-1] == 'kv-1'
+    prefix, partition, service, version, owner, type, id = lazy
+    assert (service, owner, id) == ('bifrost', 'alice', 'kv-1')
+    assert tuple(lazy) == tuple(tag)
+
+
+def test_stored_resource_tags_load_lazily(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/tags.db')
+    SQLAlchemyBaseModel.metadata.create_all(engine)
+    storage = Storage(SessionFactory(engine))
+    entry = storage.put(Endpoint(owner='alice', name='web'))
+
+    with engine.connect() as connection:
+        tag = connection.execute(select(KeyValue.uuid)).scalar()
+    assert isinstance(tag, LazyResourceID)
+    assert tag == entry.uuid
+    assert tag.type == 'kv'
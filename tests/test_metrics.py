@@ -0,0 +1,61 @@
+from concurrent import futures
+
+import grpc
+import pytest
+from google.protobuf import empty_pb2
+from thundersnow.precondition import IllegalArgumentError
+
+from bifrost.api import BifrostAPI
+from bifrost.metrics import MetricsInterceptor, Registry
+from bifrost.service import BifrostServiceFactory
+from bifrostv1 import bifrost_pb2_grpc
+from bifrostv1.bifrost_pb2 import CreateEndpointRequest
+
+
+def test_gauges_read_the_callback_registered_last():
+    registry = Registry()
+    registry.gauge('bifrost_pending', 'Pending', callback=lambda: 1)
+    gauge = registry.gauge('bifrost_pending', 'Pending', callback=lambda: 2)
+
+    assert list(gauge.samples()) == [('bifrost_pending', '', 2)]
+    assert 'bifrost_pending 2' in registry.render()
+
+
+def test_gauges_with_labels_cannot_read_a_callback():
+    registry = Registry()
+    with pytest.raises(IllegalArgumentError):
+        registry.gauge('bifrost_phase_seconds', 'Phases', labels=('phase',), callback=lambda: 1)
+
+    registry.gauge('bifrost_pending', 'Pending', labels=('queue',))
+    with pytest.raises(IllegalArgumentError):
+        registry.gauge('bifrost_pending', 'Pending', callback=lambda: 1)
+
+
+def test_the_interceptor_counts_rpcs_by_method_and_code(config):
+    registry = Registry()
+    service = BifrostServiceFactory.create(config._replace(metrics=config.metrics._replace(ENABLED=False)))
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2), interceptors=[MetricsInterceptor(registry)])
+    bifrost_pb2_grpc.add_BifrostServicer_to_server(BifrostAPI(service=service), server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    try:
+        with grpc.insecure_channel(f'127.0.0.1:{port}') as channel:
+            stub = bifrost_pb2_grpc.BifrostStub(channel)
+            stub.CreateEndpoint(CreateEndpointRequest(owner='alice', name='web'))
+            stub.CreateEndpoint(CreateEndpointRequest(owner='alice', name='api'))
+            with pytest.raises(grpc.RpcError):
+                stub.CreateEndpoint(CreateEndpointRequest(owner='alice'))
+            streamed = list(stub.StreamEndpoints(empty_pb2.Empty()))
+    finally:
+        server.stop(None)
+        service.close()
+
+    assert len(streamed) == 2
+    rendered = registry.render()
+    assert 'bifrost_rpc_handled_total{method="CreateEndpoint",code="OK"} 2' in rendered
+    assert 'bifrost_rpc_handled_total{method="CreateEndpoint",code="INVALID_ARGUMENT"} 1' in rendered
+    assert 'bifrost_rpc_handled_total{method="StreamEndpoints",code="OK"} 1' in rendered
+    assert 'bifrost_rpc_latency_seconds_count{method="CreateEndpoint"} 3' in rendered
+    assert 'bifrost_rpc_in_flight{method="CreateEndpoint"} 0' in rendered
+    sent = sum(e.ByteSize() for e in streamed)
+    assert f'bifrost_rpc_streamed_bytes_total{{method="StreamEndpoints",direction="sent"}} {sent}' in rendered
@@ -0,0 +1,55 @@
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from bifrost.prefork import Supervisor, worker_share
+
+
+def interrupt_after(seconds):
+    timer = threading.Timer(seconds, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def sleep_forever(index):
+    while True:
+        time.sleep(1)
+
+
+def fail(index):
+    raise RuntimeError(f'worker {index} failed')
+
+
+def test_children_other_than_workers_are_left_alone():
+    other = subprocess.Popen(['sh', '-c', 'exit 3'])
+    interrupt_after(0.5)
+    Supervisor(sleep_forever, 2, poll_interval=0.01).run()
+
+    # Reaped by the supervisor, Popen would have lost the exit code
+    assert other.wait(5) == 3
+
+
+def test_worker_exit_codes_are_logged(caplog):
+    caplog.set_level(logging.WARNING, logger='bifrost.prefork')
+    interrupt_after(0.5)
+    Supervisor(fail, 1, restart_delay=0.1, poll_interval=0.01).run()
+
+    assert 'exited with code 1, restarting' in caplog.text
+
+
+def test_worker_shares_add_up_to_the_total():
+    for total in (0, 1, 2, 7, 16):
+        for workers in (1, 3, 4, 8):
+            shares = [worker_share(total, workers, index) for index in range(workers)]
+            assert sum(shares) == total
+            assert max(shares) - min(shares) <= 1
+
+
+def test_worker_shares_keep_the_pool_size_within_the_limit():
+    for workers in (1, 3, 4, 8):
+        for index in range(workers):
+            assert worker_share(2, workers, index) <= worker_share(16, workers, index)
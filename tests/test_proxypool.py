@@ -0,0 +1,233 @@
+import itertools
+import threading
+import time
+
+import grpc
+import pytest
+
+from bifrost.api import BifrostAPI
+from bifrost.dockerops import DockerUnavailableError
+from bifrost.memorystorage import MemoryStorage
+from bifrost.proxypool import ProxyPool, ProxyPoolExhaustedError, proxy_key
+from bifrost.service import BifrostService
+from bifrostv1.bifrost_pb2 import Proxy, StartProxyRequest, StopProxyRequest
+
+
+class UnreachableDocker(object):
+    """Fails every call until `up` is set"""
+
+    def __init__(self):
+        self.up = threading.Event()
+        self.listed = threading.Event()
+        self.failed = 0
+
+    def call(self, fn, *args, **kwargs):
+        if not self.up.is_set():
+            self.failed += 1
+            raise DockerUnavailableError('docker is down')
+        self.listed.set()
+        return []
+
+
+class Aborted(Exception):
+    pass
+
+
+class Context(object):
+
+    def __init__(self):
+        self.code = None
+
+    def abort(self, code, details):
+        self.code = code
+        raise Aborted(details)
+
+
+class Index(object):
+
+    def add_listener(self, listener):
+        pass
+
+
+class Containers(object):
+
+    def __init__(self, docker):
+        self.docker = docker
+
+    def run(self, image, command, ports, labels, detach):
+        container_id = f'c{next(self.docker.ids)}'
+        self.docker.state[container_id] = 'running'
+        self.docker.run.append(container_id)
+        return Container(container_id)
+
+
+class Container(object):
+
+    def __init__(self, container_id):
+        self.id = container_id
+
+
+class API(object):
+
+    def __init__(self, docker):
+        self.docker = docker
+        self.ports = itertools.count(32768)
+
+    def inspect_container(self, container_id):
+        return dict(Id=container_id, State=dict(Status=self.docker.state[container_id]),
+                    NetworkSettings=dict(Ports={
+                        '4443/tcp': [dict(HostIp='127.0.0.1', HostPort=str(next(self.ports)))],
+                        '4480/tcp': [dict(HostIp='127.0.0.1', HostPort=str(next(self.ports)))]}))
+
+    def restart(self, container_id, timeout):
+        if self.docker.state[container_id] == 'dead':
+            raise RuntimeError(f'cannot restart {container_id}')
+        self.docker.restarted.append(container_id)
+
+    def remove_container(self, container_id, force):
+        del self.docker.state[container_id]
+        self.docker.removed.append(container_id)
+
+    def containers(self, all, filters):
+        return []
+
+
+class FakeDocker(object):
+    """An executor calling into an in-memory Docker client, whose
+    containers are named c1, c2, ... in the order they are run"""
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.state = {}
+        self.run, self.restarted, self.removed = [], [], []
+        self.containers = Containers(self)
+        self.api = API(self)
+
+    def call(self, fn, *args, **kwargs):
+        return fn(self, *args, **kwargs)
+
+
+def until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+@pytest.fixture
+def docker():
+    return FakeDocker()
+
+
+@pytest.fixture
+def storage():
+    return MemoryStorage()
+
+
+def pool_of(docker, storage, size, max_proxies):
+    return ProxyPool(docker, Index(), storage, 'ngrokd', 'bifrost.valhalla',
+                     size=size, max_proxies=max_proxies).start()
+
+
+def test_acquire_hands_out_a_warm_container_and_refills_the_pool(docker, storage):
+    # Stopping removes the idle container
+    pytest.importorskip('docker')
+    pool = pool_of(docker, storage, size=1, max_proxies=4)
+    try:
+        until(lambda: pool.idle_count() == 1)
+        proxy = pool.acquire('alice')
+        assert proxy.container_id == 'c1' and proxy.user == 'alice'
+        assert proxy.server_addr.startswith('127.0.0.1:')
+        assert storage.get(proxy_key(proxy.uuid), Proxy) == proxy
+
+        until(lambda: pool.idle_count() == 1)
+        assert docker.run == ['c1', 'c2'] and pool.container_count() == 2
+    finally:
+        pool.stop()
+    # The assigned container stays for its user
+    assert docker.removed == ['c2']
+
+
+def test_acquire_fails_once_max_proxies_are_assigned(docker, storage):
+    pool = pool_of(docker, storage, size=0, max_proxies=2)
+    try:
+        # Started on demand while the pool is empty
+        assigned = [pool.acquire('alice'), pool.acquire('bob')]
+        with pytest.raises(ProxyPoolExhaustedError):
+            pool.acquire('carol')
+    finally:
+        pool.stop()
+    assert [p.container_id for p in assigned] == ['c1', 'c2']
+    assert len(list(pool.assigned())) == 2
+
+
+def test_released_containers_are_restarted_and_pooled(docker, storage):
+    pool = pool_of(docker, storage, size=0, max_proxies=1)
+    try:
+        proxy = pool.acquire('alice')
+        assert pool.release(proxy.uuid) == proxy
+        assert storage.get(proxy_key(proxy.uuid), Proxy) is None
+        until(lambda: pool.idle_count() == 1)
+        assert docker.restarted == ['c1']
+        # The slot is free again, and the recycled container is handed out
+        assert pool.acquire('bob').container_id == 'c1'
+    finally:
+        pool.stop()
+    assert docker.run == ['c1']
+
+
+def test_released_containers_that_cannot_restart_are_removed(docker, storage):
+    pytest.importorskip('docker')
+    pool = pool_of(docker, storage, size=0, max_proxies=1)
+    try:
+        proxy = pool.acquire('alice')
+        docker.state[proxy.container_id] = 'dead'
+        pool.release(proxy.uuid)
+        until(lambda: pool.container_count() == 0)
+        assert pool.idle_count() == 0 and docker.removed == ['c1']
+        # Its slot goes to a new container
+        assert pool.acquire('bob').container_id == 'c2'
+    finally:
+        pool.stop()
+
+
+def test_stop_proxy_deletes_the_assignment(config, docker, storage):
+    pool = pool_of(docker, storage, size=0, max_proxies=1)
+    api = BifrostAPI(service=BifrostService(config, storage, docker=docker, proxies=pool))
+    try:
+        started = api.StartProxy(StartProxyRequest(user='alice'), Context())
+        assert storage.get(proxy_key(started.uuid), Proxy) == started.proxy
+        assert list(api.StreamProxies(None, Context())) == [started.proxy]
+
+        api.StopProxy(StopProxyRequest(uuid=started.uuid), Context())
+        assert storage.get(proxy_key(started.uuid), Proxy) is None
+        assert list(api.StreamProxies(None, Context())) == []
+        context = Context()
+        with pytest.raises(Aborted):
+            api.StopProxy(StopProxyRequest(uuid=started.uuid), context)
+        assert context.code is grpc.StatusCode.NOT_FOUND
+    finally:
+        pool.stop()
+
+
+def test_reconcile_is_retried_off_the_starting_thread():
+    docker = UnreachableDocker()
+    pool = ProxyPool(docker, Index(), MemoryStorage(), 'ngrokd', 'bifrost.valhalla',
+                     size=0, retry_interval=0.01).start()
+    try:
+        while docker.failed < 3:
+            threading.Event().wait(0.01)
+        assert not docker.listed.is_set()
+
+        docker.up.set()
+        assert docker.listed.wait(5)
+    finally:
+        pool.stop()
+
+
+def test_a_pool_stopped_before_docker_answers_stops():
+    docker = UnreachableDocker()
+    pool = ProxyPool(docker, Index(), MemoryStorage(), 'ngrokd', 'bifrost.valhalla',
+                     size=0, retry_interval=60).start()
+    pool.stop()
+    assert not docker.listed.is_set()
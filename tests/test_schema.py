@@ -0,0 +1,151 @@
+import json
+
+from google.protobuf import any_pb2
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+
+from bifrost.id import prefix_for
+from bifrost.model import SCHEMA_VERSION, TOMBSTONE_TABLE, KeyValue
+from bifrost.schema import ensure_schema
+from bifrost.service import endpoint_key
+from bifrost.sqlaext import create_partitions
+from bifrost.storage import EnvelopeFormat, SessionFactory, Storage, delete_statement, entry_lock_query, \
+    entry_query, keys_query, page_query, upsert_statement
+from bifrostv1.bifrost_pb2 import Endpoint, Proxy
+
+
+# bifrost_v1_key_value as created before binary envelopes, resource types,
+# revisions and the version table
+BASELINE_DDL = (
+    '''CREATE TABLE bifrost_v1_key_value (
+        key VARCHAR(2048) NOT NULL,
+        value JSON NOT NULL,
+        owner_id VARCHAR(255) NOT NULL,
+        uuid VARCHAR(4096),
+        created DATETIME NOT NULL,
+        updated DATETIME NOT NULL,
+        PRIMARY KEY (key))''',
+    'CREATE UNIQUE INDEX ix_bifrost_v1_key_value_uuid ON bifrost_v1_key_value (uuid)',
+)
+
+
+def baseline_engine(tmp_path, endpoints):
+    engine = create_engine(f'sqlite:///{tmp_path}/baseline.db')
+    envelope_type = KeyValue.__table__.c.value.type
+    with engine.begin() as connection:
+        for ddl in BASELINE_DDL:
+            connection.execute(text(ddl))
+        for i, endpoint in enumerate(endpoints):
+            envelope = any_pb2.Any()
+            envelope.Pack(endpoint)
+            value = envelope_type.process_bind_param(envelope, connection.dialect)
+            connection.execute(
+                text("INSERT INTO bifrost_v1_key_value VALUES (:key, json(:value), :owner, :uuid, "
+                     "'2020-01-01 00:00:00', '2020-01-01 00:00:00')"),
+                dict(key=f'endpoint-{i:04d}', value=json.dumps(value),
+                     owner=endpoint.owner, uuid=f'tag-{i}'))
+    return engine
+
+
+def test_upgrades_a_baseline_table(tmp_path):
+    endpoints = [Endpoint(owner='alice', name=f'web{i}') for i in range(3)]
+    engine = baseline_engine(tmp_path, endpoints)
+
+    assert ensure_schema(engine)
+    assert not ensure_schema(engine)
+
+    columns = {c['name']: c for c in inspect(engine).get_columns(KeyValue.__tablename__)}
+    assert {'value_bin', 'resource_type', 'revision'} <= set(columns)
+    assert columns['value']['nullable']
+
+    storage = Storage(SessionFactory(engine), envelope_format=EnvelopeFormat.binary)
+    assert [e.name for e in storage.all(Endpoint)] == ['web0', 'web1', 'web2']
+    revisions = [r.revision for r in storage.changed_since(Endpoint)]
+    assert sorted(revisions) == revisions and len(set(revisions)) == 3 and revisions[0] > 0
+
+    assert storage.migrate_envelopes() == 3
+    assert [e.name for e in storage.all(Endpoint)] == ['web0', 'web1', 'web2']
+    storage.put(Endpoint(owner='bob', name='api'))
+    assert storage.count(Endpoint) == 4
+
+
+def test_creates_the_current_schema(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/fresh.db')
+    assert ensure_schema(engine)
+    with engine.connect() as connection:
+        assert connection.execute(text('SELECT max(version) FROM bifrost_v1_schema_version')).scalar() \
+            == SCHEMA_VERSION
+
+
+def test_a_current_schema_is_checked_with_one_query(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/current.db')
+    ensure_schema(engine)
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+
+    assert not ensure_schema(engine)
+    assert len(statements) == 1 and 'bifrost_v1_schema_version' in statements[0]
+
+
+def test_adds_the_tombstone_table(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/v2.db')
+    ensure_schema(engine, 2)
+    # As version 2 left it
+    TOMBSTONE_TABLE.drop(engine)
+
+    assert ensure_schema(engine)
+    storage = Storage(SessionFactory(engine))
+    entry = storage.put(Endpoint(owner='alice', name='web'))
+    assert storage.delete(entry.key, Endpoint)
+    assert [t.key for t in storage.deleted_since(Endpoint)] == [entry.key]
+
+
+def test_pages_are_read_in_key_order_without_a_sort(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/plan.db')
+    ensure_schema(engine)
+    with engine.connect() as connection:
+        for query in (page_query(Endpoint, None, 10, None), page_query(Endpoint, 'endpoint-b', 10, None),
+                      keys_query(Endpoint, 'endpoint-b', 10, None)):
+            compiled = query.compile(dialect=connection.dialect, compile_kwargs=dict(literal_binds=True))
+            plan = ' / '.join(row[-1] for row in connection.execute(text(f'EXPLAIN QUERY PLAN {compiled}')))
+            assert 'ix_bifrost_v1_key_value_resource_type_key' in plan
+            assert 'TEMP B-TREE' not in plan
+
+
+class Recorder(object):
+    """A postgres connection that records what it is asked to run"""
+
+    def __init__(self):
+        self.dialect = postgresql.dialect()
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(str(statement))
+
+
+def test_key_values_are_partitioned_by_resource_type_on_postgres():
+    table = KeyValue.__table__
+    ddl = str(CreateTable(table).compile(dialect=postgresql.dialect()))
+    assert 'PARTITION BY LIST (resource_type)' in ddl
+    assert {prefix_for(Endpoint), prefix_for(Proxy)} <= set(table.info['partitions'])
+
+    connection = Recorder()
+    create_partitions(connection, table)
+    assert connection.statements == [
+        f"CREATE TABLE IF NOT EXISTS {table.name}_endpoint PARTITION OF {table.name} FOR VALUES IN ('endpoint')",
+        f"CREATE TABLE IF NOT EXISTS {table.name}_proxy PARTITION OF {table.name} FOR VALUES IN ('proxy')",
+        f'CREATE TABLE IF NOT EXISTS {table.name}_default PARTITION OF {table.name} DEFAULT',
+    ]
+
+
+def test_statements_on_one_entry_name_its_partition():
+    key = endpoint_key('alice', 'web')
+    for statement in (entry_query(key, Endpoint), entry_lock_query(key, 'endpoint'),
+                      delete_statement(key, 'endpoint')):
+        compiled = statement.compile(dialect=postgresql.dialect())
+        assert 'resource_type = %(resource_type_1)s' in str(compiled)
+        assert compiled.params['resource_type_1'] == 'endpoint'
+
+    upsert = upsert_statement(postgresql.dialect(), dict(key=key, resource_type='endpoint'))
+    assert 'ON CONFLICT (key, resource_type)' in str(upsert.compile(dialect=postgresql.dialect()))
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import time
+from concurrent import futures
+
+import pytest
+from sqlalchemy import create_engine
+
+from bifrost.aioservice import AsyncBifrostServiceFactory
+from bifrost.changefeed import EventType
+from bifrost.proxypool import ProxyPoolDisabledError
+from bifrost.schema import ensure_schema
+from bifrost.service import BifrostServiceFactory, endpoint_key
+from bifrostv1.bifrost_pb2 import Endpoint
+
+
+def test_services_without_the_proxy_pool_never_reach_docker(config):
+    config = config._replace(proxy_pool=config.proxy_pool._replace(ENABLED=False))
+    service = BifrostServiceFactory.create(config)
+    try:
+        assert service.docker is None and service.containers is None
+        with pytest.raises(ProxyPoolDisabledError):
+            service.start_proxy('alice')
+        assert list(service.iter_proxies()) == []
+    finally:
+        service.close()
+
+
+def test_the_async_service_watches_endpoints_and_refuses_proxies_without_the_pool(config, tmp_path):
+    uri = f'sqlite:///{tmp_path}/async.db'
+    ensure_schema(create_engine(uri))
+    config = config._replace(DATABASE_URI=uri, metrics=config.metrics._replace(ENABLED=False))
+
+    async def run():
+        service = AsyncBifrostServiceFactory.create(config)
+        try:
+            await service.create_endpoint(Endpoint(owner='alice', name='web'))
+            events = service.watch_endpoints().__aiter__()
+            seen = [await events.__anext__(), await events.__anext__()]
+            await service.storage.delete(endpoint_key('alice', 'web'), Endpoint)
+            seen.append(await events.__anext__())
+            await events.aclose()
+
+            with pytest.raises(ProxyPoolDisabledError):
+                await service.start_proxy('alice')
+            assert [proxy async for proxy in service.iter_proxies()] == []
+            return seen
+        finally:
+            service.close()
+
+    seen = asyncio.run(run())
+    assert [e.type for e in seen] == [EventType.snapshot, EventType.synced, EventType.deleted]
+    assert seen[0].message.name == 'web' and seen[2].key == endpoint_key('alice', 'web')
+
+
+def test_endpoints_are_listed_a_page_at_a_time(config):
+    service = BifrostServiceFactory.create(config._replace(metrics=config.metrics._replace(ENABLED=False)))
+    try:
+        for i in range(3):
+            service.create_endpoint(Endpoint(owner='alice', name=f'web-{i}'))
+        first, token = service.list_endpoints(page_size=2)
+        second, last_token = service.list_endpoints(page_size=2, page_token=token)
+    finally:
+        service.close()
+
+    assert [e.name for e in first + second] == ['web-0', 'web-1', 'web-2']
+    assert token and last_token == ''
+
+
+def test_concurrent_identical_client_config_renders_are_coalesced(config):
+    service = BifrostServiceFactory.create(config._replace(metrics=config.metrics._replace(ENABLED=False)))
+    render = service.client_configs.render
+    started, release = threading.Event(), threading.Event()
+
+    def slow_render(subdomain):
+        started.set()
+        release.wait(5)
+        return render(subdomain)
+    service.client_configs.render = slow_render
+    try:
+        with futures.ThreadPoolExecutor(4) as pool:
+            leader = pool.submit(service.client_config, 'web')
+            started.wait(5)
+            waiters = [pool.submit(service.client_config, 'web') for _ in range(3)]
+            deadline = time.monotonic() + 5
+            while service.flight.stats().coalesced < 3:
+                assert time.monotonic() < deadline
+                time.sleep(0.001)
+            release.set()
+            rendered = [f.result(5) for f in [leader] + waiters]
+    finally:
+        service.close()
+
+    assert service.flight.stats().executed == 1
+    assert all(r is rendered[0] for r in rendered)
+    assert rendered[0].proxy_uri.startswith('http://web.')
@@ -0,0 +1,84 @@
+import asyncio
+import threading
+import time
+from concurrent import futures
+
+import pytest
+
+from bifrost.singleflight import AsyncSingleFlight, SingleFlight, SingleFlightStats
+
+
+def until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_concurrent_identical_calls_share_one_execution():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def read():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return ['web']
+
+    with futures.ThreadPoolExecutor(4) as pool:
+        leader = pool.submit(flight.do, 'page', read)
+        started.wait(5)
+        waiters = [pool.submit(flight.do, 'page', read) for _ in range(3)]
+        until(lambda: flight.stats().coalesced == 3)
+        release.set()
+        results = [f.result(5) for f in [leader] + waiters]
+
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert flight.stats() == SingleFlightStats(executed=1, coalesced=3, in_flight=0)
+    # Nothing is kept once the call returned
+    assert flight.do('page', lambda: ['api']) == ['api']
+
+
+def test_waiters_share_the_error_of_the_call():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise LookupError('gone')
+
+    with futures.ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(flight.do, 'page', fail)
+        started.wait(5)
+        waiter = pool.submit(flight.do, 'page', fail)
+        until(lambda: flight.stats().coalesced == 1)
+        release.set()
+        for f in (leader, waiter):
+            with pytest.raises(LookupError):
+                f.result(5)
+
+
+def test_a_cancelled_waiter_leaves_the_async_call_running():
+    async def run():
+        flight = AsyncSingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def read():
+            calls.append(1)
+            await release.wait()
+            return ['web']
+
+        first = asyncio.ensure_future(flight.do('page', read))
+        second = asyncio.ensure_future(flight.do('page', read))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        return calls, await second, flight.stats()
+
+    calls, result, stats = asyncio.run(run())
+    assert calls == [1] and result == ['web']
+    assert stats == SingleFlightStats(executed=1, coalesced=1, in_flight=0)
@@ -0,0 +1,27 @@
+import subprocess
+import sys
+from pathlib import Path
+
+from bifrost.startup import StartupTimer
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def test_phases_are_timed_from_mark_to_mark():
+    ticks = iter([1.0, 1.5, 3.0])
+    timer = StartupTimer(started=0.25, clock=lambda: next(ticks))
+    timer.mark('imports')
+    timer.mark('schema')
+    timer.mark('listen')
+
+    assert timer.phases() == [('imports', 0.75), ('schema', 0.5), ('listen', 1.5)]
+    assert timer.total() == 2.75
+    assert timer.report() == 'started in 2.750s (imports 0.750s, schema 0.500s, listen 1.500s)'
+
+
+def test_the_server_module_imports_its_heavy_dependencies_lazily():
+    heavy = ('sqlalchemy', 'docker', 'yaml', 'jinja2', 'pkg_resources', 'bifrost.service')
+    script = f'import sys, server; print(" ".join(m for m in {heavy!r} if m in sys.modules))'
+    imported = subprocess.run([sys.executable, '-c', script], cwd=ROOT, check=True,
+                              stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+    assert imported == []
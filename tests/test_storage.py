@@ -0,0 +1,155 @@
+import threading
+
+import pytest
+from sqlalchemy import create_engine, event, func, select, text
+
+from bifrost.memorystorage import MemoryStorage
+from bifrost.model import SQLAlchemyBaseModel, KeyValue
+from bifrost.service import endpoint_key
+from bifrost.storage import EnvelopeFormat, SessionFactory, Storage
+from bifrostv1.bifrost_pb2 import Endpoint, Proxy
+
+
+def test_storages_sharing_a_database_allocate_distinct_revisions(tmp_path):
+    uri = f'sqlite:///{tmp_path}/shared.db'
+    SQLAlchemyBaseModel.metadata.create_all(create_engine(uri))
+    # Each with its own engine and write lock, like pre-forked workers
+    storages = [Storage(SessionFactory(create_engine(uri, connect_args=dict(timeout=30)))) for _ in range(4)]
+
+    def put(storage, worker):
+        for i in range(50):
+            storage.put(Endpoint(owner='alice', name=f'{worker}-{i}'))
+
+    threads = [threading.Thread(target=put, args=(storage, worker)) for worker, storage in enumerate(storages)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    engine = storages[0].session_factory._engine
+    with engine.connect() as connection:
+        count, revisions = connection.execute(
+            select(func.count(), func.count(KeyValue.revision.distinct()))).one()
+    assert count == revisions == 200
+
+
+def test_binary_envelopes_leave_the_json_column_null(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/envelopes.db')
+    SQLAlchemyBaseModel.metadata.create_all(engine)
+    storage = Storage(SessionFactory(engine), envelope_format=EnvelopeFormat.binary)
+    storage.put(Endpoint(owner='alice', name='web'))
+    storage.put_many([Endpoint(owner='alice', name='api')])
+    storage.upsert(Endpoint(owner='bob', name='web'), 'endpoint-bob/web')
+
+    json_storage = Storage(SessionFactory(engine), envelope_format=EnvelopeFormat.json)
+    json_storage.put(Endpoint(owner='carol', name='web'))
+    assert json_storage.migrate_envelopes() == 1
+
+    with engine.connect() as connection:
+        assert connection.execute(text(f'SELECT count(*) FROM {KeyValue.__tablename__} '
+                                       f'WHERE value IS NULL AND value_bin IS NOT NULL')).scalar() == 4
+    assert sorted(e.name for e in storage.all(Endpoint)) == ['api', 'web', 'web', 'web']
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def storage(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryStorage()
+    engine = create_engine(f'sqlite:///{tmp_path}/storage.db')
+    SQLAlchemyBaseModel.metadata.create_all(engine)
+    return Storage(SessionFactory(engine))
+
+
+def test_entries_are_deleted_by_their_type(storage):
+    key = endpoint_key('alice', 'web')
+    storage.put(Proxy(user='alice'), key=key)
+
+    assert not storage.delete(key, Endpoint)
+    assert storage.get(key, Proxy).user == 'alice'
+    assert storage.delete(key, Proxy)
+    assert storage.get(key, Proxy) is None
+    assert not storage.delete(key, Proxy)
+
+
+def test_revisions_of_deleted_entries_are_not_handed_out_again(tmp_path):
+    uri = f'sqlite:///{tmp_path}/restarted.db'
+    SQLAlchemyBaseModel.metadata.create_all(create_engine(uri))
+    storage = Storage(SessionFactory(create_engine(uri)))
+    key = storage.put(Endpoint(owner='alice', name='web')).key
+    storage.delete(key, Endpoint)
+
+    # As after a restart, with nothing handed out by this process yet
+    restarted = Storage(SessionFactory(create_engine(uri)))
+    assert [t.revision for t in restarted.deleted_since(Endpoint)] == [2]
+    assert restarted.put(Endpoint(owner='alice', name='web')).revision == 3
+
+
+def test_pages_resume_after_the_last_key_of_a_full_page(storage):
+    keys = storage.put_many([Endpoint(owner='alice', name=f'web-{i}') for i in range(5)])
+
+    pages, after_key = [], None
+    while True:
+        page = storage.page(Endpoint, after_key, page_size=2)
+        pages.append([e.name for e in page.messages])
+        if page.next_key is None:
+            break
+        after_key = page.next_key
+    assert pages == [['web-0', 'web-1'], ['web-2', 'web-3'], ['web-4']]
+
+    # A page that ends exactly at the last key still points past it
+    last = storage.page(Endpoint, keys[1], page_size=3)
+    assert last.next_key == keys[-1]
+    assert storage.page(Endpoint, last.next_key, page_size=3) == ([], None)
+    assert [e.name for e in storage.iter(Endpoint, page_size=2)] == [f'web-{i}' for i in range(5)]
+
+
+def test_queries_only_see_entries_of_their_type(storage):
+    storage.put_many([Endpoint(owner='alice', name='web'), Endpoint(owner='bob', name='api')])
+    storage.put_many([Proxy(user='alice'), Proxy(user='bob')])
+
+    assert storage.count(Endpoint) == storage.count(Proxy) == 2
+    assert sorted(e.name for e in storage.all(Endpoint)) == ['api', 'web']
+    assert all(key.startswith('endpoint-') for key in storage.keys(Endpoint))
+    assert [e.name for e in storage.page(Endpoint, owner='alice').messages] == ['web']
+    assert storage.count(Endpoint, owner='carol') == 0
+
+
+def test_put_many_stores_a_batch_per_insert(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/bulk.db')
+    SQLAlchemyBaseModel.metadata.create_all(engine)
+    storage = Storage(SessionFactory(engine), batch_size=50)
+    inserts = []
+    event.listen(engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *args: inserts.append(statement)
+                 if statement.startswith('INSERT') else None)
+
+    messages = [Endpoint(owner='alice', name=f'web-{i}') for i in range(120)]
+    keys = storage.put_many(messages)
+
+    assert len(inserts) == 3
+    assert len(set(keys)) == 120 and keys == sorted(keys)
+    stored = [storage.get(key, Endpoint) for key in keys]
+    assert [e.name for e in stored] == [m.name for m in messages]
+    assert all(len(e.tags) == 1 for e in stored)
+    assert storage.put_many([]) == []
+
+
+def test_upserts_replace_the_entry_under_their_key(storage):
+    key = endpoint_key('alice', 'web')
+    added = storage.upsert(Endpoint(owner='alice', name='web', url='http://a'), key)
+    updated = storage.upsert(Endpoint(owner='alice', name='web', url='http://b'), key)
+
+    assert added.added and not updated.added
+    assert updated.revision > added.revision
+    # The resource tag stays with the entry
+    assert list(updated.message.tags) == list(added.message.tags)
+    assert storage.get(key, Endpoint).url == 'http://b'
+    assert storage.count(Endpoint) == 1
+
+    # Within one batch the last message for a key wins
+    other = endpoint_key('alice', 'api')
+    revisions = storage.upsert_many([(Endpoint(owner='alice', name='api', url='http://c'), other),
+                                     (Endpoint(owner='alice', name='api', url='http://d'), other)])
+    assert [r.added for r in revisions] == [True, False]
+    assert storage.get(other, Endpoint).url == 'http://d'
+    assert storage.count(Endpoint) == 2